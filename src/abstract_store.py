@@ -0,0 +1,279 @@
+# packed PubMed abstract store
+import os
+import sys
+import mmap
+import shutil
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+
+"""
+Packed store of the PubMed title+abstract text files.
+
+Instead of one /pubmed_abstracts/<pmid>.txt file per article, the texts are
+concatenated in a single data file, with a sorted array of PMIDs and an array of
+offsets. Both arrays and the data file are memory-mapped, so a lookup is a binary
+search over the PMIDs followed by a slice of the data file.
+
+Store directory layout:
+pmids.npy: sorted PMIDs (uint64)
+offsets.npy: start of each text in abstracts.dat, with the end of the file at the end
+abstracts.dat: concatenated text files
+updates/: texts added or changed since the store was packed, in the same layout, with
+    deleted.npy: sorted PMIDs deleted since the store was packed
+
+Lookups check the update segment before the packed texts, so the texts changed by the
+PubMed update files are applied with update_store, which only rewrites the update
+segment. The whole store is packed again once the update segment holds more than a
+tenth of the texts.
+
+Convert the directory of text files with:
+
+    python src/abstract_store.py /pubmed_abstracts/ /pubmed_abstracts_packed/
+"""
+
+PMIDS_FILE = "pmids.npy"
+OFFSETS_FILE = "offsets.npy"
+DATA_FILE = "abstracts.dat"
+UPDATES_DIR = "updates"
+DELETED_FILE = "deleted.npy"
+# share of the texts in the update segment above which update_store packs the store
+MAX_UPDATES = 0.1
+
+
+def search(pmids, pmid):
+    """Position of a PMID in a sorted array of PMIDs, or None"""
+    i = int(np.searchsorted(pmids, pmid))
+    if i < len(pmids) and pmids[i] == pmid:
+        return i
+    return None
+
+
+class AbstractStore:
+    """Read-only memory-mapped abstract store
+
+    :param path: store directory
+    :type path: string
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pmids = np.load(os.path.join(path, PMIDS_FILE), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        self.data_file = open(os.path.join(path, DATA_FILE), "rb")
+        if self.offsets[-1] > 0:
+            self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b""
+        self.view = memoryview(self.data)
+        updates_path = os.path.join(path, UPDATES_DIR)
+        if os.path.isdir(updates_path):
+            self.updates = AbstractStore(updates_path)
+            self.deleted = np.load(os.path.join(updates_path, DELETED_FILE))
+        else:
+            self.updates = None
+            self.deleted = np.zeros(0, dtype=np.uint64)
+
+    def __len__(self):
+        if self.updates is None:
+            return len(self.pmids)
+        return len(self.get_pmids())
+
+    def __contains__(self, pmid):
+        return self.find(pmid) is not None
+
+    def get_pmids(self):
+        """Sorted PMIDs of the store, including the update segment
+
+        :rtype: numpy.ndarray
+        """
+        if self.updates is None:
+            return self.pmids
+        packed = np.setdiff1d(self.pmids, self.deleted, assume_unique=True)
+        return np.union1d(packed, self.updates.pmids)
+
+    def find(self, pmid):
+        """Segment of the store holding a PMID and its position in the segment, or
+        None if it is not stored
+
+        The update segment is checked before the packed texts.
+        """
+        if not str(pmid).isdigit():
+            return None
+        pmid = np.uint64(pmid)
+        if self.updates is not None:
+            found = self.updates.find(pmid)
+            if found is not None:
+                return found
+            if search(self.deleted, pmid) is not None:
+                return None
+        i = search(self.pmids, pmid)
+        if i is None:
+            return None
+        return self, i
+
+    def get_bytes(self, pmid):
+        """Text file of a PMID, as a memoryview of the data file
+
+        :param pmid: PubMed ID
+        :type pmid: string
+        :return: text file contents or None if the PMID is not stored
+        :rtype: memoryview
+        """
+        found = self.find(pmid)
+        if found is None:
+            return None
+        segment, i = found
+        return segment.view[int(segment.offsets[i]) : int(segment.offsets[i + 1])]
+
+    def get(self, pmid):
+        """Text file of a PMID
+
+        :param pmid: PubMed ID
+        :type pmid: string
+        :return: text file contents or None if the PMID is not stored
+        :rtype: string
+        """
+        text = self.get_bytes(pmid)
+        if text is None:
+            return None
+        return str(text, "utf-8")
+
+    def close(self):
+        if self.updates is not None:
+            self.updates.close()
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data_file.close()
+
+
+def list_directory(abstract_path):
+    """Sorted PMIDs of the <pmid>.txt files of a directory
+
+    :rtype: numpy.ndarray
+    """
+    print("listing", abstract_path)
+    pmids = []
+    with os.scandir(abstract_path) as entries:
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext == ".txt" and name.isdigit():
+                pmids.append(int(name))
+    return np.sort(np.array(pmids, dtype=np.uint64))
+
+
+def write_segment(abstract_path, pmids, path):
+    """Write the text files of sorted PMIDs in the store layout
+
+    :param abstract_path: directory where pubmed text files are stored as .txt files
+    :type abstract_path: string
+    :param pmids: sorted PMIDs
+    :type pmids: numpy.ndarray
+    :param path: directory to write, created
+    :type path: string
+    """
+    os.makedirs(path)
+    offsets = np.zeros(len(pmids) + 1, dtype=np.uint64)
+    offset = 0
+    with open(os.path.join(path, DATA_FILE), "wb") as data:
+        for i, pmid in enumerate(tqdm(pmids)):
+            with open(os.path.join(abstract_path, "{}.txt".format(pmid)), "rb") as f:
+                text = f.read()
+            data.write(text)
+            offset += len(text)
+            offsets[i + 1] = offset
+    np.save(os.path.join(path, PMIDS_FILE), pmids)
+    np.save(os.path.join(path, OFFSETS_FILE), offsets)
+
+
+def replace_directory(tmp_path, path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def pack_directory(abstract_path, store_path):
+    """Convert a directory of <pmid>.txt files into a packed store
+
+    The store is written to a temporary directory and moved to *store_path* when
+    complete.
+
+    :param abstract_path: directory where pubmed text files are stored as .txt files
+    :type abstract_path: string
+    :param store_path: store directory
+    :type store_path: string
+    :return: number of texts packed
+    :rtype: int
+    """
+    pmids = list_directory(abstract_path)
+    tmp_path = store_path.rstrip("/") + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    write_segment(abstract_path, pmids, tmp_path)
+    replace_directory(tmp_path, store_path)
+    return len(pmids)
+
+
+def update_store(abstract_path, store_path, changed):
+    """Apply the text files added, changed or deleted since the store was packed
+
+    The texts of the changed PMIDs and of the PMIDs already in the update segment are
+    read again from *abstract_path* and written to a new update segment; PMIDs without
+    a text file are recorded as deleted. The packed texts are not rewritten, unless
+    the update segment would hold more than MAX_UPDATES of the texts, in which case
+    the whole directory is packed again.
+
+    :param abstract_path: directory where pubmed text files are stored as .txt files
+    :type abstract_path: string
+    :param store_path: store directory, packed if it does not exist
+    :type store_path: string
+    :param changed: PMIDs written or deleted since the last update
+    :type changed: iterable
+    :return: number of texts packed, or of texts and deleted PMIDs in the update
+        segment
+    :rtype: int
+    """
+    if not os.path.isdir(store_path):
+        return pack_directory(abstract_path, store_path)
+    store = AbstractStore(store_path)
+    pmids = set(int(p) for p in changed)
+    if store.updates is not None:
+        pmids.update(int(p) for p in store.updates.pmids)
+        pmids.update(int(p) for p in store.deleted)
+    n_packed = len(store.pmids)
+    store.close()
+    if len(pmids) > MAX_UPDATES * n_packed:
+        return pack_directory(abstract_path, store_path)
+
+    pmids = sorted(pmids)
+    exists = [
+        os.path.isfile(os.path.join(abstract_path, "{}.txt".format(p))) for p in pmids
+    ]
+    texts = np.array([p for p, e in zip(pmids, exists) if e], dtype=np.uint64)
+    deleted = np.array([p for p, e in zip(pmids, exists) if not e], dtype=np.uint64)
+    updates_path = os.path.join(store_path, UPDATES_DIR)
+    tmp_path = updates_path + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    write_segment(abstract_path, texts, tmp_path)
+    np.save(os.path.join(tmp_path, DELETED_FILE), deleted)
+    replace_directory(tmp_path, updates_path)
+    return len(pmids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pack pubmed text files.")
+    parser.add_argument("abstract_path", help="directory of <pmid>.txt files")
+    parser.add_argument("store_path", help="store directory to write")
+    args = parser.parse_args()
+    if not os.path.isdir(args.abstract_path):
+        print("directory not found", args.abstract_path)
+        sys.exit()
+    n = pack_directory(args.abstract_path, args.store_path)
+    print("packed {} texts into {}".format(n, args.store_path))
+
+
+if __name__ == "__main__":
+    main()
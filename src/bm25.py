@@ -0,0 +1,484 @@
+# local BM25 retrieval over the pubmed abstract corpus
+import os
+import re
+import sys
+import json
+import html
+import shutil
+import argparse
+import multiprocessing
+from collections import Counter
+
+import numpy as np
+import scipy.sparse
+from tqdm import tqdm
+
+from pubmed import get_abstract_store
+from query_analysis import query_analyzer
+
+"""
+BM25 retrieval engine that runs without galago or the PubMed API.
+
+The inverted index is built once from the abstract corpus (the packed abstract store
+if it exists, otherwise the directory of text files) and saved as numpy arrays that
+are memory-mapped when searching, so only the postings of the query terms are read:
+
+terms.txt: one term per line, the line number is the term id
+pmids.npy: PMID of each document (uint64)
+doc_len.npy: number of terms of each document (float32)
+indptr.npy: start of the postings of each term in indices and tf (int64)
+indices.npy: document of each posting (int32)
+tf.npy: frequency of the term in the document of each posting (uint16)
+meta.json: number of documents and average document length
+
+While building, the postings are written to disk by term bucket and each bucket is
+sorted by term alone (see build_index), so the index does not have to fit in memory.
+
+The BM25 weights are computed at search time, so k1 and b (bm25_k1 and bm25_b in
+params.json) can be changed without rebuilding the index. Queries are scored in
+batches with a sparse matrix product and split between processes.
+
+Build the index with:
+
+    python src/bm25.py --abstract_path /pubmed_abstracts/ --index /pubmed_bm25_idx/
+"""
+
+with open("params.json", "r") as f:
+    params = json.load(f)
+
+TOKEN_RE = re.compile(r"\w+")
+# documents per indexing task
+INDEX_CHUNK_SIZE = 10000
+# term buckets of the postings written to disk while indexing
+INDEX_BUCKETS = 64
+# queries scored together
+QUERY_BATCH_SIZE = 64
+
+
+def tokenize(text):
+    """Lowercased word tokens of documents and queries"""
+    return TOKEN_RE.findall(text.lower())
+
+
+def list_corpus(abstract_path):
+    """PMIDs of the abstract corpus, from the packed store if it exists"""
+    store = get_abstract_store()
+    if store is not None:
+        return [str(pmid) for pmid in store.get_pmids()]
+    pmids = []
+    with os.scandir(abstract_path) as entries:
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext == ".txt" and name.isdigit():
+                pmids.append(name)
+    return sorted(pmids, key=int)
+
+
+def read_text(pmid, abstract_path):
+    store = get_abstract_store()
+    if store is not None:
+        return store.get(pmid) or ""
+    with open(os.path.join(abstract_path, pmid + ".txt"), "r") as f:
+        return f.read()
+
+
+def index_chunk(args):
+    """Term frequencies of a chunk of documents, with the terms of the chunk
+
+    :return: terms, CSR arrays (indptr, indices, tf) and document lengths
+    :rtype: tuple
+    """
+    pmids, abstract_path = args
+    terms = {}
+    indptr = [0]
+    indices = []
+    tfs = []
+    doc_len = []
+    for pmid in pmids:
+        tokens = tokenize(read_text(pmid, abstract_path))
+        counts = Counter(tokens)
+        for term, tf in counts.items():
+            indices.append(terms.setdefault(term, len(terms)))
+            tfs.append(tf)
+        indptr.append(len(indices))
+        doc_len.append(len(tokens))
+    return (
+        list(terms),
+        np.array(indptr, dtype=np.int64),
+        np.array(indices, dtype=np.int64),
+        np.minimum(np.array(tfs, dtype=np.int64), np.iinfo(np.uint16).max),
+        np.array(doc_len, dtype=np.float32),
+    )
+
+
+def write_postings(files, term_ids, docs, tf, n_buckets):
+    """Append postings to the files of their term bucket (term id % n_buckets)
+
+    The term id in the bucket (term id // n_buckets) is written with each posting.
+    """
+    buckets = term_ids % n_buckets
+    order = np.argsort(buckets, kind="stable")
+    bounds = np.searchsorted(buckets[order], np.arange(n_buckets + 1))
+    local_ids = (term_ids // n_buckets).astype(np.int32)
+    for bucket in range(n_buckets):
+        selected = order[bounds[bucket] : bounds[bucket + 1]]
+        if len(selected) == 0:
+            continue
+        terms_file, docs_file, tf_file = files[bucket]
+        local_ids[selected].tofile(terms_file)
+        docs[selected].tofile(docs_file)
+        tf[selected].tofile(tf_file)
+
+
+def build_index(abstract_path, index_path, processes=None, n_buckets=INDEX_BUCKETS):
+    """Build the inverted index of the abstract corpus
+
+    The postings of each chunk of documents are appended to the files of their term
+    bucket (term id % n_buckets), in document order. Each bucket is then loaded
+    alone, sorted by term (stable, so the postings of a term stay in document order)
+    and copied to its range of the memory-mapped indices and tf arrays, the terms
+    being numbered bucket by bucket. Only the postings of one chunk or of one bucket
+    are held in memory.
+
+    :param abstract_path: directory where pubmed text files are stored as .txt files
+    :type abstract_path: string
+    :param index_path: index directory
+    :type index_path: string
+    :param processes: number of tokenizer processes, by default the number of cores
+    :type processes: int
+    :param n_buckets: number of term buckets written to disk
+    :type n_buckets: int
+    :return: number of documents and terms
+    :rtype: tuple
+    """
+    pmids = list_corpus(abstract_path)
+    print("indexing {} documents".format(len(pmids)))
+    chunks = [
+        (pmids[i : i + INDEX_CHUNK_SIZE], abstract_path)
+        for i in range(0, len(pmids), INDEX_CHUNK_SIZE)
+    ]
+    tmp_path = index_path.rstrip("/") + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    postings_path = os.path.join(tmp_path, "postings")
+    os.makedirs(postings_path)
+    bucket_files = [
+        [
+            os.path.join(postings_path, "{}.{}".format(bucket, name))
+            for name in ("terms", "docs", "tf")
+        ]
+        for bucket in range(n_buckets)
+    ]
+
+    vocab = {}
+    df = np.zeros(0, dtype=np.int64)
+    doc_lens = []
+    n_docs = 0
+    files = [[open(path, "wb") for path in paths] for paths in bucket_files]
+    try:
+        with multiprocessing.Pool(processes=processes) as pool:
+            # imap keeps the chunk order, so the documents are numbered as pmids
+            for terms, indptr, indices, tf, doc_len in tqdm(
+                pool.imap(index_chunk, chunks), total=len(chunks)
+            ):
+                term_ids = np.array(
+                    [vocab.setdefault(t, len(vocab)) for t in terms], dtype=np.int64
+                )[indices]
+                docs = np.repeat(
+                    np.arange(n_docs, n_docs + len(doc_len), dtype=np.int32),
+                    np.diff(indptr),
+                )
+                write_postings(files, term_ids, docs, tf.astype(np.uint16), n_buckets)
+                df = np.concatenate([df, np.zeros(len(vocab) - len(df), np.int64)])
+                df += np.bincount(term_ids, minlength=len(vocab))
+                doc_lens.append(doc_len)
+                n_docs += len(doc_len)
+    finally:
+        for bucket in files:
+            for f in bucket:
+                f.close()
+    doc_len = np.concatenate(doc_lens) if doc_lens else np.zeros(0, np.float32)
+
+    # terms numbered bucket by bucket, so each bucket is a range of the postings
+    terms = list(vocab)
+    n_terms = len(terms)
+    term_order = np.concatenate(
+        [np.arange(bucket, n_terms, n_buckets) for bucket in range(n_buckets)]
+    ).astype(np.int64)
+    indptr = np.zeros(n_terms + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(df[term_order])
+    first_terms = np.cumsum(
+        [0] + [len(range(bucket, n_terms, n_buckets)) for bucket in range(n_buckets)]
+    )
+    indices = np.lib.format.open_memmap(
+        os.path.join(tmp_path, "indices.npy"), "w+", np.int32, (int(indptr[-1]),)
+    )
+    tfs = np.lib.format.open_memmap(
+        os.path.join(tmp_path, "tf.npy"), "w+", np.uint16, (int(indptr[-1]),)
+    )
+    print("merging {} term buckets".format(n_buckets))
+    for bucket in tqdm(range(n_buckets)):
+        terms_file, docs_file, tf_file = bucket_files[bucket]
+        local_ids = np.fromfile(terms_file, dtype=np.int32)
+        order = np.argsort(local_ids, kind="stable")
+        del local_ids
+        start = indptr[first_terms[bucket]]
+        end = indptr[first_terms[bucket + 1]]
+        indices[start:end] = np.fromfile(docs_file, dtype=np.int32)[order]
+        tfs[start:end] = np.fromfile(tf_file, dtype=np.uint16)[order]
+        for path in bucket_files[bucket]:
+            os.remove(path)
+    indices.flush()
+    tfs.flush()
+    del indices, tfs
+    shutil.rmtree(postings_path)
+
+    with open(os.path.join(tmp_path, "terms.txt"), "w") as f:
+        for i in term_order:
+            f.write(terms[i] + "\n")
+    np.save(os.path.join(tmp_path, "pmids.npy"), np.array(pmids, dtype=np.uint64))
+    np.save(os.path.join(tmp_path, "doc_len.npy"), doc_len)
+    np.save(os.path.join(tmp_path, "indptr.npy"), indptr)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "n_docs": len(pmids),
+                "avgdl": float(doc_len.mean()) if len(doc_len) else 0.0,
+            },
+            f,
+        )
+    if os.path.isdir(index_path):
+        shutil.rmtree(index_path)
+    os.rename(tmp_path, index_path)
+    return len(pmids), n_terms
+
+
+class BM25Index:
+    """Memory-mapped BM25 index
+
+    :param path: index directory
+    :type path: string
+    :param k1: BM25 k1 parameter
+    :type k1: float
+    :param b: BM25 b parameter
+    :type b: float
+    """
+
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        with open(os.path.join(path, "terms.txt"), "r") as f:
+            self.terms = {line.rstrip("\n"): i for i, line in enumerate(f)}
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.n_docs = meta["n_docs"]
+        self.avgdl = meta["avgdl"]
+        self.pmids = np.load(os.path.join(path, "pmids.npy"), mmap_mode="r")
+        self.doc_len = np.load(os.path.join(path, "doc_len.npy"), mmap_mode="r")
+        self.indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        self.indices = np.load(os.path.join(path, "indices.npy"), mmap_mode="r")
+        self.tf = np.load(os.path.join(path, "tf.npy"), mmap_mode="r")
+
+    def get_term_ids(self, tokens):
+        """Term ids of query tokens, ignoring unknown terms"""
+        term_ids = []
+        for token in tokens:
+            for term in tokenize(token):
+                if term in self.terms:
+                    term_ids.append(self.terms[term])
+        return term_ids
+
+    def get_postings(self, term_ids):
+        """BM25 weights of the postings of some terms
+
+        :param term_ids: distinct term ids
+        :type term_ids: numpy.ndarray
+        :return: CSR arrays (indptr, documents, weights) with one row per term
+        :rtype: tuple
+        """
+        starts = np.asarray(self.indptr[term_ids])
+        ends = np.asarray(self.indptr[term_ids + 1])
+        df = ends - starts
+        docs = np.concatenate(
+            [self.indices[s:e] for s, e in zip(starts, ends)] + [np.zeros(0, np.int32)]
+        )
+        tf = np.concatenate(
+            [self.tf[s:e] for s, e in zip(starts, ends)] + [np.zeros(0, np.uint16)]
+        ).astype(np.float32)
+        idf = np.log(1 + (self.n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / self.avgdl)
+        weights = np.repeat(idf, df) * tf * (self.k1 + 1) / (tf + norm)
+        indptr = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(df)
+        return indptr, docs, weights
+
+    def search(self, queries, k=100):
+        """Score a batch of queries against all documents
+
+        :param queries: term ids of each query
+        :type queries: list
+        :param k: number of documents to return per query
+        :type k: int
+        :return: PMIDs and scores of the top k documents of each query
+        :rtype: list
+        """
+        batch_terms = np.unique(
+            np.array([t for q in queries for t in q], dtype=np.int64)
+        )
+        if len(batch_terms) == 0:
+            return [([], []) for q in queries]
+        indptr, docs, weights = self.get_postings(batch_terms)
+        # only the documents containing some query term are scored
+        batch_docs, doc_columns = np.unique(docs, return_inverse=True)
+        postings = scipy.sparse.csr_matrix(
+            (weights, doc_columns, indptr), shape=(len(batch_terms), len(batch_docs))
+        )
+        rows = []
+        cols = []
+        values = []
+        for i, q in enumerate(queries):
+            q_terms, counts = np.unique(np.array(q, dtype=np.int64), return_counts=True)
+            rows += [i] * len(q_terms)
+            cols += list(np.searchsorted(batch_terms, q_terms))
+            values += list(counts)
+        query_matrix = scipy.sparse.csr_matrix(
+            (np.array(values, dtype=np.float32), (rows, cols)),
+            shape=(len(queries), len(batch_terms)),
+        )
+        scores = (query_matrix @ postings).tocsr()
+
+        results = []
+        for i in range(len(queries)):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            row_docs = batch_docs[scores.indices[start:end]]
+            row_scores = scores.data[start:end]
+            if len(row_scores) > k:
+                top = np.argpartition(-row_scores, k - 1)[:k]
+                row_docs, row_scores = row_docs[top], row_scores[top]
+            # by score, ties by document order
+            order = np.lexsort((row_docs, -row_scores))
+            pmids = [str(p) for p in self.pmids[row_docs[order]]]
+            results.append((pmids, row_scores[order].tolist()))
+        return results
+
+
+# index of the current process, opened by init_worker
+worker_index = None
+
+
+def init_worker(index_path, k1, b):
+    global worker_index
+    worker_index = BM25Index(index_path, k1, b)
+
+
+def search_batch(args):
+    queries, k = args
+    return worker_index.search(queries, k)
+
+
+def get_pmids_bm25(
+    aueb_dic, n=100, limit_queries=None, processes=None, k1=None, b=None, query_tokens=None
+):
+    """Retrieve documents for each query with the local BM25 index
+
+    :param aueb_dic: AUEB format dict
+    :type aueb_dict: dict
+    :param n: number of documents to retrieve per query
+    :type n: int
+    :param limit_queries: either a list or a number to limit queries
+    :type limit_queries: int or list
+    :param processes: number of search processes, by default bm25_processes of
+        params.json or the number of cores
+    :type processes: int
+    :param k1: BM25 k1, by default bm25_k1 of params.json
+    :type k1: float
+    :param b: BM25 b, by default bm25_b of params.json
+    :type b: float
+    :param query_tokens: tokens of each query selected by query_analysis, if already
+        available
+    :type query_tokens: list
+    :return: PMIDs for each query, with score and rank
+    :rtype: dict
+    """
+    if isinstance(limit_queries, int):
+        aueb_dic["queries"] = aueb_dic["queries"][:limit_queries]
+    elif isinstance(limit_queries, list):
+        aueb_dic["queries"] = [
+            r for r in aueb_dic["queries"] if r["query_id"] in limit_queries
+        ]
+    index_path = params.get("bm25_index", "/pubmed_bm25_idx/")
+    if k1 is None:
+        k1 = params.get("bm25_k1", 1.2)
+    if b is None:
+        b = params.get("bm25_b", 0.75)
+    if processes is None:
+        processes = params.get("bm25_processes", os.cpu_count())
+    index = BM25Index(index_path, k1, b)
+
+    if query_tokens is None:
+        query_tokens = query_analyzer.rank_tokens(
+            [html.unescape(r["query_text"]) for r in aueb_dic["queries"]]
+        )
+    queries = []
+    for tokens in query_tokens:
+        tokens = list(dict.fromkeys([t.lower() for t in tokens]))[:20]
+        queries.append(index.get_term_ids(tokens))
+    batches = [
+        (queries[i : i + QUERY_BATCH_SIZE], n)
+        for i in range(0, len(queries), QUERY_BATCH_SIZE)
+    ]
+    print("searching {} queries".format(len(queries)))
+    results = []
+    if processes > 1 and len(batches) > 1:
+        with multiprocessing.Pool(
+            processes, initializer=init_worker, initargs=(index_path, k1, b)
+        ) as pool:
+            for batch_results in tqdm(
+                pool.imap(search_batch, batches), total=len(batches)
+            ):
+                results += batch_results
+    else:
+        for batch, k in tqdm(batches):
+            results += index.search(batch, k)
+
+    ret_docs = {}
+    for r, (pmids, scores) in zip(aueb_dic["queries"], results):
+        qid = str(r["query_id"])
+        ret_docs[qid] = {}
+        for rank, (pmid, score) in enumerate(zip(pmids, scores), start=1):
+            ret_docs[qid][pmid] = {"rank": rank, "bm25": score, "score": score}
+    print("done, obtained results for {} qs".format(len(ret_docs)))
+    return ret_docs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the bm25 index.")
+    parser.add_argument(
+        "--abstract_path", default="/pubmed_abstracts/", help="directory of text files"
+    )
+    parser.add_argument(
+        "--index",
+        default=params.get("bm25_index", "/pubmed_bm25_idx/"),
+        help="index directory",
+    )
+    parser.add_argument(
+        "--processes", type=int, default=None, help="tokenizer processes (default: cores)"
+    )
+    parser.add_argument(
+        "--buckets",
+        type=int,
+        default=INDEX_BUCKETS,
+        help="term buckets, more buckets use less memory while merging",
+    )
+    args = parser.parse_args()
+    if get_abstract_store() is None and not os.path.isdir(args.abstract_path):
+        print("directory not found", args.abstract_path)
+        sys.exit()
+    n_docs, n_terms = build_index(
+        args.abstract_path, args.index, args.processes, args.buckets
+    )
+    print("indexed {} documents, {} terms".format(n_docs, n_terms))
+
+
+if __name__ == "__main__":
+    main()
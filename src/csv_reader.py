@@ -5,7 +5,9 @@ import argparse
 import os
 import atexit
 from collections import Counter
-from qas import normalize_pmid
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from qas import normalize_pmid, normalize_pmids, get_batch_id, pm_cache, rate_limiter
 from bs4 import BeautifulSoup
 import warnings
 
@@ -19,6 +21,7 @@ import praw
 
 
 from pubmed import get_doc_text
+from post_store import open_store, write_reddit_cache
 from qas import calculate_semantic_similarity
 
 """
@@ -28,6 +31,7 @@ No manual annotations were used for v1 of the corpus because we saw little impro
 when considering the effort necessary.
 A cache of previously retrieved posts is necessary.
 This cache is generated with the stackexchange_questions.py or reddit.py scripts.
+Posts are looked up in an indexed store (post_store.py) built from that cache.
 
 """
 
@@ -36,53 +40,43 @@ with open("params.json", "r") as f:
 
 
 def get_se_question(qid):
-    """Retrieve a specific question using stackexchange cache
+    """Retrieve a specific question using the stackexchange post store
     
     :param qid: Question ID
     :type qid: string
-    :param se_cache: cached SE search results
-    :type se_cache: dict
     :return: question item or None if not found
-    :rtype: dict
+    :rtype: StoredPost
     """
-    for q in cache["items"]:
-        # print(qid, q["question_id"])
-        if str(q["question_id"]) == str(qid):
-            # q_cache[qid] = q
-            return q
+    return store.get_question(qid)
 
 
 def get_answer(aid):
-    for q in cache["items"]:
-        # print(q.keys())
-        if "answers" in q:
-            for a in q.get("answers"):
-                if str(a["answer_id"]) == aid:
-                    # cache[aid] = a
-                    return a
+    return store.get_answer(aid)
 
 
 def get_reddit_post(qid):
-    if qid in cache and "score" in cache[qid]:
-        return cache[qid]
+    q_object = store.get_question(qid)
+    if q_object is not None and q_object.get("score") is not None:
+        return q_object
     else:
         submission = reddit.submission(id=qid)
         q_object = {
             "body": submission.selftext.replace("<img", "<a").replace("<hr>", ""),
             "score": submission.score
         }
-        cache[qid] = q_object
+        store.put_question(qid, q_object)
         return q_object
 
 
 def get_reddit_comment(aid):
-    if aid in cache:
-        return cache[aid]
+    a_object = store.get_answer(aid)
+    if a_object is not None:
+        return a_object
     else:
         submission = reddit.comment(id=aid)
-        q_object = {"body": submission.body.replace("<img", "<a").replace("<hr>", "")}
-        cache[aid] = q_object
-    return q_object
+        a_object = {"body": submission.body.replace("<img", "<a").replace("<hr>", "")}
+        store.put_answer(aid, a_object)
+    return a_object
 
 
 def get_column_indexes(filename):
@@ -182,8 +176,95 @@ def get_question_score(row, filename, idx):
 
 
 
+def get_candidate_links(row, idx):
+    """Get the links of a CSV row that may be mapped to a PMID
+    
+    :param row: Row object from CSV corpus file
+    :type row: list
+    :param idx: Dictionary of the column names of CSV file
+    :type idx: dict
+    :return: lower case links, without surrounding parenthesis
+    :rtype: list
+    """
+    candidate_links = []
+    for l in row[idx["link_index"]].split(","):
+        l = l.lower()
+        if (
+            "/pubmed/" in l
+            or "/pmc/articles/" in l
+            or "doi.org" in l
+            or "researchgate" in l
+            or "sciencedirect" in l
+            or "accid=" in l
+            or "pmid=" in l
+        ):  # use only pubmed and pmc or doi.org
+            clean_link = l.split("(")[-1].split(")")[0]
+            if len(clean_link) < 5:  # DOIs can have parenthesis
+                clean_link = l
+            candidate_links.append(clean_link)
+    return candidate_links
+
+
+def prefetch_links(origin_file, min_a_score, workers, revisit_missing=True):
+    """Resolve every unique candidate link of a CSV corpus concurrently
+
+    PMC and DOI links are converted in batch with *normalize_pmids* and the other
+    links with *normalize_pmid* on a thread pool. Requests are throttled by the
+    per-host rate limits of qas.py. The results are stored in the PMID cache so
+    that *process_csv_file* does not have to wait for the network.
+
+    :param origin_file: input CSV corpus file path
+    :type origin_file: string
+    :param min_a_score: Answer score cutoff value
+    :type min_a_score: int
+    :param workers: number of threads
+    :type workers: int
+    :param revisit_missing: retry links that failed because of network or server errors
+    :type revisit_missing: boolean
+    """
+    idx = get_column_indexes(origin_file)
+    links = {}
+    with open(origin_file, "r") as f:
+        csvreader = csv.reader(f)
+        next(csvreader)
+        for r in csvreader:
+            if len(r) <= idx["link_index"] or int(r[idx["score_index"]]) < min_a_score:
+                continue
+            links.update(dict.fromkeys(get_candidate_links(r, idx)))
+    links = [
+        l for l in links if pm_cache.needs_resolution(l, retry_transient=revisit_missing)
+    ]
+    batch_links = [l for l in links if get_batch_id(l)[0] is not None]
+    other_links = [l for l in links if get_batch_id(l)[0] is None]
+    print(
+        "prefetching {} links ({} in batch)".format(len(links), len(batch_links))
+    )
+    start = time.time()
+    errors = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch_future = executor.submit(normalize_pmids, batch_links, revisit_missing)
+        futures = [
+            executor.submit(normalize_pmid, l, revisit_missing) for l in other_links
+        ]
+        progress = tqdm.tqdm(as_completed(futures), total=len(futures))
+        for future in progress:
+            if future.exception() is not None:
+                errors += 1
+        try:
+            batch_future.result()
+        except Exception as e:
+            print("batch conversion failed", e)
+    elapsed = time.time() - start
+    print(
+        "prefetched {} links in {:.1f}s ({:.1f} links/s), {} errors".format(
+            len(links), elapsed, len(links) / max(elapsed, 1e-6), errors
+        )
+    )
+    print("pmid cache", pm_cache.count_statuses())
+
+
 def process_csv_file(
-    origin_file, dest_name, min_a_score, min_a_count, use_title, use_body, use_answer, slowmode=True
+    origin_file, dest_name, min_a_score, min_a_count, use_title, use_body, use_answer, slowmode=True, workers=0
 ):
     """write CSV corpus with filters applied based on another CSV file with only 
     links mapped to pubmed.
@@ -204,10 +285,15 @@ def process_csv_file(
     :type use_body: boolean
     :param use_answer: Use answer text for query
     :type use_answer: boolean
+    :param workers: resolve links with this many threads before processing the file,
+        0 to resolve them while processing
+    :type workers: int
 
     """
 
     idx = get_column_indexes(origin_file)
+    if workers > 0:
+        prefetch_links(origin_file, min_a_score, workers, revisit_missing=slowmode)
 
     pkl_dest_name = dest_name + ".pkl"
     csv_dest_name = dest_name + ".csv"
@@ -270,8 +356,6 @@ def process_csv_file(
                     "num_ret": 0,
                     "num_rel_ret": 0,
                 }
-            links = r[idx["link_index"]].split(",")
-            # print(qid, links)
             # a_pmids = 0
             if aid not in counters["a_pubmed_counts"]:
                 counters["a_pubmed_counts"][aid] = 0
@@ -279,44 +363,30 @@ def process_csv_file(
                 counters["a_scores"][aid] = int(r[idx["score_index"]])
 
             # normalize links to pubmed
-            for l in links:
-                l = l.lower()
-                if (
-                    "/pubmed/" in l
-                    or "/pmc/articles/" in l
-                    or "doi.org" in l
-                    or "researchgate" in l
-                    or "sciencedirect" in l
-                    or "accid=" in l
-                    or "pmid=" in l
-                ):  # use only pubmed and pmc or doi.org
-                    clean_link = l.split("(")[-1].split(")")[0]
-                    if len(clean_link) < 5:  # DOIs can have parenthesis
-                        clean_link = l
-                    # print(l, clean_link)
-                    doc_id = normalize_pmid(clean_link, revisit_missing=slowmode)
-                    # print(l, doc_id)
-                    if doc_id is None:
-                        continue
-                    # print(doc_id)
-                    # print("doc_id", doc_id, qs[qid]["relevant_documents"])
-                    if doc_id not in qs[qid]["relevant_documents"]:
-                        # a_pmids += 1
-                        counters["a_pubmed_counts"][aid] += 1
-                        counters["q_pubmed_counts"][qid] += 1
-                        qs[qid]["relevant_documents"].add(doc_id)
-                        doc_text = get_doc_text(doc_id)
-                        csv_lines.append(
-                            [
-                                qid,
-                                aid,
-                                qtext.replace("\n", " "),
-                                #r[idx["score_index"]],
-                                qscore,
-                                doc_id,
-                                doc_text[0],
-                            ]
-                        )
+            for clean_link in get_candidate_links(r, idx):
+                doc_id = normalize_pmid(clean_link, revisit_missing=slowmode)
+                # print(l, doc_id)
+                if doc_id is None:
+                    continue
+                # print(doc_id)
+                # print("doc_id", doc_id, qs[qid]["relevant_documents"])
+                if doc_id not in qs[qid]["relevant_documents"]:
+                    # a_pmids += 1
+                    counters["a_pubmed_counts"][aid] += 1
+                    counters["q_pubmed_counts"][qid] += 1
+                    qs[qid]["relevant_documents"].add(doc_id)
+                    doc_text = get_doc_text(doc_id)
+                    csv_lines.append(
+                        [
+                            qid,
+                            aid,
+                            qtext.replace("\n", " "),
+                            #r[idx["score_index"]],
+                            qscore,
+                            doc_id,
+                            doc_text[0],
+                        ]
+                    )
 
             # do not keep counting score and links of this answer if we did not
             # get a normalized pubmed link
@@ -406,7 +476,7 @@ def print_counters(counters):
 
 
 def main():
-    global cache
+    global store
     global cache_file
     global reddit
     parser = argparse.ArgumentParser(description="read csv corpus, write tables.")
@@ -422,26 +492,29 @@ def main():
     parser.add_argument("--body_text", action="store_true", help="use body text")
     parser.add_argument("--title_text", action="store_true", help="use title text")
     parser.add_argument("--answer_text", action="store_true", help="use answer text")
+    parser.add_argument(
+        "--workers", type=int, default=8, help="threads used to resolve links, 0 to disable"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=None, help="max requests per second to each host"
+    )
+    parser.add_argument(
+        "--skip_similarity",
+        action="store_true",
+        help="do not compute the question-document similarity (no word vectors loaded)",
+    )
 
     args = parser.parse_args()
 
     if "reddit" in args.file:
         reddit = praw.Reddit(params["toolname"])
         cache_file = "reddit_cache.pkl"
-        if os.path.isfile(cache_file):
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-        else:
-            cache = {}
+        store = open_store(cache_file, reddit=True)
     else:
-        # use a cache of retrieved posts texts
+        # use an indexed store of retrieved posts texts, built from the cache
         cache_file = args.cache
-        if os.path.isfile(cache_file):
-            # logging.info("loading cache...")
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-        # logging.info("loaded cache dictionary with %s entries", str(len(pm_cache)))
-        else:
+        store = open_store(cache_file)
+        if store is None:
             print("cache file not found")
             sys.exit()
 
@@ -456,6 +529,10 @@ def main():
     if args.answer_text:
         dest_name += "_answer"
 
+    if args.rate is not None:
+        rate_limiter.default_rate = args.rate
+        rate_limiter.rates = {}
+
     print("processing ", args.file)
     csv_lines = process_csv_file(
         args.file,
@@ -465,14 +542,17 @@ def main():
         args.title_text,
         args.body_text,
         args.answer_text,
-        slowmode=False
+        slowmode=False,
+        workers=args.workers,
     )
 
     if "reddit" in args.file:
-        with open(cache_file, "w") as f:
-            json.dump(cache, f)
+        # keep the JSON cache up to date with the posts retrieved by this run
+        write_reddit_cache(store, cache_file)
+    store.close()
     #print(csv_lines)
-    calculate_semantic_similarity(csv_lines)
+    if not args.skip_similarity:
+        calculate_semantic_similarity(csv_lines)
 
 if __name__ == "__main__":
     main()
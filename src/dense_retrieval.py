@@ -0,0 +1,317 @@
+# retrieval by similarity of document vectors
+import os
+import sys
+import json
+import html
+import shutil
+import argparse
+
+import numpy as np
+import scipy.sparse
+from tqdm import tqdm
+
+from bm25 import list_corpus, read_text
+from nlp_server import get_vectors
+
+"""
+Retrieval engine that ranks the abstracts by the cosine similarity between their
+vector and the question vector (average of the word vectors, as in
+qas.calculate_semantic_similarity).
+
+The abstract vectors are computed once and saved, normalized, in a memory-mapped
+matrix (float16 by default, to halve its size). Queries are scored in batches with a
+matrix product over blocks of the matrix, keeping the top k of each query.
+For large corpora, the vectors can be clustered (spherical k-means) into an IVF
+index, and only the documents of the vector_nprobe clusters closest to each query
+are scored.
+
+Index directory:
+vectors.npy: normalized vector of each document
+pmids.npy: PMID of each document (uint64)
+meta.json: model and dtype
+centroids.npy, ivf_offsets.npy, ivf_docs.npy: clusters, if built with --clusters
+
+Build the index with:
+
+    python src/dense_retrieval.py --abstract_path /pubmed_abstracts/ --index /pubmed_vectors_idx/ --clusters 4096
+"""
+
+with open("params.json", "r") as f:
+    params = json.load(f)
+
+# documents per matrix block
+BLOCK_SIZE = 100000
+# queries scored together
+QUERY_BATCH_SIZE = 256
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def kmeans(vectors, n_clusters, iterations=10, sample_size=200000, seed=0):
+    """Spherical k-means over a sample of normalized vectors
+
+    :param vectors: normalized vectors
+    :type vectors: numpy.ndarray
+    :param n_clusters: number of clusters
+    :type n_clusters: int
+    :return: normalized centroids
+    :rtype: numpy.ndarray
+    """
+    rng = np.random.RandomState(seed)
+    n = len(vectors)
+    sample = np.sort(rng.choice(n, min(n, max(sample_size, n_clusters)), replace=False))
+    sample = np.asarray(vectors[sample], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)]
+    for _ in tqdm(range(iterations)):
+        assignment = assign_clusters(sample, centroids)
+        members = scipy.sparse.csr_matrix(
+            (np.ones(len(sample), np.float32), (assignment, np.arange(len(sample)))),
+            shape=(n_clusters, len(sample)),
+        )
+        sums = members @ sample
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # clusters left empty get a random vector of the sample
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), empty.sum())]
+        centroids = normalize(sums)
+    return centroids
+
+
+def assign_clusters(vectors, centroids):
+    """Closest centroid of each vector, computed in blocks"""
+    assignment = np.zeros(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        block = np.asarray(vectors[start : start + BLOCK_SIZE], dtype=np.float32)
+        assignment[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+def build_index(
+    abstract_path, index_path, model, dtype="float16", n_clusters=0, batch_size=1000
+):
+    """Compute and save the vectors of the abstract corpus
+
+    :param abstract_path: directory where pubmed text files are stored as .txt files
+    :type abstract_path: string
+    :param index_path: index directory
+    :type index_path: string
+    :param model: spaCy model with word vectors
+    :type model: string
+    :param dtype: float16 or float32
+    :type dtype: string
+    :param n_clusters: number of IVF clusters, 0 for exact search only
+    :type n_clusters: int
+    :return: number of documents
+    :rtype: int
+    """
+    pmids = list_corpus(abstract_path)
+    print("computing {} document vectors".format(len(pmids)))
+    tmp_path = index_path.rstrip("/") + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    vectors = None
+    for start in tqdm(range(0, len(pmids), batch_size)):
+        batch_pmids = pmids[start : start + batch_size]
+        texts = [read_text(pmid, abstract_path) for pmid in batch_pmids]
+        batch = normalize(get_vectors(model, texts))
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(
+                os.path.join(tmp_path, "vectors.npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=(len(pmids), batch.shape[1]),
+            )
+        vectors[start : start + len(batch)] = batch
+    if vectors is None:
+        print("no documents")
+        sys.exit()
+    vectors.flush()
+    np.save(os.path.join(tmp_path, "pmids.npy"), np.array(pmids, dtype=np.uint64))
+    n_clusters = min(n_clusters, len(pmids))
+    if n_clusters:
+        print("clustering into {} clusters".format(n_clusters))
+        centroids = kmeans(vectors, n_clusters)
+        assignment = assign_clusters(vectors, centroids)
+        ivf_docs = np.argsort(assignment, kind="stable").astype(np.int64)
+        ivf_offsets = np.zeros(n_clusters + 1, dtype=np.int64)
+        ivf_offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_clusters))
+        np.save(os.path.join(tmp_path, "centroids.npy"), centroids.astype(np.float32))
+        np.save(os.path.join(tmp_path, "ivf_offsets.npy"), ivf_offsets)
+        np.save(os.path.join(tmp_path, "ivf_docs.npy"), ivf_docs)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"model": model, "dtype": dtype, "clusters": n_clusters}, f)
+    del vectors
+    if os.path.isdir(index_path):
+        shutil.rmtree(index_path)
+    os.rename(tmp_path, index_path)
+    return len(pmids)
+
+
+def merge_top_k(top_docs, top_scores, docs, scores, k):
+    """Merge new candidates into the current top k of each query (rows)"""
+    docs = np.concatenate([top_docs, docs], axis=1)
+    scores = np.concatenate([top_scores, scores], axis=1)
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        docs = np.take_along_axis(docs, top, axis=1)
+        scores = np.take_along_axis(scores, top, axis=1)
+    return docs, scores
+
+
+class VectorIndex:
+    """Memory-mapped document vectors
+
+    :param path: index directory
+    :type path: string
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.model = self.meta["model"]
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.pmids = np.load(os.path.join(path, "pmids.npy"), mmap_mode="r")
+        self.centroids = None
+        if self.meta.get("clusters"):
+            self.centroids = np.load(os.path.join(path, "centroids.npy"))
+            self.ivf_offsets = np.load(os.path.join(path, "ivf_offsets.npy"))
+            self.ivf_docs = np.load(os.path.join(path, "ivf_docs.npy"), mmap_mode="r")
+
+    def search_exact(self, query_vectors, k):
+        """Top k documents of each query over the whole matrix
+
+        :return: document indexes and scores, one row per query, not sorted
+        :rtype: tuple
+        """
+        n = len(query_vectors)
+        top_docs = np.zeros((n, 0), dtype=np.int64)
+        top_scores = np.zeros((n, 0), dtype=np.float32)
+        for start in range(0, len(self.vectors), BLOCK_SIZE):
+            block = np.asarray(self.vectors[start : start + BLOCK_SIZE], np.float32)
+            scores = query_vectors @ block.T
+            docs = np.broadcast_to(
+                np.arange(start, start + len(block), dtype=np.int64), scores.shape
+            )
+            top_docs, top_scores = merge_top_k(top_docs, top_scores, docs, scores, k)
+        return top_docs, top_scores
+
+    def search_ivf(self, query_vectors, k, nprobe):
+        """Top k documents of each query among the nprobe closest clusters"""
+        nprobe = min(nprobe, len(self.centroids))
+        closest = np.argpartition(
+            -(query_vectors @ self.centroids.T), nprobe - 1, axis=1
+        )[:, :nprobe]
+        results = []
+        for query_vector, clusters in zip(query_vectors, closest):
+            docs = np.concatenate(
+                [
+                    self.ivf_docs[self.ivf_offsets[c] : self.ivf_offsets[c + 1]]
+                    for c in clusters
+                ]
+            )
+            # reading the rows in order is faster on the memory-mapped matrix
+            docs = np.sort(docs)
+            scores = np.asarray(self.vectors[docs], np.float32) @ query_vector
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                docs, scores = docs[top], scores[top]
+            results.append((docs, scores))
+        return results
+
+    def search(self, texts, k=100, nprobe=None):
+        """Search the most similar documents of each text
+
+        :param texts: query texts
+        :type texts: list
+        :param k: number of documents to return per query
+        :type k: int
+        :param nprobe: clusters searched per query, None for exact search
+        :type nprobe: int
+        :return: PMIDs and scores of the top k documents of each query
+        :rtype: list
+        """
+        query_vectors = normalize(get_vectors(self.model, texts)).astype(np.float32)
+        if nprobe and self.centroids is not None:
+            rows = self.search_ivf(query_vectors, k, nprobe)
+        else:
+            rows = zip(*self.search_exact(query_vectors, k))
+        results = []
+        for query_vector, (docs, scores) in zip(query_vectors, rows):
+            if not query_vector.any():  # no known words in the query
+                results.append(([], []))
+                continue
+            order = np.lexsort((docs, -scores))
+            pmids = [str(p) for p in self.pmids[docs[order]]]
+            results.append((pmids, scores[order].tolist()))
+        return results
+
+
+def get_pmids_vectors(aueb_dic, n=100, limit_queries=None):
+    """Retrieve documents for each query by vector similarity
+
+    :param aueb_dic: AUEB format dict
+    :type aueb_dict: dict
+    :param n: number of documents to retrieve per query
+    :type n: int
+    :param limit_queries: either a list or a number to limit queries
+    :type limit_queries: int or list
+    :return: PMIDs for each query, with score and rank
+    :rtype: dict
+    """
+    if isinstance(limit_queries, int):
+        aueb_dic["queries"] = aueb_dic["queries"][:limit_queries]
+    elif isinstance(limit_queries, list):
+        aueb_dic["queries"] = [
+            r for r in aueb_dic["queries"] if r["query_id"] in limit_queries
+        ]
+    index = VectorIndex(params.get("vector_index", "/pubmed_vectors_idx/"))
+    nprobe = params.get("vector_nprobe", 16)
+    queries = aueb_dic["queries"]
+    ret_docs = {}
+    for start in tqdm(range(0, len(queries), QUERY_BATCH_SIZE)):
+        batch = queries[start : start + QUERY_BATCH_SIZE]
+        results = index.search(
+            [html.unescape(r["query_text"]) for r in batch], n, nprobe
+        )
+        for r, (pmids, scores) in zip(batch, results):
+            qid = str(r["query_id"])
+            ret_docs[qid] = {}
+            for rank, (pmid, score) in enumerate(zip(pmids, scores), start=1):
+                ret_docs[qid][pmid] = {"rank": rank, "score": score}
+    print("done, obtained results for {} qs".format(len(ret_docs)))
+    return ret_docs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the document vector index.")
+    parser.add_argument(
+        "--abstract_path", default="/pubmed_abstracts/", help="directory of text files"
+    )
+    parser.add_argument(
+        "--index",
+        default=params.get("vector_index", "/pubmed_vectors_idx/"),
+        help="index directory",
+    )
+    parser.add_argument(
+        "--model",
+        default=params.get("similarity_model", "en_vectors_web_lg"),
+        help="spaCy model with word vectors",
+    )
+    parser.add_argument(
+        "--dtype", default="float16", choices=["float16", "float32"], help="vector type"
+    )
+    parser.add_argument(
+        "--clusters", type=int, default=0, help="IVF clusters (default: exact only)"
+    )
+    args = parser.parse_args()
+    n = build_index(args.abstract_path, args.index, args.model, args.dtype, args.clusters)
+    print("indexed {} documents".format(n))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+# vectorized evaluation of retrieval results
+import sys
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+"""
+Evaluation of the documents retrieved for each query (AUEB format, see
+retrieve_answers.process_search_results).
+
+All the queries are packed into padded arrays (one row per query, one column per
+retrieved document) and every metric is computed for all the queries at once:
+micro precision/recall/F1, average precision (same values as sklearn
+average_precision_score on the document scores), reciprocal rank, and
+precision, recall and nDCG at each cutoff (documents ordered by rank).
+
+retrieve_answers.py also exports its results as TREC run and qrels files, which are
+scored without running the engines again, one worker process per run file:
+
+    python src/evaluation.py evaluate corpus.qrels runs/*.run --output scores.tsv
+
+The synthetic benchmark against the per-query evaluation is run with:
+
+    python src/evaluation.py benchmark --queries 100000 --docs 100
+"""
+
+CUTOFFS = (1, 5, 10, 20, 100)
+
+
+def pack_queries(queries):
+    """Pack the retrieved documents of the queries into padded arrays
+
+    :param queries: AUEB format queries, with retrieved_documents
+    :type queries: list
+    :return: relevance (bool), score and rank of each retrieved document, mask of the
+        valid cells, and number of distinct relevant documents of each query
+    :rtype: dict
+    """
+    lengths = []
+    n_rel = []
+    flat_rel, flat_score, flat_rank = [], [], []
+    for q in queries:
+        relevant = set(q["relevant_documents"])
+        lengths.append(len(q["retrieved_documents"]))
+        n_rel.append(len(relevant))
+        for doc in q["retrieved_documents"]:
+            flat_rel.append(doc["doc_id"] in relevant)
+            flat_score.append(doc["score"])
+            flat_rank.append(doc["rank"])
+    return pack_lists(lengths, n_rel, flat_rel, flat_score, flat_rank)
+
+
+def pack_run(run, qrels, qids):
+    """Pack the documents of a TREC run into padded arrays, as pack_queries
+
+    :param run: run, from read_run
+    :type run: pandas.DataFrame
+    :param qrels: relevant documents, from read_qrels
+    :type qrels: pandas.DataFrame
+    :param qids: ids of the queries to evaluate, one row each
+    :type qids: list
+    :rtype: dict
+    """
+    rows = pd.Categorical(run["qid"], categories=qids).codes
+    run = run[rows >= 0]
+    rows = rows[rows >= 0]
+    # a left merge keeps the order of the run
+    hits = run.merge(qrels.assign(hit=True), on=["qid", "doc_id"], how="left")
+    hits = hits["hit"].notna().values
+    order = np.argsort(rows, kind="stable")
+    rows = rows[order]
+    lengths = np.bincount(rows, minlength=len(qids))
+    columns = np.arange(len(rows)) - (np.cumsum(lengths) - lengths)[rows]
+    width = int(lengths.max()) if len(qids) else 0
+    rel = np.zeros((len(qids), width), dtype=bool)
+    rel[rows, columns] = hits[order]
+    scores = np.full(rel.shape, -np.inf)
+    scores[rows, columns] = run["score"].values[order]
+    ranks = np.full(rel.shape, np.inf)
+    ranks[rows, columns] = run["rank"].values[order]
+    qrel_rows = pd.Categorical(qrels["qid"], categories=qids).codes
+    n_rel = np.bincount(qrel_rows[qrel_rows >= 0], minlength=len(qids))
+    valid = np.arange(width) < lengths[:, None]
+    return {"rel": rel, "scores": scores, "ranks": ranks, "valid": valid, "n_rel": n_rel}
+
+
+def pack_lists(lengths, n_rel, flat_rel, flat_score, flat_rank):
+    """Padded arrays from the documents of all the queries, one after the other"""
+    lengths = np.array(lengths, dtype=np.int64)
+    width = int(lengths.max()) if len(lengths) else 0
+    valid = np.arange(width) < lengths[:, None]
+    # boolean mask assignment fills the cells row by row, in the order of the lists
+    rel = np.zeros(valid.shape, dtype=bool)
+    rel[valid] = flat_rel
+    scores = np.full(valid.shape, -np.inf)
+    scores[valid] = flat_score
+    ranks = np.full(valid.shape, np.inf)
+    ranks[valid] = flat_rank
+    n_rel = np.array(n_rel, dtype=np.int64)
+    return {"rel": rel, "scores": scores, "ranks": ranks, "valid": valid, "n_rel": n_rel}
+
+
+def sort_rows(keys, *arrays):
+    """Sort the cells of each row of *arrays* by *keys*, keeping ties in order"""
+    order = np.argsort(keys, axis=1, kind="stable")
+    return [np.take_along_axis(a, order, axis=1) for a in arrays]
+
+
+def average_precision(rel, scores, valid):
+    """Average precision of each row, as sklearn average_precision_score
+
+    Documents with the same score are a single threshold, and the precision is
+    averaged over the relevant documents retrieved.
+
+    :return: AP of each row, 0 for rows without relevant documents
+    :rtype: numpy.ndarray
+    """
+    rel, scores, valid = sort_rows(-scores, rel, scores, valid)
+    cum_tp = np.cumsum(rel, axis=1)
+    cum_fp = np.cumsum(valid & ~rel, axis=1)
+    # last document of each group of equal scores
+    last = valid.copy()
+    last[:, :-1] &= (scores[:, :-1] != scores[:, 1:]) | ~valid[:, 1:]
+    tp_at_last = np.where(last, cum_tp, 0)
+    prev_tp = np.zeros_like(cum_tp)
+    prev_tp[:, 1:] = np.maximum.accumulate(tp_at_last, axis=1)[:, :-1]
+    total_tp = cum_tp[:, -1:] if cum_tp.shape[1] else np.zeros((len(rel), 1), np.int64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = cum_tp / (cum_tp + cum_fp)
+        recall_gain = (cum_tp - prev_tp) / total_tp
+    ap = np.where(last, recall_gain * precision, 0).sum(axis=1)
+    return np.where(total_tp[:, 0] > 0, ap, 0.0)
+
+
+def evaluate_packed(packed, cutoffs=CUTOFFS):
+    """Metrics of each query from packed arrays (see pack_queries)
+
+    :param cutoffs: cutoffs of precision, recall and nDCG
+    :type cutoffs: list
+    :return: metric name -> array with the value of each query
+    :rtype: dict
+    """
+    rel, valid, n_rel = packed["rel"], packed["valid"], packed["n_rel"]
+    metrics = {
+        "num_ret": valid.sum(axis=1),
+        "num_rel": n_rel,
+        "num_rel_ret": rel.sum(axis=1),
+        "ap": average_precision(rel, packed["scores"], valid),
+    }
+    # the other metrics follow the ranks given by the engine
+    (rel,) = sort_rows(packed["ranks"], rel)
+    width = rel.shape[1]
+    positions = np.arange(1, width + 1)
+    first = np.argmax(rel, axis=1) if width else np.zeros(len(rel), np.int64)
+    metrics["rr"] = np.where(rel.any(axis=1), 1.0 / (first + 1), 0.0)
+    cum_tp = np.cumsum(rel, axis=1)
+    discounted = np.cumsum(rel / np.log2(positions + 1), axis=1)
+    ideal = np.concatenate([[0.0], np.cumsum(1 / np.log2(np.arange(2, max(cutoffs) + 2)))])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for k in cutoffs:
+            tp_k = cum_tp[:, min(k, width) - 1] if width else np.zeros(len(rel))
+            dcg_k = discounted[:, min(k, width) - 1] if width else np.zeros(len(rel))
+            metrics["p@{}".format(k)] = tp_k / k
+            metrics["recall@{}".format(k)] = np.where(n_rel > 0, tp_k / n_rel, 0.0)
+            idcg_k = ideal[np.minimum(n_rel, k)]
+            metrics["ndcg@{}".format(k)] = np.where(n_rel > 0, dcg_k / idcg_k, 0.0)
+    return metrics
+
+
+def evaluate_queries(queries, cutoffs=CUTOFFS):
+    """Metrics of each query
+
+    :param queries: AUEB format queries, with retrieved_documents
+    :type queries: list
+    :return: metric name -> array with the value of each query
+    :rtype: dict
+    """
+    return evaluate_packed(pack_queries(queries), cutoffs)
+
+
+def summarize(metrics):
+    """Micro precision/recall/F1 and mean of the other metrics over the queries
+
+    :param metrics: metrics of each query, from evaluate_queries
+    :type metrics: dict
+    :rtype: dict
+    """
+    tps = int(metrics["num_rel_ret"].sum())
+    fps = int(metrics["num_ret"].sum()) - tps
+    fns = int(metrics["num_rel"].sum()) - tps
+    p = tps / (tps + fps) if tps + fps > 0 else 0
+    r = tps / (tps + fns) if tps + fns > 0 else 0
+    f = (2 * p * r) / (p + r) if p > 0 and r > 0 else 0
+    summary = {"precision": p, "recall": r, "f1": f}
+    for name, values in metrics.items():
+        if not name.startswith("num_"):
+            summary["map" if name == "ap" else "m" + name] = float(np.mean(values))
+    return summary
+
+
+def write_trec_run(path, queries, run_name):
+    """Write the retrieved documents of AUEB format queries as a TREC run file
+
+    :param path: run file
+    :type path: string
+    :param queries: AUEB format queries, with retrieved_documents
+    :type queries: list
+    :param run_name: name of the run, last column of the file
+    :type run_name: string
+    """
+    with open(path, "w") as f:
+        for q in queries:
+            for doc in sorted(q["retrieved_documents"], key=lambda d: d["rank"]):
+                f.write(
+                    "{} Q0 {} {} {} {}\n".format(
+                        q["query_id"], doc["doc_id"], doc["rank"], doc["score"], run_name
+                    )
+                )
+
+
+def write_trec_qrels(path, queries):
+    """Write the relevant documents of AUEB format queries as a TREC qrels file"""
+    with open(path, "w") as f:
+        for q in queries:
+            for doc_id in dict.fromkeys(q["relevant_documents"]):
+                f.write("{} 0 {} 1\n".format(q["query_id"], doc_id))
+
+
+def read_qrels(path):
+    """Read a TREC qrels file
+
+    :return: relevant documents (qid and doc_id columns) and ids of all the queries
+    :rtype: tuple
+    """
+    qrels = pd.read_csv(
+        path,
+        sep=r"\s+",
+        header=None,
+        names=["qid", "iteration", "doc_id", "relevance"],
+        dtype={"qid": str, "doc_id": str},
+    )
+    qids = list(pd.unique(qrels["qid"]))
+    qrels = qrels[qrels["relevance"] > 0][["qid", "doc_id"]].drop_duplicates()
+    return qrels, qids
+
+
+def read_run(path):
+    """Read a TREC run file
+
+    :return: qid, doc_id, rank and score of each line
+    :rtype: pandas.DataFrame
+    """
+    return pd.read_csv(
+        path,
+        sep=r"\s+",
+        header=None,
+        names=["qid", "q0", "doc_id", "rank", "score", "run"],
+        usecols=["qid", "doc_id", "rank", "score"],
+        dtype={"qid": str, "doc_id": str, "rank": np.int64, "score": np.float64},
+    )
+
+
+def init_worker(qrels_path, complete):
+    global worker_qrels, worker_qids, worker_complete
+    worker_qrels, worker_qids = read_qrels(qrels_path)
+    worker_complete = complete
+
+
+def evaluate_run(path):
+    """Metrics of each query of a run file against the qrels of the worker
+
+    The queries evaluated are the queries of the qrels found in the run, or all the
+    queries of the qrels if complete is set (missing queries have no documents).
+
+    :return: path, query ids and metrics of each query
+    :rtype: tuple
+    """
+    run = read_run(path)
+    qids = worker_qids
+    if not worker_complete:
+        run_qids = set(run["qid"])
+        qids = [q for q in qids if q in run_qids]
+    return path, qids, evaluate_packed(pack_run(run, worker_qrels, qids))
+
+
+def evaluate_runs(qrels_path, run_paths, processes=None, complete=False):
+    """Evaluate run files in parallel
+
+    :param qrels_path: TREC qrels file
+    :type qrels_path: string
+    :param run_paths: TREC run files
+    :type run_paths: list
+    :param processes: number of worker processes, by default the number of CPUs
+    :type processes: int
+    :param complete: evaluate every query of the qrels, even if not in the run
+    :type complete: boolean
+    :return: path -> query ids and metrics of each query, in the order of run_paths
+    :rtype: dict
+    """
+    results = {}
+    processes = min(processes or multiprocessing.cpu_count(), len(run_paths))
+    if processes > 1:
+        with multiprocessing.Pool(
+            processes, initializer=init_worker, initargs=(qrels_path, complete)
+        ) as pool:
+            for path, qids, metrics in tqdm(
+                pool.imap(evaluate_run, run_paths), total=len(run_paths)
+            ):
+                results[path] = (qids, metrics)
+    else:
+        init_worker(qrels_path, complete)
+        for path in tqdm(run_paths):
+            path, qids, metrics = evaluate_run(path)
+            results[path] = (qids, metrics)
+    return results
+
+
+def per_query_scores(queries):
+    """Per-query evaluation of retrieve_answers before the vectorized evaluation"""
+    from sklearn.metrics import average_precision_score
+    import warnings
+
+    tps = fps = fns = 0
+    maps = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for q in queries:
+            y_true = []
+            y_scores = []
+            for retdoc in q["retrieved_documents"]:
+                is_relevant = retdoc["doc_id"] in q["relevant_documents"]
+                tps += is_relevant
+                fps += not is_relevant
+                y_true.append(int(is_relevant))
+                y_scores.append(retdoc["score"])
+            for reldoc in set(q["relevant_documents"]):
+                if reldoc not in [x["doc_id"] for x in q["retrieved_documents"]]:
+                    fns += 1
+            try:
+                doc_ap = average_precision_score(y_true, y_scores)
+            except:
+                doc_ap = 0.0
+            maps.append(0.0 if np.isnan(doc_ap) else doc_ap)
+    return tps, fps, fns, np.array(maps)
+
+
+def make_synthetic_queries(n_queries, n_docs, n_relevant=5, seed=0):
+    """Random queries with ties in the scores and some queries without hits"""
+    rng = np.random.RandomState(seed)
+    queries = []
+    for i in range(n_queries):
+        docs = rng.choice(2 * n_docs, n_docs, replace=False)
+        scores = np.round(rng.normal(size=n_docs), 1)
+        order = np.argsort(-scores, kind="stable")
+        relevant = rng.choice(2 * n_docs, rng.randint(1, 2 * n_relevant), replace=False)
+        queries.append(
+            {
+                "query_id": str(i),
+                "relevant_documents": [str(d) for d in relevant],
+                "retrieved_documents": [
+                    {"doc_id": str(docs[j]), "rank": rank, "score": float(scores[j])}
+                    for rank, j in enumerate(order, start=1)
+                ],
+            }
+        )
+    return queries
+
+
+def benchmark(n_queries, n_docs, n_compare):
+    """Time the vectorized evaluation on synthetic queries, and compare it with the
+    per-query evaluation on the first n_compare queries"""
+    print("generating {} queries".format(n_queries))
+    queries = make_synthetic_queries(n_queries, n_docs)
+    start = time.time()
+    packed = pack_queries(queries)
+    pack_time = time.time() - start
+    metrics = evaluate_packed(packed)
+    elapsed = time.time() - start
+    print(
+        "vectorized: {:.2f}s ({:.2f}s packing), {:.0f} queries/s".format(
+            elapsed, pack_time, n_queries / elapsed
+        )
+    )
+    print(summarize(metrics))
+    if not n_compare:
+        return
+    subset = queries[:n_compare]
+    start = time.time()
+    tps, fps, fns, maps = per_query_scores(subset)
+    loop_time = time.time() - start
+    sub_metrics = evaluate_queries(subset)
+    counts_match = (
+        tps == sub_metrics["num_rel_ret"].sum()
+        and fps == sub_metrics["num_ret"].sum() - tps
+        and fns == sub_metrics["num_rel"].sum() - tps
+    )
+    max_diff = float(np.abs(maps - sub_metrics["ap"]).max())
+    print(
+        "per query: {:.0f} queries/s, speedup {:.1f}x".format(
+            len(subset) / loop_time, (n_queries / elapsed) / (len(subset) / loop_time)
+        )
+    )
+    print("same counts: {}, max AP difference: {:.2e}".format(counts_match, max_diff))
+    if not counts_match or max_diff > 1e-9:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="evaluate TREC runs or benchmark.")
+    parser.add_argument("command", choices=["evaluate", "benchmark"])
+    parser.add_argument("files", nargs="*", help="qrels file and run files (evaluate)")
+    parser.add_argument("--output", help="TSV file of the scores of each run")
+    parser.add_argument(
+        "--per_query", help="TSV file of the metrics of each query of each run"
+    )
+    parser.add_argument("--processes", type=int, default=None, help="worker processes")
+    parser.add_argument(
+        "--complete",
+        action="store_true",
+        help="evaluate all the queries of the qrels, even if missing from a run",
+    )
+    parser.add_argument("--queries", type=int, default=100000, help="number of queries")
+    parser.add_argument("--docs", type=int, default=100, help="documents per query")
+    parser.add_argument(
+        "--compare",
+        type=int,
+        default=5000,
+        help="queries also scored per query with sklearn (0 to skip)",
+    )
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        benchmark(args.queries, args.docs, args.compare)
+        return
+    if len(args.files) < 2:
+        print("usage: evaluation.py evaluate <qrels> <run> [<run> ...]")
+        sys.exit(1)
+    start = time.time()
+    results = evaluate_runs(args.files[0], args.files[1:], args.processes, args.complete)
+    print(
+        "evaluated {} runs in {:.2f}s".format(len(results), time.time() - start),
+        file=sys.stderr,
+    )
+    rows = []
+    for path, (qids, metrics) in results.items():
+        summary = summarize(metrics)
+        rows.append([path, str(len(qids))] + ["{:.4f}".format(v) for v in summary.values()])
+    header = ["run", "queries"] + list(summary.keys())
+    lines = ["\t".join(row) for row in [header] + rows]
+    print("\n".join(lines))
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    if args.per_query:
+        with open(args.per_query, "w") as f:
+            names = list(metrics.keys())
+            f.write("\t".join(["run", "query_id"] + names) + "\n")
+            for path, (qids, metrics) in results.items():
+                for i, qid in enumerate(qids):
+                    values = [repr(float(metrics[name][i])) for name in names]
+                    f.write("\t".join([path, qid] + values) + "\n")
+
+
+if __name__ == "__main__":
+    main()
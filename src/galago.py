@@ -1,22 +1,63 @@
 # galago interface
+import os
 import json
+import shlex
 import subprocess
+import threading
 import time
 import unicodedata
 import html
-import spacy
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 
+from query_analysis import query_analyzer
+from result_cache import result_cache
 
-# Load English tokenizer, tagger, parser, NER and word vectors
-nlp = spacy.load("en_core_web_lg")
+with open("params.json", "r") as f:
+    params = json.load(f)
 
+galago_path = params.get("galago_path", "galago/galago-3.14-bin/bin/galago")
+galago_index = params.get("galago_index", "/galago_pubmed_idx")
+galago_threads = params.get("galago_threads", 20)
+# extra batch search options, e.g. {"mu": 2000} or {"scorer": "bm25", "k": 1.2}
+galago_options = params.get("galago_options", {})
+# directory of the query files
+galago_workdir = params.get("galago_workdir", ".")
+# index shards searched by the same queries, each an index path or a dict with index
+# and optionally remote (command prefix, e.g. ["ssh", "node1"]), galago_path, threads
+galago_shards = params.get("galago_shards", [])
+# queries are run in chunks, each chunk is killed after chunk_timeout seconds and its
+# queries without results are run again up to max_retries times
+chunk_size = params.get("galago_chunk_size", 500)
+chunk_timeout = params.get("galago_timeout", 600)
+max_retries = params.get("galago_retries", 2)
+chunk_query_file = "galago_query_chunk.json"
 
-def write_galago_query_file(aueb_dic, n, limit_queries=None):
+
+def write_galago_query_file(aueb_dic, n, limit_queries=None, workdir=None):
     """Generate query file to be processed by galago
 
     :param aueb_dic: AUEB format dict
     :type aueb_dict: dict
-    
+    :param workdir: directory of the query file, by default galago_workdir
+    :type workdir: string
+    :return: galago queries
+    :rtype: dict
+    """
+    query_dic = make_galago_queries(aueb_dic, limit_queries)
+    with open(os.path.join(workdir or galago_workdir, "galago_query.json"), "w") as f:
+        json.dump(query_dic, f)
+    print("done")
+    return query_dic
+
+
+def make_galago_queries(aueb_dic, limit_queries=None):
+    """Galago queries of the AUEB queries, with the tokens selected by query_analysis
+
+    :param aueb_dic: AUEB format dict
+    :type aueb_dict: dict
+    :return: galago queries
+    :rtype: dict
     """
     if isinstance(limit_queries, int):
         aueb_dic["queries"] = aueb_dic["queries"][:limit_queries]
@@ -29,18 +70,12 @@ def write_galago_query_file(aueb_dic, n, limit_queries=None):
         print(aueb_dic, limit_queries)
     print("writing galago queries")
     query_dic = {"queries": []}
-    for r in aueb_dic["queries"]:
-        query_text = r["query_text"].replace(".", " ")
-        query_text = html.unescape(query_text)
-        doc = nlp(query_text)
-        # doc_tokens = [t for t in doc if t.is_alpha and not t.is_stop]
-        doc_tokens = [
-            t for t in doc if not t.is_punct and not t.is_space and not t.is_stop
-        ]
-        # doc_tokens = [t for t in doc]
-        doc_tokens = sorted(doc_tokens, key=lambda x: x.prob, reverse=False)
-        # print([(t.text, t.prob) for t in doc_tokens])
-        doc_tokens = list(dict.fromkeys([t.text for t in doc_tokens]))
+    query_texts = [
+        html.unescape(r["query_text"].replace(".", " ")) for r in aueb_dic["queries"]
+    ]
+    query_tokens = query_analyzer.rank_tokens(query_texts)
+    for r, doc_tokens in zip(aueb_dic["queries"], query_tokens):
+        doc_tokens = list(dict.fromkeys(doc_tokens))
         doc_tokens = doc_tokens[:20]
         # print(query_text, doc_tokens)
         q = {
@@ -49,59 +84,344 @@ def write_galago_query_file(aueb_dic, n, limit_queries=None):
             "text": "#combine({})".format(" ".join(doc_tokens)),
         }
         query_dic["queries"].append(q)
-    with open("galago_query.json", "w") as f:
-        json.dump(query_dic, f)
-    print("done")
+    return query_dic
 
 
-def get_pmids_galago(aueb_dic, n=100, limit_queries=None):
-    # write query file with all the queries
-    write_galago_query_file(aueb_dic, n, limit_queries)
-    ret_docs = {}
-    galago_path = "galago/galago-3.14-bin/bin/galago"
+def get_galago_args(n, bm25=False, options=None, threads=None, index=None, path=None):
+    """galago threaded-batch-search command, without the query file
+
+    :param n: number of documents to retrieve per query
+    :type n: int
+    :param bm25: use the bm25 scorer instead of the default query likelihood
+    :type bm25: boolean
+    :param options: batch search options (e.g. mu, lambda, k, b), added to
+        galago_options of params.json
+    :type options: dict
+    :param threads: galago threads, by default galago_threads
+    :type threads: int
+    :param index: galago index, by default galago_index
+    :type index: string
+    :param path: galago binary, by default galago_path
+    :type path: string
+    :rtype: list
+    """
+    search_options = dict({"caseFold": True}, **galago_options)
+    search_options.update(options or {})
+    if bm25:
+        search_options["scorer"] = "bm25"
     galago_args = [
-        galago_path,
+        path or galago_path,
         "threaded-batch-search",
-        "--threadCount=20",
-        # "--verbose=true",
-        "--caseFold=true",
-        # "--mu=2000",
-        # "--scorer=bm25",
-        # "--lambda=0.2",
-        "--index=/galago_pubmed_idx",
-        "--requested={}".format(n),
-        "galago_query.json",
+        "--threadCount={}".format(threads or galago_threads),
     ]
-    print(" ".join(galago_args))
+    # sorted, so that the same options give the same result cache settings
+    for key, value in sorted(search_options.items()):
+        if isinstance(value, bool):
+            value = str(value).lower()
+        galago_args.append("--{}={}".format(key, value))
+    galago_args += ["--index={}".format(index or galago_index), "--requested={}".format(n)]
+    return galago_args
+
+
+def parse_galago_line(line):
+    """Parse a result line of galago batch search (TREC run format)
+
+    :param line: output line
+    :type line: string
+    :return: query id, PMID, rank and score or None if the line is not a result
+    :rtype: tuple
+    """
+    values = line.split()
+    if not values or values[-1] != "galago":
+        return None
+    try:
+        rank = int(values[3])
+        qid = values[0]
+        pmid = values[2].split("/")[-1].split(".")[0]
+        bm25 = float(values[4])
+    except (ValueError, IndexError):
+        print(values)
+        return None
+    return qid, pmid, rank, bm25
+
+
+def get_shards(shards=None):
+    """Index shards, by default galago_shards of params.json or the single galago_index
+
+    :param shards: index paths or dicts with index, remote, galago_path and threads
+    :type shards: list
+    :return: shards as dicts
+    :rtype: list
+    """
+    shards = shards or galago_shards or [galago_index]
+    return [{"index": s} if isinstance(s, str) else dict(s) for s in shards]
+
+
+def run_galago_chunk(
+    galago_args, queries, ret_docs, timeout, query_file=chunk_query_file, remote=None
+):
+    """Run galago batch search on a chunk of queries, reading results as they are output
+
+    Results are added to ret_docs as soon as galago writes them, so the results
+    obtained before a timeout are kept.
+
+    :param galago_args: galago command without the query file
+    :type galago_args: list
+    :param queries: galago queries of the chunk
+    :type queries: list
+    :param ret_docs: results, by query id
+    :type ret_docs: dict
+    :param timeout: seconds after which the galago process is killed
+    :type timeout: float
+    :param query_file: path of the query file of the chunk
+    :type query_file: string
+    :param remote: command prefix to run galago on another host (e.g. ssh host), the
+        query file is sent on its standard input
+    :type remote: list
+    :return: True if galago finished without errors
+    :rtype: boolean
+    """
+    with open(query_file, "w") as f:
+        json.dump({"queries": queries}, f)
+    stdin = None
+    command = galago_args + [query_file]
+    if remote:
+        command = remote + [
+            'f=$(mktemp) && cat > "$f" && {} "$f"; status=$?; rm -f "$f"; '
+            "exit $status".format(" ".join(shlex.quote(a) for a in galago_args))
+        ]
+        stdin = open(query_file, "r")
     galago_process = subprocess.Popen(
-        galago_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        command,
+        stdin=stdin,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
     )
-    print("running queries...")
-    try:
-        # timeout=600
-        stdout, stderr = galago_process.communicate(timeout=600)
-    except subprocess.TimeoutExpired:
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
         galago_process.kill()
-        stdout, stderr = galago_process.communicate()
-
-    print("done, processing output")
-    lines = stdout.splitlines()
-    for l in lines:
-        values = l.decode().split()
-        if not values or values[-1] != "galago":
-            # print(l.decode())
-            continue
 
-        try:
-            rank = int(values[3])
-            qid = values[0]
-            pmid = values[2].split("/")[-1].split(".")[0]
-            bm25 = float(values[4])
-        except ValueError:
-            print(values)
+    watchdog = threading.Timer(timeout, kill)
+    watchdog.start()
+    try:
+        for line in galago_process.stdout:
+            result = parse_galago_line(line)
+            if result is None:
+                continue
+            qid, pmid, rank, bm25 = result
+            if qid not in ret_docs:
+                ret_docs[qid] = {}
+            ret_docs[qid][pmid] = {"rank": rank, "bm25": bm25, "score": bm25}
+        galago_process.wait()
+    finally:
+        watchdog.cancel()
+        if galago_process.poll() is None:
+            galago_process.kill()
+            galago_process.wait()
+        galago_process.stdout.close()
+        if stdin is not None:
+            stdin.close()
+    if timed_out.is_set():
+        print("galago timed out after {}s".format(timeout))
+        return False
+    if galago_process.returncode != 0:
+        print("galago exited with code {}".format(galago_process.returncode))
+        return False
+    return True
+
+
+def merge_shard_results(shard_results, n):
+    """Top n documents of a query over the results of every shard, by score
+
+    :param shard_results: PMID -> rank and score, of each shard
+    :type shard_results: list
+    :return: PMID -> rank and score
+    :rtype: dict
+    """
+    candidates = sorted(
+        ((d["score"], pmid) for results in shard_results for pmid, d in results.items()),
+        key=lambda x: -x[0],
+    )
+    merged = {}
+    for score, pmid in candidates:
+        if len(merged) == n:
+            break
+        if pmid not in merged:
+            merged[pmid] = {"rank": len(merged) + 1, "bm25": score, "score": score}
+    return merged
+
+
+def run_galago_shards(shards, shard_args, queries, ret_docs, timeout, query_file, n):
+    """Run a chunk of queries on every shard at the same time and merge the results
+
+    The results of a shard that failed are only used for the queries with n results in
+    that shard, the other queries are left out of ret_docs.
+
+    :param shards: shards, from get_shards
+    :type shards: list
+    :param shard_args: galago command of each shard
+    :type shard_args: list
+    :param n: number of documents to retrieve per query
+    :type n: int
+    :return: True if galago finished without errors on every shard
+    :rtype: boolean
+    """
+    shard_docs = [{} for _ in shards]
+
+    def run_shard(i):
+        return run_galago_chunk(
+            shard_args[i],
+            queries,
+            shard_docs[i],
+            timeout,
+            "{}.{}".format(query_file, i),
+            shards[i].get("remote"),
+        )
+
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        finished = list(executor.map(run_shard, range(len(shards))))
+    complete = set(q["number"] for q in queries)
+    for shard, ok, docs in zip(shards, finished, shard_docs):
+        if not ok:
+            print("shard {} failed".format(shard["index"]))
+            complete &= set(qid for qid in docs if len(docs[qid]) >= n)
+    for qid in complete:
+        merged = merge_shard_results([docs.get(qid, {}) for docs in shard_docs], n)
+        if merged:
+            ret_docs[qid] = merged
+    return all(finished)
+
+
+def cache_results(settings, query, n, docs):
+    """Store the results of a galago query in the result cache, ordered by rank"""
+    results = sorted(
+        ([pmid, d["rank"], d["bm25"]] for pmid, d in docs.items()), key=lambda x: x[1]
+    )
+    result_cache.put("galago", settings, query, n, results)
+
+
+def get_pmids_galago(
+    aueb_dic,
+    n=100,
+    limit_queries=None,
+    bm25=False,
+    options=None,
+    threads=None,
+    workdir=None,
+    query_dic=None,
+    shards=None,
+):
+    """Retrieve documents for each query with galago
+
+    Queries in the result cache (result_cache.py) are not run again. The other
+    queries are run in chunks of galago_chunk_size queries (params.json), each chunk
+    with a timeout of galago_timeout seconds. When a chunk times out or fails, its
+    queries without all the requested results are run again, up to galago_retries
+    times.
+    With several index shards (galago_shards), each chunk is run on every shard at
+    the same time, locally or on other hosts, and the top n documents of each query
+    are merged by score. The scores of each shard use the statistics of its own
+    documents, so the shards should be random splits of the collection.
+
+    :param aueb_dic: AUEB format dict
+    :type aueb_dict: dict
+    :param n: number of documents to retrieve per query
+    :type n: int
+    :param bm25: use the bm25 scorer
+    :type bm25: boolean
+    :param options: batch search options, see get_galago_args
+    :type options: dict
+    :param threads: galago threads, by default galago_threads
+    :type threads: int
+    :param workdir: directory of the query files, by default galago_workdir
+    :type workdir: string
+    :param query_dic: galago queries, if already made with make_galago_queries
+    :type query_dic: dict
+    :param shards: index shards, by default galago_shards (see get_shards)
+    :type shards: list
+    :return: results, by query id
+    :rtype: dict
+    """
+    workdir = workdir or galago_workdir
+    if query_dic is None:
+        # write query file with all the queries
+        query_dic = write_galago_query_file(aueb_dic, n, limit_queries, workdir)
+    ret_docs = {}
+    shards = get_shards(shards)
+    shard_args = [
+        get_galago_args(
+            n,
+            bm25,
+            options,
+            shard.get("threads", threads),
+            shard["index"],
+            shard.get("galago_path"),
+        )
+        for shard in shards
+    ]
+    for shard, galago_args in zip(shards, shard_args):
+        print(" ".join(shard.get("remote", []) + galago_args))
+    # the results of a query depend on every argument except the number requested
+    settings = " ".join(
+        a
+        for a in shard_args[0][1:-1]
+        if not a.startswith(("--threadCount", "--index"))
+    )
+    settings += " --index=" + ",".join(shard["index"] for shard in shards)
+    queries = []
+    for q in query_dic["queries"]:
+        cached = result_cache.get("galago", settings, q["text"], n)
+        if cached is None:
+            queries.append(q)
             continue
-        if qid not in ret_docs:
-            ret_docs[qid] = {}
-        ret_docs[qid][pmid] = {"rank": rank, "bm25": bm25, "score": bm25}
+        ret_docs[q["number"]] = {
+            pmid: {"rank": rank, "bm25": bm25, "score": bm25}
+            for pmid, rank, bm25 in cached
+        }
+    n_cached = len(query_dic["queries"]) - len(queries)
+    print("{} queries in the result cache".format(n_cached))
+    chunks = [
+        queries[i : i + chunk_size] for i in range(0, len(queries), chunk_size)
+    ]
+    print("running {} queries in {} chunks...".format(len(queries), len(chunks)))
+    query_file = os.path.join(workdir, chunk_query_file)
+    for chunk in tqdm(chunks):
+        for attempt in range(max_retries + 1):
+            if len(shards) > 1:
+                finished = run_galago_shards(
+                    shards, shard_args, chunk, ret_docs, chunk_timeout, query_file, n
+                )
+            else:
+                finished = run_galago_chunk(
+                    shard_args[0],
+                    chunk,
+                    ret_docs,
+                    chunk_timeout,
+                    query_file,
+                    shards[0].get("remote"),
+                )
+            # after a failure, only queries with all the requested results are complete
+            done = [
+                q for q in chunk if finished or len(ret_docs.get(q["number"], {})) >= n
+            ]
+            for q in done:
+                cache_results(settings, q["text"], n, ret_docs.get(q["number"], {}))
+            if finished:
+                break
+            chunk = [q for q in chunk if q not in done]
+            for q in chunk:
+                ret_docs.pop(q["number"], None)
+            if attempt < max_retries:
+                print("retrying {} queries".format(len(chunk)))
+        else:
+            print("no results for {} queries".format(len(chunk)))
+    for path in [query_file] + [
+        "{}.{}".format(query_file, i) for i in range(len(shards))
+    ]:
+        if os.path.isfile(path):
+            os.remove(path)
     print("done, obtained results for {} qs".format(len(ret_docs)))
     return ret_docs
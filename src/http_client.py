@@ -0,0 +1,215 @@
+# shared HTTP client for the calls to NCBI, StackExchange and Reddit
+import json
+import time
+import atexit
+import threading
+import email.utils
+import urllib.parse
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ratelimit import RateLimiter, SharedRateLimiter
+
+"""
+HTTP layer used by every outbound request of the project (qas.py, pubmed.py,
+pubmed_async.py, stackexchange_questions.py and reddit.py).
+
+All requests share one requests.Session, so connections to each host are kept alive
+and reused by every thread. Requests wait for the rate limit of their host, shared by
+all the processes of the machine so that parallel jobs stay under the quota together,
+and have a timeout. Connection errors are retried by the session with exponential
+backoff. 429/5xx answers are retried by HttpClient.get, after the Retry-After delay of
+the answer or the exponential backoff, and every attempt waits for the rate limit and
+is counted. The number of requests, retries, errors, bytes and the latency percentiles
+of each host are printed at the end of the run.
+
+params.json options:
+rate_limits, default_rate: max requests per second of each host / other hosts
+rate_limit_dir: directory of the rate limit state shared by processes (default
+    /tmp/biqa_ratelimit), null to limit each process separately
+http_timeouts, http_timeout: timeout in seconds of each host / other hosts (default 30)
+http_retries: retries of each request (default 3)
+http_backoff: backoff factor of the retries, in seconds (default 0.5)
+http_pool_size: connections kept per host (default 16)
+http_stats_file: also write the counters to this JSON file
+"""
+
+with open("params.json", "r") as f:
+    params = json.load(f)
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class HttpClient:
+    """Pooled, rate limited HTTP client with retries and counters
+
+    :param rate_limiter: rate limiter of the hosts
+    :type rate_limiter: RateLimiter
+    :param timeouts: host -> timeout in seconds
+    :type timeouts: dict
+    :param default_timeout: timeout of hosts not in *timeouts*
+    :type default_timeout: float
+    :param max_retries: retries of each request, after a connection error or a
+        429/5xx answer
+    :type max_retries: int
+    :param backoff: backoff factor of the retries, in seconds
+    :type backoff: float
+    :param pool_size: connections kept per host
+    :type pool_size: int
+    """
+
+    def __init__(
+        self,
+        rate_limiter,
+        timeouts=None,
+        default_timeout=30,
+        max_retries=3,
+        backoff=0.5,
+        pool_size=16,
+    ):
+        self.rate_limiter = rate_limiter
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # connection errors only, answers are retried by get through the rate limiter
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=0,
+            backoff_factor=backoff,
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def get(self, url, rate_limit=True, retry_status=True, **kwargs):
+        """requests.get through the shared session
+
+        :param url: url
+        :type url: string
+        :param rate_limit: wait for the rate limit of the host before each attempt,
+            False if the caller limits the rate itself
+        :type rate_limit: boolean
+        :param retry_status: retry 429/5xx answers, False if the caller retries them
+        :type retry_status: boolean
+        :return: response, the last one if every attempt was answered with 429/5xx
+        :rtype: requests.Response
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        kwargs.setdefault("timeout", self.timeouts.get(host, self.default_timeout))
+        retries = self.max_retries if retry_status else 0
+        for attempt in range(retries + 1):
+            if rate_limit:
+                self.rate_limiter.wait(url)
+            start = time.monotonic()
+            try:
+                response = self.session.get(url, **kwargs)
+            except requests.exceptions.RequestException:
+                latency = time.monotonic() - start
+                self.count(host, latency, 0, error=True, retry=attempt > 0)
+                raise
+            self.count(
+                host,
+                time.monotonic() - start,
+                len(response.content),
+                error=response.status_code >= 400,
+                retry=attempt > 0,
+            )
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+            time.sleep(self.get_retry_delay(response, attempt))
+
+    def get_retry_delay(self, response, attempt):
+        """Seconds to wait before retrying an answer: its Retry-After header, or the
+        exponential backoff if it is longer"""
+        delay = self.backoff * 2 ** attempt
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(delay, float(retry_after))
+            except ValueError:
+                date = email.utils.parsedate_tz(retry_after)
+                if date is not None:
+                    return max(delay, email.utils.mktime_tz(date) - time.time())
+        return delay
+
+    def count(self, host, latency, size, error=False, retry=False):
+        with self.lock:
+            counter = self.counters.setdefault(
+                host,
+                {"requests": 0, "retries": 0, "errors": 0, "bytes": 0, "latencies": []},
+            )
+            counter["requests"] += 1
+            counter["retries"] += retry
+            counter["errors"] += error
+            counter["bytes"] += size
+            counter["latencies"].append(latency)
+
+    def get_stats(self):
+        """Counters of each host, with the latency percentiles in seconds
+
+        :rtype: dict
+        """
+        stats = {}
+        with self.lock:
+            for host, counter in self.counters.items():
+                p50, p90, p99 = np.percentile(counter["latencies"], [50, 90, 99])
+                stats[host] = {
+                    "requests": counter["requests"],
+                    "retries": counter["retries"],
+                    "errors": counter["errors"],
+                    "bytes": counter["bytes"],
+                    "latency_p50": round(float(p50), 4),
+                    "latency_p90": round(float(p90), 4),
+                    "latency_p99": round(float(p99), 4),
+                }
+        return stats
+
+    def dump_stats(self, stats_file=None):
+        """Print the counters, and write them to stats_file if set"""
+        stats = self.get_stats()
+        if not stats:
+            return
+        print("HTTP requests:")
+        for host, host_stats in sorted(stats.items()):
+            print(
+                "  {}: {requests} requests, {retries} retries, {errors} errors, "
+                "{bytes} bytes, "
+                "latency p50 {latency_p50}s p90 {latency_p90}s p99 {latency_p99}s".format(
+                    host, **host_stats
+                )
+            )
+        if stats_file:
+            with open(stats_file, "w") as f:
+                json.dump(stats, f, indent=2)
+
+
+# max requests per second to each host (NCBI allows 10 req/s with an API key)
+rate_limit_dir = params.get("rate_limit_dir", "/tmp/biqa_ratelimit")
+if rate_limit_dir:
+    rate_limiter = SharedRateLimiter(
+        params.get("rate_limits", {}), params.get("default_rate", 3), rate_limit_dir
+    )
+else:
+    rate_limiter = RateLimiter(params.get("rate_limits", {}), params.get("default_rate", 3))
+http = HttpClient(
+    rate_limiter,
+    timeouts=params.get("http_timeouts", {}),
+    default_timeout=params.get("http_timeout", 30),
+    max_retries=params.get("http_retries", 3),
+    backoff=params.get("http_backoff", 0.5),
+    pool_size=params.get("http_pool_size", 16),
+)
+atexit.register(http.dump_stats, params.get("http_stats_file"))
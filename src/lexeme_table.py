@@ -0,0 +1,408 @@
+# spaCy-free query token selection from an exported lexeme table
+import os
+import re
+import sys
+import csv
+import json
+import html
+import argparse
+import unicodedata
+
+import numpy as np
+
+"""
+The query token selection (nlp_models.select_tokens) only uses the tokenizer and the
+prob, is_stop, is_punct and is_space attributes of each token. These attributes are
+exported once from the spaCy model into a numpy file, with the rules of its tokenizer
+(prefix, suffix and infix patterns and special cases), and the "fast" query analyzer
+(query_analyzer in params.json) uses them with a Python version of the spaCy
+tokenizer, so the model is never loaded.
+
+Export the table of the model:
+
+    python src/lexeme_table.py export --model en_core_web_lg --table lexemes.npz
+
+Compare the tokens selected by both analyzers on the question texts of the corpora
+(requires spaCy):
+
+    python src/lexeme_table.py check april2020/*.csv --table lexemes.npz
+
+The check saves its result next to the table (lexemes.parity.json). The fast analyzer
+is only used with a table whose recorded parity is at least lexeme_min_parity
+(params.json, default 0.99) for both engines; otherwise the queries are processed
+with spaCy. Exporting the table again removes the previous result.
+
+Table file arrays:
+words: UTF-8 text of each lexeme, concatenated
+offsets: start of each word in words, with the end of words at the end
+probs: log probability of each lexeme (float32)
+flags: is_stop, is_punct and is_space bits of each lexeme (uint8)
+stop_words: stop words used for words not in the table, newline separated
+oov_prob: prob of words not in the table
+tokenizer: JSON rules of the tokenizer, see Tokenizer
+"""
+
+IS_STOP = 1
+IS_PUNCT = 2
+IS_SPACE = 4
+
+
+def get_pattern(function):
+    """Pattern and flags of a bound regex method of the spaCy tokenizer"""
+    if function is None:
+        return None
+    return [function.__self__.pattern, function.__self__.flags]
+
+
+class Tokenizer:
+    """Python version of the spaCy tokenizer, with the rules exported from a model
+
+    :param rules: prefix, suffix, infix, token_match and url_match patterns (pattern
+        and flags, or None), and special_cases, string -> token texts
+    :type rules: dict
+    """
+
+    def __init__(self, rules):
+        def compile_rule(name):
+            if rules.get(name) is None:
+                return None
+            pattern, flags = rules[name]
+            return re.compile(pattern, flags)
+
+        self.prefix_re = compile_rule("prefix")
+        self.suffix_re = compile_rule("suffix")
+        self.infix_re = compile_rule("infix")
+        self.token_match_re = compile_rule("token_match")
+        self.url_match_re = compile_rule("url_match")
+        self.special_cases = rules["special_cases"]
+        # tokens of each chunk already seen, as the cache of the spaCy tokenizer
+        self.cache = {}
+
+    def find_prefix(self, string):
+        if self.prefix_re is None:
+            return 0
+        match = self.prefix_re.search(string)
+        return 0 if match is None else match.end() - match.start()
+
+    def find_suffix(self, string):
+        if self.suffix_re is None:
+            return 0
+        match = self.suffix_re.search(string)
+        return 0 if match is None else match.end() - match.start()
+
+    def token_match(self, string):
+        return self.token_match_re is not None and self.token_match_re.match(string)
+
+    def url_match(self, string):
+        return self.url_match_re is not None and self.url_match_re.match(string)
+
+    def split_affixes(self, string, prefixes, suffixes):
+        """Remove the prefixes and suffixes of a chunk, as Tokenizer._split_affixes
+
+        :return: the rest of the chunk
+        :rtype: string
+        """
+        last_size = 0
+        while string and len(string) != last_size:
+            if self.token_match(string) or string in self.special_cases:
+                break
+            last_size = len(string)
+            pre_len = self.find_prefix(string)
+            if pre_len:
+                prefix = string[:pre_len]
+                minus_pre = string[pre_len:]
+                if minus_pre in self.special_cases:
+                    prefixes.append(prefix)
+                    return minus_pre
+            suf_len = self.find_suffix(string[pre_len:])
+            if suf_len:
+                suffix = string[-suf_len:]
+                minus_suf = string[:-suf_len]
+                if minus_suf in self.special_cases:
+                    suffixes.append(suffix)
+                    return minus_suf
+            if pre_len and suf_len and pre_len + suf_len <= len(string):
+                string = string[pre_len:-suf_len]
+                prefixes.append(prefix)
+                suffixes.append(suffix)
+            elif pre_len:
+                string = minus_pre
+                prefixes.append(prefix)
+            elif suf_len:
+                string = minus_suf
+                suffixes.append(suffix)
+        return string
+
+    def split_infixes(self, string):
+        """Tokens of a chunk without affixes, as Tokenizer._attach_tokens"""
+        if string in self.special_cases:
+            return list(self.special_cases[string])
+        if self.token_match(string) or self.url_match(string):
+            return [string]
+        matches = [] if self.infix_re is None else list(self.infix_re.finditer(string))
+        tokens = []
+        start = 0
+        for match in matches:
+            if match.start() == 0:
+                continue
+            if match.start() != start:
+                tokens.append(string[start : match.start()])
+            if match.start() != match.end():
+                tokens.append(match.group())
+            start = match.end()
+        if string[start:]:
+            tokens.append(string[start:])
+        return tokens
+
+    def tokenize(self, text):
+        """Split a text into tokens
+
+        :param text: text to tokenize
+        :type text: string
+        :return: token texts, without whitespace
+        :rtype: list
+        """
+        tokens = []
+        for chunk in text.split():
+            chunk_tokens = self.cache.get(chunk)
+            if chunk_tokens is None:
+                prefixes = []
+                suffixes = []
+                rest = self.split_affixes(chunk, prefixes, suffixes)
+                chunk_tokens = prefixes
+                if rest:
+                    chunk_tokens += self.split_infixes(rest)
+                chunk_tokens += reversed(suffixes)
+                self.cache[chunk] = chunk_tokens
+            tokens += chunk_tokens
+        return tokens
+
+
+def is_punct(text):
+    """Same definition as spaCy's is_punct"""
+    return all(unicodedata.category(c).startswith("P") for c in text)
+
+
+class LexemeTable:
+    """Lexeme attributes exported from a spaCy model
+
+    :param path: table file written by export_table
+    :type path: string
+    """
+
+    def __init__(self, path):
+        table = np.load(path)
+        words = table["words"].tobytes().decode("utf-8")
+        offsets = table["offsets"]
+        self.probs = table["probs"]
+        self.flags = table["flags"]
+        self.oov_prob = float(table["oov_prob"])
+        self.stop_words = set(table["stop_words"].tobytes().decode("utf-8").split("\n"))
+        if "tokenizer" not in table:
+            raise ValueError(
+                "{} has no tokenizer rules, export the table again".format(path)
+            )
+        rules = json.loads(table["tokenizer"].tobytes().decode("utf-8"))
+        self.tokenizer = Tokenizer(rules)
+        # offsets are in characters, see export_table
+        self.index = {
+            words[offsets[i] : offsets[i + 1]]: i for i in range(len(self.probs))
+        }
+
+    def get_attributes(self, word):
+        """prob, is_stop, is_punct and is_space of a word"""
+        i = self.index.get(word)
+        if i is None:
+            return (
+                self.oov_prob,
+                word.lower() in self.stop_words,
+                is_punct(word),
+                word.isspace(),
+            )
+        flags = self.flags[i]
+        return (
+            float(self.probs[i]),
+            bool(flags & IS_STOP),
+            bool(flags & IS_PUNCT),
+            bool(flags & IS_SPACE),
+        )
+
+    def rank_tokens(self, texts):
+        """Same selection as nlp_models.select_tokens, without the spaCy model
+
+        :param texts: texts to process
+        :type texts: list
+        :return: token texts of each text, from the least to the most frequent
+        :rtype: list
+        """
+        results = []
+        for text in texts:
+            doc_tokens = []
+            for token in self.tokenizer.tokenize(text):
+                prob, stop, punct, space = self.get_attributes(token)
+                if not punct and not space and not stop:
+                    doc_tokens.append((prob, token))
+            doc_tokens = sorted(doc_tokens, key=lambda x: x[0], reverse=False)
+            results.append([t for _, t in doc_tokens])
+        return results
+
+
+# tables already loaded, by path
+tables = {}
+
+
+def get_table(path):
+    if path not in tables:
+        print("loading lexeme table", path)
+        tables[path] = LexemeTable(path)
+    return tables[path]
+
+
+def get_parity_file(table_path):
+    return os.path.splitext(table_path)[0] + ".parity.json"
+
+
+def read_parity(table_path):
+    """Parity recorded by the check command for a table
+
+    :return: fraction of the questions with the same query tokens, by engine, or
+        None if the table was not checked
+    :rtype: dict
+    """
+    parity_file = get_parity_file(table_path)
+    if not os.path.isfile(parity_file):
+        return None
+    with open(parity_file, "r") as f:
+        return json.load(f)
+
+
+def export_table(nlp, path):
+    """Write the lexeme attributes of a spaCy model
+
+    :param nlp: spaCy model
+    :type nlp: spacy.language.Language
+    :param path: table file (.npz)
+    :type path: string
+    :return: number of lexemes
+    :rtype: int
+    """
+    # prob given to the lexemes created for words that are not in the vocabulary
+    oov_prob = nlp.vocab["biqa-out-of-vocabulary-word"].prob
+    words = []
+    probs = []
+    flags = []
+    for lex in nlp.vocab:
+        if lex.orth_ == "biqa-out-of-vocabulary-word":
+            continue
+        words.append(lex.orth_)
+        probs.append(lex.prob)
+        flags.append(
+            IS_STOP * lex.is_stop + IS_PUNCT * lex.is_punct + IS_SPACE * lex.is_space
+        )
+    # offsets in characters, so the whole text is decoded at once when loading
+    offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(w) for w in words])
+    stop_words = "\n".join(sorted(nlp.Defaults.stop_words))
+    from spacy.attrs import ORTH
+
+    special_cases = (
+        getattr(nlp.tokenizer, "rules", None) or nlp.Defaults.tokenizer_exceptions
+    )
+    rules = {
+        "prefix": get_pattern(nlp.tokenizer.prefix_search),
+        "suffix": get_pattern(nlp.tokenizer.suffix_search),
+        "infix": get_pattern(nlp.tokenizer.infix_finditer),
+        "token_match": get_pattern(nlp.tokenizer.token_match),
+        "url_match": get_pattern(getattr(nlp.tokenizer, "url_match", None)),
+        "special_cases": {
+            string: [t.get(ORTH, t.get("ORTH")) for t in tokens]
+            for string, tokens in special_cases.items()
+        },
+    }
+    np.savez_compressed(
+        path,
+        words=np.frombuffer("".join(words).encode("utf-8"), dtype=np.uint8),
+        offsets=offsets,
+        probs=np.array(probs, dtype=np.float32),
+        flags=np.array(flags, dtype=np.uint8),
+        stop_words=np.frombuffer(stop_words.encode("utf-8"), dtype=np.uint8),
+        oov_prob=np.float32(oov_prob),
+        tokenizer=np.frombuffer(json.dumps(rules).encode("utf-8"), dtype=np.uint8),
+    )
+    # the parity of the previous table does not apply to this one
+    if os.path.isfile(get_parity_file(path)):
+        os.remove(get_parity_file(path))
+    return len(words)
+
+
+def check_parity(csv_files, table_path, model, n_tokens=20):
+    """Compare the query tokens of the fast and spaCy analyzers
+
+    Both the galago (dots removed, case kept) and pubmed (lowercased) query tokens
+    are compared, with their duplicates removed and limited to n_tokens.
+
+    :return: fraction of the questions with the same query tokens, by engine
+    :rtype: dict
+    """
+    from nlp_models import get_model, select_tokens
+
+    texts = set()
+    for csv_file in csv_files:
+        with open(csv_file, "r") as f:
+            for row in csv.DictReader(f):
+                texts.add(html.unescape(row["question_text"]))
+    texts = sorted(texts)
+    galago_texts = [t.replace(".", " ") for t in texts]
+    table = get_table(table_path)
+    nlp = get_model(model)
+
+    parity = {}
+    for engine, engine_texts, lower in (
+        ("galago", galago_texts, False),
+        ("pubmed", texts, True),
+    ):
+        spacy_tokens = select_tokens(nlp, engine_texts)
+        fast_tokens = table.rank_tokens(engine_texts)
+        same = 0
+        shown = 0
+        for text, spacy_t, fast_t in zip(engine_texts, spacy_tokens, fast_tokens):
+            if lower:
+                spacy_t = [t.lower() for t in spacy_t]
+                fast_t = [t.lower() for t in fast_t]
+            spacy_t = list(dict.fromkeys(spacy_t))[:n_tokens]
+            fast_t = list(dict.fromkeys(fast_t))[:n_tokens]
+            if spacy_t == fast_t:
+                same += 1
+            elif shown < 10:
+                print(engine, repr(text), spacy_t, fast_t, sep="\n  ")
+                shown += 1
+        parity[engine] = same / len(engine_texts)
+    return parity
+
+
+def main():
+    parser = argparse.ArgumentParser(description="export and check lexeme tables.")
+    parser.add_argument("command", choices=["export", "check"])
+    parser.add_argument("files", nargs="*", help="CSV corpus files (check)")
+    parser.add_argument("--model", default="en_core_web_lg", help="spaCy model")
+    parser.add_argument("--table", default="lexemes.npz", help="table file")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        from nlp_models import get_model
+
+        n = export_table(get_model(args.model), args.table)
+        print("exported {} lexemes to {}".format(n, args.table))
+    else:
+        if not args.files:
+            print("no corpus files")
+            sys.exit()
+        parity = check_parity(args.files, args.table, args.model)
+        for engine, value in parity.items():
+            print("{}: same tokens for {:.2%} of the questions".format(engine, value))
+        with open(get_parity_file(args.table), "w") as f:
+            json.dump(parity, f)
+
+
+if __name__ == "__main__":
+    main()
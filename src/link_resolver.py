@@ -0,0 +1,176 @@
+# offline PubMed link resolver
+import re
+import csv
+import time
+import argparse
+
+"""
+Resolve the links that do not need the network to be mapped to a PMID.
+
+The link families are tested in the same order as the branches of qas.normalize_pmid,
+and each URL is classified once: *resolve_link* also returns the family, which tells
+qas how to resolve the links that need the network.
+Links with a PMID in the URL (linkname=, cmd=retrieve, /m/pubmed, pmid=, /pubmed/<id>)
+are resolved, links to homepages and to imgur/youtube/wiki/etc are unmappable and the
+rest (PMC, DOI, search, ScienceDirect, ResearchGate) are marked for network resolution.
+
+Benchmark over the links of the april2020 CSVs:
+
+    python src/link_resolver.py april2020/*.csv
+"""
+
+RESOLVED = "resolved"
+UNMAPPABLE = "unmappable"
+NETWORK = "network"
+
+pmc_id = re.compile(r"pmc([0-9]+)", re.IGNORECASE)
+retrieve_id = re.compile(r"([0-9]{8})")
+pmid_param = re.compile(r".*pmid=(.*)$", re.IGNORECASE)
+pubmed_site_id = re.compile(r"pubmed\.ncbi\.nlm\.nih\.gov/(\d+)", re.IGNORECASE)
+non_digits = re.compile(r"\D")
+
+
+def resolve_link(url):
+    """Resolve a URL without using the network
+
+    The families of links are tested in the order of the branches of
+    qas.normalize_pmid, and the URL is only scanned by the tests up to its family.
+
+    :param url: url
+    :type url: string
+    :return: (status, PMID, family), the PMID is None unless the status is RESOLVED.
+        The family tells how a NETWORK link is resolved (see qas.get_pmid_online)
+    :rtype: tuple
+
+    :Example:
+        >>> resolve_link("http://www.ncbi.nlm.nih.gov/pubmed?linkname=pubmed_pubmed_citedin&from_uid=2217192")
+        ('resolved', '2217192', 'linkname')
+        >>> resolve_link("https://www.ncbi.nlm.nih.gov/pmc/articles/PMC2989813/")
+        ('network', None, 'pmc')
+        >>> resolve_link("https://en.wikipedia.org/wiki/Nostril")
+        ('unmappable', None, 'blacklist')
+    """
+    if url.rstrip("/").rsplit("/", 1)[-1] in ("pmc", "pubmed"):
+        # links to PMC or PubMed homepage
+        return UNMAPPABLE, None, "homepage"
+    lower_url = url.lower()
+    is_search = "?term=" in lower_url or "cmd=search" in lower_url
+    if "pmc" in lower_url:
+        if is_search:
+            return NETWORK, None, "search"
+        if "pmid" not in lower_url:
+            if pmc_id.search(url) is None:
+                return UNMAPPABLE, None, "pmc"
+            return NETWORK, None, "pmc"
+    elif is_search and "pubmed" in lower_url:
+        return NETWORK, None, "search"
+    if "doi.org" in lower_url:
+        return NETWORK, None, "doi"
+    elif "linkname=" in lower_url:
+        family = "linkname"
+        pmid = url.rsplit("=", 1)[-1]
+    elif "cmd=retrieve" in lower_url:
+        family = "retrieve"
+        match = retrieve_id.search(url)
+        if match is None:
+            return UNMAPPABLE, None, family
+        pmid = match.group(1)
+    elif "/m/pubmed" in lower_url:
+        family = "mobile"
+        parts = url.split("/", 6)
+        if len(parts) < 6:
+            return UNMAPPABLE, None, family
+        pmid = parts[5]
+    elif "artid=" in lower_url:
+        return NETWORK, None, "artid"
+    elif "accid=" in lower_url:
+        return NETWORK, None, "accid"
+    elif "pmid=" in lower_url:
+        family = "pmid"
+        match = pmid_param.search(url)
+        if match is None:
+            return UNMAPPABLE, None, family
+        pmid = match.group(1)
+    elif "sciencedirect" in lower_url:
+        return NETWORK, None, "sciencedirect"
+    elif "researchgate" in lower_url:
+        return NETWORK, None, "researchgate"
+    elif (
+        "imgur" in lower_url
+        or "youtube" in lower_url
+        or "book" in lower_url
+        or "projects" in lower_url
+        or "wiki" in lower_url
+        or ".jpg" in lower_url
+        or "flickr" in lower_url
+    ):
+        return UNMAPPABLE, None, "blacklist"
+    elif "pubmed.ncbi.nlm.nih.gov/" in lower_url:
+        family = "pubmed_site"
+        match = pubmed_site_id.search(url)
+        if match is None:
+            return UNMAPPABLE, None, family
+        pmid = match.group(1)
+    else:
+        family = "path"
+        parts = url.split("/", 5)
+        if len(parts) < 5:
+            return UNMAPPABLE, None, family
+        pmid = parts[4]
+    if not pmid.isdecimal():
+        pmid = non_digits.sub("", pmid)
+        if not pmid:
+            return UNMAPPABLE, None, family
+    return RESOLVED, pmid, family
+
+
+def get_benchmark_links(csv_files):
+    """Generate links of every family from the PMIDs of corpus CSV files
+
+    The april2020 corpus files have the PMID of each answer document instead of the
+    original links, so the links are rebuilt in the formats found on the forums.
+    """
+    templates = [
+        "https://www.ncbi.nlm.nih.gov/pubmed/{}",
+        "http://www.ncbi.nlm.nih.gov/pubmed/{}/",
+        "http://www.ncbi.nlm.nih.gov/pubmed?linkname=pubmed_pubmed_citedin&from_uid={}",
+        "http://www.ncbi.nlm.nih.gov/entrez/query.fcgi?cmd=Retrieve&db=PubMed&list_uids={}",
+        "https://www.ncbi.nlm.nih.gov/m/pubmed/{}/",
+        "https://europepmc.org/abstract/MED/{}?pmid={}",
+        "https://www.ncbi.nlm.nih.gov/pmc/articles/PMC{}/",
+        "https://doi.org/10.1000/{}",
+        "https://www.ncbi.nlm.nih.gov/pubmed/?term={}",
+        "https://www.sciencedirect.com/science/article/pii/S{}",
+        "https://en.wikipedia.org/wiki/{}",
+        "https://i.imgur.com/{}.jpg",
+        "https://www.ncbi.nlm.nih.gov/pmc/",
+    ]
+    links = []
+    for csv_file in csv_files:
+        with open(csv_file, "r") as f:
+            for row in csv.DictReader(f):
+                for template in templates:
+                    links.append(template.format(row["pmid"], row["pmid"]))
+    return links
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark offline link resolution.")
+    parser.add_argument("files", nargs="+", help="CSV corpus files")
+    args = parser.parse_args()
+
+    links = get_benchmark_links(args.files)
+    print("links", len(links))
+
+    start = time.time()
+    results = [resolve_link(l) for l in links]
+    print("resolve_link: {:.3f}s".format(time.time() - start))
+    statuses = {}
+    for status, pmid, family in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    for status, count in sorted(statuses.items()):
+        print(status, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# stub of the NCBI ID conversion services
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import urllib.parse
+import http.server
+
+import qas
+import http_client
+from pmid_cache import PmidCache
+from pubmed_async import StubServer
+
+"""
+Local stub of idconv, esearch and esummary, used to check the batch conversion of PMC
+and DOI links of qas.normalize_pmids.
+
+The IDs are numbers (PMC<n>, 10.1000/<n>) and the answer of each ID depends on n:
+- n % 13 == 0: idconv rejects the whole request (batch-level "status": "error")
+- n % 7 == 0: idconv answers the ID with an error record
+- PMC IDs: converted to PMID 1000000 + n, rejected PMC IDs cannot be mapped
+- DOIs: even n converted by idconv (PMID 2000000 + n); DOIs not converted by idconv,
+  including the rejected ones, are found by esearch [aid] if n % 3 == 0 and n % 7
+Any request can also fail with 503 (--error_rate).
+
+The links are converted against the stub with an empty cache, and the status of each
+link in the cache is checked against the answers of the stub:
+
+    python src/ncbi_stub.py --ids 1000 --error_rate 0.05
+"""
+
+
+def is_rejected(n):
+    return n % 13 == 0
+
+
+def get_expected(idtype, n):
+    """PMID of an ID, None if it cannot be mapped"""
+    if idtype == "pmcid":
+        if is_rejected(n) or n % 7 == 0:
+            return None
+        return str(1000000 + n)
+    converted = not is_rejected(n) and n % 7 and n % 2 == 0
+    found = n % 3 == 0 and n % 7
+    if converted or found:
+        return str(2000000 + n)
+    return None
+
+
+def get_number(id_):
+    return int(id_.rsplit("/", 1)[-1].upper().replace("PMC", "").split("[")[0])
+
+
+class StubNcbiHandler(http.server.BaseHTTPRequestHandler):
+    """idconv, esearch and esummary stub"""
+
+    error_rate = 0.0
+    latency = 0.01
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.send_response(503)
+            self.end_headers()
+            return
+        url = urllib.parse.urlsplit(self.path)
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        if url.path.endswith("esearch.fcgi"):
+            result = self.esearch(query["term"].split(" OR "))
+        elif url.path.endswith("esummary.fcgi"):
+            result = self.esummary(query["id"].split(","))
+        else:
+            result = self.idconv(query["ids"].split(","), query["idtype"])
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def idconv(self, ids, idtype):
+        if any(is_rejected(get_number(i)) for i in ids):
+            return {"status": "error", "message": "invalid article id"}
+        records = []
+        for i in ids:
+            n = get_number(i)
+            if n % 7 == 0 or (idtype == "doi" and n % 2):
+                records.append(
+                    {"requested-id": i, "status": "error", "errmsg": "not found"}
+                )
+            else:
+                pmid = (2000000 if idtype == "doi" else 1000000) + n
+                records.append({"requested-id": i, "pmid": pmid})
+        return {"status": "ok", "records": records}
+
+    def esearch(self, terms):
+        numbers = [get_number(t) for t in terms]
+        idlist = [str(2000000 + n) for n in numbers if n % 3 == 0 and n % 7]
+        return {"esearchresult": {"idlist": idlist}}
+
+    def esummary(self, uids):
+        result = {"uids": uids}
+        for uid in uids:
+            doi = "10.1000/{}".format(int(uid) - 2000000)
+            result[uid] = {"articleids": [{"idtype": "doi", "value": doi}]}
+        return {"result": result}
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="batch ID conversion against a stub.")
+    parser.add_argument("--ids", type=int, default=1000, help="IDs of each type")
+    parser.add_argument("--rate", type=float, default=100, help="requests per second")
+    parser.add_argument(
+        "--error_rate", type=float, default=0.0, help="fraction of 503 answers"
+    )
+    args = parser.parse_args()
+
+    StubNcbiHandler.error_rate = args.error_rate
+    server = StubServer(("127.0.0.1", 0), StubNcbiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    qas.idconv_url = stub_url + "idconv/"
+    qas.eutils_url = stub_url
+    http_client.rate_limiter.rates[urllib.parse.urlsplit(stub_url).netloc] = args.rate
+    cache_dir = tempfile.mkdtemp()
+    qas.pm_cache = PmidCache(os.path.join(cache_dir, "stub_cache.db"))
+
+    links = {}
+    for n in range(1, args.ids + 1):
+        pmc_url = "https://www.ncbi.nlm.nih.gov/pmc/articles/PMC{}/".format(n)
+        links[pmc_url] = ("pmcid", n)
+        links["https://doi.org/10.1000/{}".format(n)] = ("doi", n)
+    start = time.time()
+    pmids = qas.normalize_pmids(list(links))
+    elapsed = time.time() - start
+    server.shutdown()
+
+    counts = {}
+    wrong = 0
+    for url, (idtype, n) in links.items():
+        expected = get_expected(idtype, n)
+        entry = qas.pm_cache.lookup(url)
+        # requests answered with 503 after the retries leave their IDs transient
+        if pmids[url] is None and entry.status == "transient":
+            ok = args.error_rate > 0
+        elif expected is None:
+            ok = pmids[url] is None and entry.status == "unmappable"
+        else:
+            ok = pmids[url] == expected
+        wrong += not ok
+        counts[entry.status] = counts.get(entry.status, 0) + 1
+    print(
+        "{} links in {:.2f}s: {}, {} not as expected".format(
+            len(links),
+            elapsed,
+            ", ".join("{} {}".format(k, v) for k, v in sorted(counts.items())),
+            wrong,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
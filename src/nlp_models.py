@@ -0,0 +1,85 @@
+# shared spaCy models
+import threading
+
+import numpy as np
+
+"""
+Registry of the spaCy models used by the other modules.
+
+Each model is loaded the first time it is requested and then shared by every module
+of the process, so scripts that do not use a model never pay for loading it, and a
+model used by several modules is loaded only once.
+"""
+
+# pipes not needed when only lexical attributes or vectors are used
+DISABLED_PIPES = ["tagger", "parser", "ner"]
+
+models = {}
+lock = threading.Lock()
+
+
+def get_model(name):
+    """Get a spaCy model, loading it on first use
+
+    :param name: model name, e.g. en_core_web_lg
+    :type name: string
+    :return: spaCy model
+    :rtype: spacy.language.Language
+    """
+    nlp = models.get(name)
+    if nlp is None:
+        with lock:
+            nlp = models.get(name)
+            if nlp is None:
+                import spacy
+
+                print("loading", name)
+                nlp = spacy.load(name)
+                models[name] = nlp
+    return nlp
+
+
+def select_tokens(nlp, texts, batch_size=256, n_process=1):
+    """Tokens of each text without punctuation, spaces and stop words, rarest first
+
+    :param nlp: spaCy model
+    :type nlp: spacy.language.Language
+    :param texts: texts to process
+    :type texts: list
+    :param batch_size: texts per nlp.pipe batch
+    :type batch_size: int
+    :param n_process: nlp.pipe processes, more than 1 requires spaCy>=2.2.2
+    :type n_process: int
+    :return: token texts of each text, from the least to the most frequent
+    :rtype: list
+    """
+    kwargs = {"batch_size": batch_size, "disable": DISABLED_PIPES}
+    if n_process > 1:
+        kwargs["n_process"] = n_process
+    results = []
+    for doc in nlp.pipe(texts, **kwargs):
+        doc_tokens = [
+            t for t in doc if not t.is_punct and not t.is_space and not t.is_stop
+        ]
+        doc_tokens = sorted(doc_tokens, key=lambda x: x.prob, reverse=False)
+        results.append([t.text for t in doc_tokens])
+    return results
+
+
+def doc_vectors(nlp, texts, batch_size=256):
+    """Document vectors (average of the word vectors) of each text
+
+    :param nlp: spaCy model with word vectors
+    :type nlp: spacy.language.Language
+    :param texts: texts to process
+    :type texts: list
+    :param batch_size: texts per nlp.pipe batch
+    :type batch_size: int
+    :return: one vector per text
+    :rtype: numpy.ndarray
+    """
+    vectors = np.zeros((len(texts), nlp.vocab.vectors_length), dtype=np.float32)
+    docs = nlp.pipe(texts, batch_size=batch_size, disable=DISABLED_PIPES)
+    for i, doc in enumerate(docs):
+        vectors[i] = doc.vector
+    return vectors
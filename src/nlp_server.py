@@ -0,0 +1,253 @@
+# local NLP server keeping the spaCy models loaded between runs
+import os
+import sys
+import json
+import base64
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+import numpy as np
+
+from nlp_models import get_model, select_tokens, doc_vectors
+
+"""
+Optional server that keeps spaCy models loaded and processes batches of texts for
+other scripts through a Unix socket.
+
+Start it once, e.g. before a parameter sweep:
+
+    python src/nlp_server.py --models en_core_web_lg en_vectors_web_lg
+
+While it is running, rank_tokens (query_analysis.py) and get_vectors (used by
+qas.calculate_semantic_similarity) send their texts to the server instead of loading
+the models. When the server is not running, the models are loaded in the process as
+usual. The socket path is nlp_socket in params.json (default /tmp/biqa_nlp.sock).
+
+Protocol: each message is a 4 byte big-endian length followed by a JSON object.
+Requests have an "op" (ping, rank_tokens or vectors), a "model" and a list of "texts".
+Vectors are returned as base64 encoded float32 arrays.
+"""
+
+HEADER = struct.Struct(">I")
+
+with open("params.json", "r") as f:
+    params = json.load(f)
+
+socket_path = params.get("nlp_socket", "/tmp/biqa_nlp.sock")
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode("utf-8")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_message(sock):
+    (size,) = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return json.loads(recv_exactly(sock, size).decode("utf-8"))
+
+
+def encode_array(array):
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return {
+        "shape": list(array.shape),
+        "data": base64.b64encode(array.tobytes()).decode("ascii"),
+    }
+
+
+def decode_array(message):
+    data = base64.b64decode(message["data"])
+    return np.frombuffer(data, dtype=np.float32).reshape(message["shape"])
+
+
+class NlpClient:
+    """Client of a running NLP server
+
+    :param path: socket path
+    :type path: string
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def request(self, message):
+        with self.lock:
+            send_message(self.sock, message)
+            response = recv_message(self.sock)
+        if "error" in response:
+            raise RuntimeError("nlp server: " + response["error"])
+        return response
+
+    def ping(self):
+        return self.request({"op": "ping"})["models"]
+
+    def rank_tokens(self, model, texts, batch_size=256):
+        message = {
+            "op": "rank_tokens",
+            "model": model,
+            "texts": texts,
+            "batch_size": batch_size,
+        }
+        return self.request(message)["tokens"]
+
+    def vectors(self, model, texts, batch_size=256):
+        message = {
+            "op": "vectors",
+            "model": model,
+            "texts": texts,
+            "batch_size": batch_size,
+        }
+        return decode_array(self.request(message)["vectors"])
+
+    def close(self):
+        self.sock.close()
+
+
+# client of the current process, False if there is no server
+client = None
+
+
+def get_client():
+    """Connect to the NLP server if it is running, once per process
+
+    :return: client or None if there is no server
+    :rtype: NlpClient
+    """
+    global client
+    if client is None:
+        client = False
+        if os.path.exists(socket_path):
+            try:
+                client = NlpClient(socket_path)
+                print("using nlp server with models", client.ping())
+            except OSError:
+                client = False
+    return client or None
+
+
+def reset_client():
+    """Stop using the server, after it stopped responding"""
+    global client
+    if client:
+        client.close()
+    client = False
+
+
+def rank_tokens(model, texts, batch_size=256, n_process=1):
+    """Select the tokens of each text with the server or a local model
+
+    See nlp_models.select_tokens.
+    """
+    nlp_client = get_client()
+    if nlp_client is not None:
+        try:
+            return nlp_client.rank_tokens(model, texts, batch_size)
+        except (OSError, ValueError) as e:
+            print("nlp server not available:", e)
+            reset_client()
+    return select_tokens(get_model(model), texts, batch_size, n_process)
+
+
+def get_vectors(model, texts, batch_size=256):
+    """Document vectors of each text with the server or a local model
+
+    See nlp_models.doc_vectors.
+    """
+    nlp_client = get_client()
+    if nlp_client is not None:
+        try:
+            return nlp_client.vectors(model, texts, batch_size)
+        except (OSError, ValueError) as e:
+            print("nlp server not available:", e)
+            reset_client()
+    return doc_vectors(get_model(model), texts, batch_size)
+
+
+class NlpHandler(socketserver.BaseRequestHandler):
+    """Answer the requests of a client until it disconnects"""
+
+    def handle(self):
+        while True:
+            try:
+                message = recv_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                response = self.process(message)
+            except Exception as e:
+                response = {"error": "{}: {}".format(type(e).__name__, e)}
+            send_message(self.request, response)
+
+    def process(self, message):
+        if message["op"] == "ping":
+            return {"models": sorted(self.server.models)}
+        model = message["model"]
+        batch_size = message.get("batch_size", 256)
+        # spaCy models are not thread-safe, process one request at a time
+        with self.server.lock:
+            nlp = get_model(model)
+            self.server.models.add(model)
+            if message["op"] == "rank_tokens":
+                return {"tokens": select_tokens(nlp, message["texts"], batch_size)}
+            elif message["op"] == "vectors":
+                vectors = doc_vectors(nlp, message["texts"], batch_size)
+                return {"vectors": encode_array(vectors)}
+        raise ValueError("unknown op " + str(message["op"]))
+
+
+class NlpServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, models):
+        self.lock = threading.Lock()
+        self.models = set()
+        for model in models:
+            get_model(model)
+            self.models.add(model)
+        super().__init__(path, NlpHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve spaCy models on a socket.")
+    parser.add_argument(
+        "--models", nargs="*", default=[], help="models to load on startup"
+    )
+    parser.add_argument("--socket", default=socket_path, help="socket path")
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        try:
+            NlpClient(args.socket).ping()
+            print("server already running on", args.socket)
+            sys.exit()
+        except OSError:
+            os.remove(args.socket)  # left by a server that was killed
+    server = NlpServer(args.socket, args.models)
+    print("serving on", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# persistent URL -> PMID mapping cache
+import os
+import time
+import pickle
+import sqlite3
+import threading
+
+"""
+SQLite cache of the URL -> PMID mappings obtained by qas.normalize_pmid.
+
+Each mapping is committed as soon as it is made, so a killed run keeps every
+resolution up to that point. The database uses WAL journaling so several scripts
+(e.g. reddit.py and csv_reader.py) can read and write the same cache at the same time.
+The database is only opened on first use.
+
+Each URL has a status:
+resolved: mapped to a PMID
+unmappable: the URL cannot be mapped to a PMID, it is never tried again
+transient: the last attempt failed because of a network or server error; it is tried
+again once the backoff delay (doubled at each attempt) has passed
+"""
+
+RESOLVED = "resolved"
+UNMAPPABLE = "unmappable"
+TRANSIENT = "transient"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mapping (
+    url TEXT PRIMARY KEY,
+    pmid TEXT,
+    status TEXT,
+    attempts INTEGER DEFAULT 0,
+    last_attempt REAL DEFAULT 0,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# columns added after the first version of the cache
+MIGRATION = [
+    "ALTER TABLE mapping ADD COLUMN status TEXT",
+    "ALTER TABLE mapping ADD COLUMN attempts INTEGER DEFAULT 0",
+    "ALTER TABLE mapping ADD COLUMN last_attempt REAL DEFAULT 0",
+    "ALTER TABLE mapping ADD COLUMN error TEXT",
+]
+# misses of previous versions did not distinguish network errors, so they are tried
+# once more
+MIGRATE_STATUS = """
+UPDATE mapping SET
+    status = CASE WHEN pmid IS NULL THEN 'transient' ELSE 'resolved' END,
+    attempts = CASE WHEN pmid IS NULL THEN 1 ELSE 0 END,
+    last_attempt = 0
+WHERE status IS NULL
+"""
+
+
+class CacheEntry:
+    """Status of a URL in the cache"""
+
+    def __init__(self, pmid, status, attempts, last_attempt, error):
+        self.pmid = pmid
+        self.status = status
+        self.attempts = attempts
+        self.last_attempt = last_attempt
+        self.error = error
+
+
+class PmidCache:
+    """URL -> PMID mapping backed by SQLite
+
+    *url in cache* and *cache[url]* only consider resolved URLs.
+
+    :param path: path of the SQLite database file
+    :type path: string
+    :param legacy_file: pickled dictionary to import when the database is created
+    :type legacy_file: string
+    :param timeout: seconds to wait for a lock held by another process
+    :type timeout: float
+    :param retry_delay: seconds to wait before retrying a transient failure for the
+        first time, doubled after each attempt
+    :type retry_delay: float
+    :param max_attempts: attempts after which a transient failure is not retried
+    :type max_attempts: int
+    """
+
+    def __init__(
+        self, path, legacy_file=None, timeout=60, retry_delay=600, max_attempts=5
+    ):
+        self.path = path
+        self.legacy_file = legacy_file
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.initialized = False
+
+    @property
+    def conn(self):
+        """SQLite connection of the current thread"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            with self.lock:
+                if not self.initialized:
+                    conn.executescript(SCHEMA)
+                    self.migrate(conn)
+                    self.import_legacy(conn)
+                    self.initialized = True
+        return conn
+
+    def migrate(self, conn):
+        """Add the status columns to caches created by previous versions"""
+        columns = [c[1] for c in conn.execute("PRAGMA table_info(mapping)")]
+        if "status" in columns:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = [c[1] for c in conn.execute("PRAGMA table_info(mapping)")]
+            if "status" not in columns:
+                for statement in MIGRATION:
+                    conn.execute(statement)
+                conn.execute(MIGRATE_STATUS)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def import_legacy(self, conn):
+        """Import the pickled dictionary used by previous versions, only once"""
+        if self.legacy_file is None or not os.path.isfile(self.legacy_file):
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = conn.execute(
+                "SELECT value FROM meta WHERE key = 'legacy_imported'"
+            ).fetchone()
+            if done is None:
+                print("importing pmid cache", self.legacy_file)
+                with open(self.legacy_file, "rb") as f:
+                    legacy = pickle.load(f)
+                conn.executemany(
+                    "INSERT OR IGNORE INTO mapping (url, status, attempts) "
+                    "VALUES (?, 'transient', 1)",
+                    ((url,) for url in legacy.pop("None", set())),
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO mapping (url, pmid, status) "
+                    "VALUES (?, ?, 'resolved')",
+                    legacy.items(),
+                )
+                conn.execute("INSERT INTO meta VALUES ('legacy_imported', '1')")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def lookup(self, url):
+        """Return the cache entry of a URL
+
+        :param url: url
+        :type url: string
+        :return: entry or None if the URL was never tried
+        :rtype: CacheEntry
+        """
+        row = self.conn.execute(
+            "SELECT pmid, status, attempts, last_attempt, error FROM mapping "
+            "WHERE url = ?",
+            (url,),
+        ).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(*row)
+
+    def needs_resolution(self, url, retry_transient=True):
+        """Check if a URL has to be resolved
+
+        :param url: url
+        :type url: string
+        :param retry_transient: retry transient failures whose backoff delay has passed
+        :type retry_transient: boolean
+        :return: True if the URL was never tried or is a transient failure to retry
+        :rtype: boolean
+        """
+        entry = self.lookup(url)
+        if entry is None:
+            return True
+        if entry.status != TRANSIENT or not retry_transient:
+            return False
+        if entry.attempts >= self.max_attempts:
+            return False
+        delay = self.retry_delay * 2 ** max(entry.attempts - 1, 0)
+        return time.time() - entry.last_attempt >= delay
+
+    def __contains__(self, url):
+        entry = self.lookup(url)
+        return entry is not None and entry.status == RESOLVED
+
+    def __getitem__(self, url):
+        entry = self.lookup(url)
+        if entry is None or entry.status != RESOLVED:
+            raise KeyError(url)
+        return entry.pmid
+
+    def __setitem__(self, url, pmid):
+        self.set_resolved(url, pmid)
+
+    def __len__(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM mapping WHERE status = 'resolved'"
+        ).fetchone()[0]
+
+    def set_resolved(self, url, pmid):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO mapping (url, pmid, status, attempts, last_attempt) "
+            "VALUES (?, ?, 'resolved', 0, ?)",
+            (url, pmid, time.time()),
+        )
+
+    def set_unmappable(self, url):
+        """Record a URL that cannot be mapped, keeping a previous mapping"""
+        self.conn.execute(
+            "INSERT INTO mapping (url, status, last_attempt) "
+            "VALUES (?, 'unmappable', ?) "
+            "ON CONFLICT(url) DO UPDATE SET status = 'unmappable', "
+            "last_attempt = excluded.last_attempt, error = NULL "
+            "WHERE status != 'resolved'",
+            (url, time.time()),
+        )
+
+    def set_transient(self, url, error=None):
+        """Record a failed attempt to map a URL because of a network or server error"""
+        self.conn.execute(
+            "INSERT INTO mapping (url, status, attempts, last_attempt, error) "
+            "VALUES (?, 'transient', 1, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET status = 'transient', "
+            "attempts = attempts + 1, last_attempt = excluded.last_attempt, "
+            "error = excluded.error "
+            "WHERE status != 'resolved'",
+            (url, time.time(), error),
+        )
+
+    def count_statuses(self):
+        """Number of URLs with each status"""
+        return dict(
+            self.conn.execute("SELECT status, COUNT(*) FROM mapping GROUP BY status")
+        )
@@ -0,0 +1,289 @@
+# indexed on-disk store of retrieved posts
+import os
+import json
+import sqlite3
+
+"""
+SQLite store of the questions and answers retrieved from StackExchange and Reddit.
+
+The JSON caches written by stackexchange_questions.py and csv_reader.py have to be
+fully loaded and scanned to find a single post. The store is built once from those
+caches and indexes posts by question_id/answer_id. Post metadata is read on lookup
+and the body is only read when it is accessed.
+"""
+
+QUESTION = "q"
+ANSWER = "a"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    kind TEXT NOT NULL,
+    post_id TEXT NOT NULL,
+    parent_id TEXT,
+    score INTEGER,
+    data TEXT NOT NULL,
+    body TEXT,
+    PRIMARY KEY (kind, post_id)
+);
+CREATE INDEX IF NOT EXISTS posts_parent ON posts (parent_id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+class StoredPost:
+    """Read-only post object that loads its body from the store on first access
+
+    Behaves like the dict items of the JSON caches for the keys used by the scripts
+    (*post["score"]*, *post.get("body", "")*).
+    """
+
+    def __init__(self, store, kind, post_id, fields):
+        self._store = store
+        self._kind = kind
+        self._post_id = post_id
+        self._fields = fields
+
+    def _load_body(self):
+        if "body" not in self._fields:
+            self._fields["body"] = self._store.get_body(self._kind, self._post_id)
+
+    def __getitem__(self, key):
+        if key == "body":
+            self._load_body()
+        return self._fields[key]
+
+    def __contains__(self, key):
+        if key == "body":
+            self._load_body()
+            return self._fields["body"] is not None
+        return key in self._fields
+
+    def get(self, key, default=None):
+        if key in self:
+            value = self[key]
+            return default if value is None else value
+        return default
+
+    def to_dict(self):
+        self._load_body()
+        return dict(self._fields)
+
+
+class PostStore:
+    """Indexed store of questions and answers
+
+    :param path: path of the SQLite database file
+    :type path: string
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+    def _put(self, kind, post_id, parent_id, item):
+        fields = {k: v for k, v in item.items() if k not in ("body", "answers")}
+        self.conn.execute(
+            "INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                kind,
+                str(post_id),
+                None if parent_id is None else str(parent_id),
+                fields.get("score"),
+                json.dumps(fields),
+                item.get("body"),
+            ),
+        )
+
+    def put_question(self, qid, item, commit=True):
+        """Add or replace a question (and its answers if *item* has them)
+
+        :param qid: question ID
+        :type qid: string
+        :param item: question object as returned by the StackExchange API
+        :type item: dict
+        """
+        self._put(QUESTION, qid, None, item)
+        for a in item.get("answers", []):
+            self._put(ANSWER, a["answer_id"], qid, a)
+        if commit:
+            self.conn.commit()
+
+    def put_answer(self, aid, item, qid=None, commit=True):
+        self._put(ANSWER, aid, qid, item)
+        if commit:
+            self.conn.commit()
+
+    def _get(self, kind, post_id):
+        row = self.conn.execute(
+            "SELECT data FROM posts WHERE kind = ? AND post_id = ?",
+            (kind, str(post_id)),
+        ).fetchone()
+        if row is None:
+            return None
+        return StoredPost(self, kind, str(post_id), json.loads(row[0]))
+
+    def get_question(self, qid):
+        """Retrieve a question by ID
+
+        :param qid: question ID
+        :type qid: string
+        :return: question object or None if not found
+        :rtype: StoredPost
+        """
+        return self._get(QUESTION, qid)
+
+    def get_answer(self, aid):
+        """Retrieve an answer by ID
+
+        :param aid: answer ID
+        :type aid: string
+        :return: answer object or None if not found
+        :rtype: StoredPost
+        """
+        return self._get(ANSWER, aid)
+
+    def get_body(self, kind, post_id):
+        row = self.conn.execute(
+            "SELECT body FROM posts WHERE kind = ? AND post_id = ?", (kind, post_id)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def iter_questions(self):
+        """Yield every question with its answers, in insertion order
+
+        :return: question objects in the format of the StackExchange API
+        :rtype: generator
+        """
+        questions = self.conn.execute(
+            "SELECT post_id, data, body FROM posts WHERE kind = ? ORDER BY rowid",
+            (QUESTION,),
+        )
+        for qid, data, body in questions:
+            q = json.loads(data)
+            q["body"] = body
+            answers = self.conn.execute(
+                "SELECT data, body FROM posts WHERE kind = ? AND parent_id = ? "
+                "ORDER BY rowid",
+                (ANSWER, qid),
+            )
+            q["answers"] = []
+            for a_data, a_body in answers:
+                a = json.loads(a_data)
+                a["body"] = a_body
+                q["answers"].append(a)
+            yield q
+
+    def set_meta(self, key, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value))
+        )
+        self.conn.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+
+def build_from_se_items(questions, store_file):
+    """Build a store from a StackExchange API response
+
+    :param questions: response of *StackAPI.fetch* ({items, quota_max, ...})
+    :type questions: dict
+    :param store_file: path of the SQLite database file
+    :type store_file: string
+    :return: populated store
+    :rtype: PostStore
+    """
+    store = PostStore(store_file)
+    for q in questions["items"]:
+        store.put_question(q["question_id"], q, commit=False)
+    store.conn.commit()
+    store.set_meta(
+        "response", {k: v for k, v in questions.items() if k != "items"}
+    )
+    return store
+
+
+def build_from_reddit_cache(cache, store_file):
+    """Build a store from the reddit posts cache written by csv_reader.py
+
+    Entries with a score are submissions, the other ones are comments.
+
+    :param cache: post ID -> {body, score}
+    :type cache: dict
+    :param store_file: path of the SQLite database file
+    :type store_file: string
+    :return: populated store
+    :rtype: PostStore
+    """
+    store = PostStore(store_file)
+    for post_id, post in cache.items():
+        if "score" in post:
+            store.put_question(post_id, post, commit=False)
+        else:
+            store.put_answer(post_id, post, commit=False)
+    store.conn.commit()
+    return store
+
+
+def write_reddit_cache(store, cache_file):
+    """Write the posts of a reddit store back to the JSON cache read by csv_reader.py
+
+    The store is then marked as up to date, so it is not rebuilt from the cache by
+    the next *open_store*.
+
+    :param store: reddit post store
+    :type store: PostStore
+    :param cache_file: path of the JSON cache
+    :type cache_file: string
+    """
+    cache = {}
+    for post_id, data, body in store.conn.execute(
+        "SELECT post_id, data, body FROM posts ORDER BY rowid"
+    ):
+        post = json.loads(data)
+        post["body"] = body
+        cache[post_id] = post
+    with open(cache_file, "w") as f:
+        json.dump(cache, f)
+    os.utime(store.path)
+
+
+def open_store(cache_file, reddit=False):
+    """Open the store associated with a JSON cache file, building it if necessary
+
+    The store is saved next to the cache file with a .db extension and rebuilt when
+    the cache file is newer.
+
+    :param cache_file: JSON cache of StackExchange questions or reddit posts
+    :type cache_file: string
+    :param reddit: *cache_file* is a reddit posts cache
+    :type reddit: boolean
+    :return: store
+    :rtype: PostStore
+    """
+    store_file = os.path.splitext(cache_file)[0] + ".db"
+    if os.path.isfile(store_file) and (
+        not os.path.isfile(cache_file)
+        or os.path.getmtime(store_file) >= os.path.getmtime(cache_file)
+    ):
+        return PostStore(store_file)
+    if not os.path.isfile(cache_file):
+        if reddit:
+            return PostStore(store_file)
+        return None
+    print("building post store", store_file)
+    if os.path.isfile(store_file):
+        os.remove(store_file)
+    with open(cache_file, "r") as f:
+        cache = json.load(f)
+    if reddit:
+        return build_from_reddit_cache(cache, store_file)
+    return build_from_se_items(cache, store_file)
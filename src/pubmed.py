@@ -1,23 +1,49 @@
 # pubmed api interface
+import io
 import json
 import os
-import time
 import html
-import requests
-import spacy
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
-# Load English tokenizer, tagger, parser, NER and word vectors
-nlp = spacy.load("en_core_web_lg")
+from abstract_store import AbstractStore
+from query_analysis import query_analyzer
+from result_cache import result_cache
+from pubmed_async import search_all, get_esearch_url
+from http_client import http
 
 with open("params.json", "r") as f:
     params = json.load(f)
 
+# packed abstract store, opened on first use
+abstract_store = None
+
+
+def get_abstract_store():
+    """Open the packed abstract store set in params.json (abstract_store), once
+
+    :return: store or None if there is no packed store
+    :rtype: AbstractStore
+    """
+    global abstract_store
+    if abstract_store is None:
+        store_path = params.get("abstract_store", "/pubmed_abstracts_packed/")
+        if os.path.isdir(store_path):
+            abstract_store = AbstractStore(store_path)
+        else:
+            abstract_store = False
+    return abstract_store or None
+
 
 def get_doc_text(pmid, abstract_path="/pubmed_abstracts/"):
     """Retrieve text from PubMed files stored on disk
 
+    Uses the packed abstract store if it exists, otherwise the text files.
+
     :param pmid: PubMed ID to retrieve
     :type pmid: string
     :param abstract_path: directory where pubmed text files are stored as .txt files
@@ -29,26 +55,121 @@ def get_doc_text(pmid, abstract_path="/pubmed_abstracts/"):
     if "http" in pmid:  # extract pmid
         pmid = pmid.split("/")[-1]
 
-    if not os.path.isfile(abstract_path + pmid + ".txt"):
-        # either the pmid is wrong or pubmed doesnt have an abstract in text format
-        return ("", "")
+    store = get_abstract_store()
+    if store is not None:
+        text = store.get(pmid)
+        if text is None:
+            return ("", "")
+        # same lines as readlines() of the text file (universal newlines only)
+        text = io.StringIO(text, newline=None).readlines()
+    else:
+        if not os.path.isfile(abstract_path + pmid + ".txt"):
+            # either the pmid is wrong or pubmed doesnt have an abstract in text format
+            return ("", "")
 
-    with open(abstract_path + pmid + ".txt") as f:
-        text = f.readlines()
+        with open(abstract_path + pmid + ".txt") as f:
+            text = f.readlines()
 
-    if text[0].strip() == "":
+    if not text or text[0].strip() == "":
         print("no text", text)
         return None
     return (text[0].strip(), " ".join(text[1:]).strip())
 
 
-def get_pmids_for_query(query, n_docs, n_tokens=20, n_chars=500):
+class LRUCache:
+    """Bounded thread-safe least recently used cache"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+
+doc_cache = LRUCache(params.get("doc_cache_size", 100000))
+
+# field=tiab&
+esearch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?api_key={}&db=pubmed&retmode=json&sort=relevance&retmax={}&term={}"
+
+
+def get_search_settings():
+    """Result cache settings of the searches: the esearch endpoint and the options of
+    the request URL (db, sort, ...), without the API key, retmax and the terms
+
+    :rtype: string
+    """
+    url = urllib.parse.urlsplit(get_esearch_url("", 0))
+    options = [
+        (k, v)
+        for k, v in urllib.parse.parse_qsl(url.query, keep_blank_values=True)
+        if k not in ("api_key", "retmax", "term")
+    ]
+    return urllib.parse.urlunsplit(
+        (url.scheme, url.netloc, url.path, urllib.parse.urlencode(options), "")
+    )
+
+
+def get_doc_texts(pmids, n_threads=None):
+    """Retrieve the text of many PMIDs
+
+    PMIDs are deduplicated and read in sorted order, which follows the order of the
+    packed store (or of the file names), with a thread pool. Recently read texts are
+    kept in a bounded LRU cache.
+
+    :param pmids: PubMed IDs to retrieve
+    :type pmids: iterable
+    :param n_threads: number of reader threads, by default io_threads of params.json
+        or 4 for the packed store and 16 for the text files
+    :type n_threads: int
+    :return: PMID -> (title, abstract), or None if the PMID has no text
+    :rtype: dict
+    """
+    pmids = sorted(
+        set(str(p) for p in pmids), key=lambda p: (not p.isdigit(), len(p), p)
+    )
+    texts = {}
+    missing = []
+    for pmid in pmids:
+        text = doc_cache.get(pmid, doc_cache)
+        if text is doc_cache:
+            missing.append(pmid)
+        else:
+            texts[pmid] = text
+    if n_threads is None:
+        default_threads = 4 if get_abstract_store() is not None else 16
+        n_threads = params.get("io_threads", default_threads)
+    if n_threads > 1 and len(missing) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            missing_texts = executor.map(get_doc_text, missing)
+            missing_texts = list(tqdm(missing_texts, total=len(missing)))
+    else:
+        missing_texts = [get_doc_text(pmid) for pmid in tqdm(missing)]
+    for pmid, text in zip(missing, missing_texts):
+        doc_cache.put(pmid, text)
+        texts[pmid] = text
+    return texts
+
+
+def get_pmids_for_query(query, n_docs, n_tokens=20, n_chars=500, query_tokens=None):
     """ Use PubMed entrez api to retrieve documents according to a query
 
     Query processing is performed on this function as it might differ from other
     retrieval engines.
-    The system waits 0.1 seconds between each request to prevent from going over the 
-    10 requests per second limit.
+    Requests wait for the rate limit of the eutils host (rate_limits in params.json)
+    to stay under the 10 requests per second limit.
 
     :param query: Natural language query
     :type query: string
@@ -58,33 +179,60 @@ def get_pmids_for_query(query, n_docs, n_tokens=20, n_chars=500):
     :type n_tokens: int
     :param n_chars: max number of chars of the query (including URL)
     :type n_chars: int
+    :param query_tokens: tokens selected by query_analysis, if already available
+    :type query_tokens: list
     :return: list of PMIDs
     :rtype: list
 
 
     """
-    # field=tiab&
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?api_key={}&db=pubmed&retmode=json&sort=relevance&retmax={}&term={}"
-    query = html.unescape(query)
-    doc = nlp(query)
-    doc_tokens = [t for t in doc if not t.is_punct and not t.is_space and not t.is_stop]
-    # doc_tokens = [t for t in doc if not t.is_punct and not t.is_space]
-    # doc_tokens = [t for t in doc]
-    doc_tokens = sorted(doc_tokens, key=lambda x: x.prob, reverse=False)
-    # print([(t.text, t.prob) for t in doc_tokens])
-    doc_tokens = list(dict.fromkeys([t.text.lower() for t in doc_tokens]))
+    if query_tokens is None:
+        query_tokens = query_analyzer.rank_tokens([html.unescape(query)])[0]
+    terms = get_search_terms(query_tokens, n_docs, n_tokens, n_chars)
+    settings = get_search_settings()
+    pmids = result_cache.get("pubmed", settings, terms, n_docs)
+    if pmids is not None:
+        return pmids
+    pmids = search_pubmed(get_esearch_url(terms, n_docs, params["pubmed_api"]))
+    if pmids is None:
+        return []
+    result_cache.put("pubmed", settings, terms, n_docs, pmids)
+    return pmids
+
+
+def get_search_terms(query_tokens, n_docs, n_tokens=20, n_chars=500):
+    """esearch terms of a query
+
+    :param query_tokens: tokens selected by query_analysis
+    :type query_tokens: list
+    :return: terms, trimmed so that the request URL is at most n_chars long
+    :rtype: string
+    """
+    doc_tokens = list(dict.fromkeys([t.lower() for t in query_tokens]))
     doc_tokens = doc_tokens[:n_tokens]
     # print(query, doc_tokens, file=sys.stderr)
     # q_articles[r["qid"]] = doc_tokens
     # print(doc_tokens)
-    request_url = base_url.format(params["pubmed_api"], n_docs, "+OR+".join(doc_tokens))
+    request_url = esearch_url.format(params["pubmed_api"], n_docs, "+OR+".join(doc_tokens))
     if len(request_url) > n_chars:
         print("long url! trimming to {}".format(n_chars))
         request_url = request_url[:n_chars]
+    # results depend on the search terms actually sent, after trimming
+    return request_url.split("&term=", 1)[-1]
+
+
+def search_pubmed(request_url):
+    """Run an esearch request
+
+    :param request_url: esearch URL
+    :type request_url: string
+    :return: list of PMIDs, or None if the request failed
+    :rtype: list
+    """
     try:
-        pubmed_results = requests.get(request_url)
+        pubmed_results = http.get(request_url)
     except:
-        return []
+        return None
     # print(request_url, pubmed_results.text)
     if pubmed_results.status_code != 200:
         print(pubmed_results.text)
@@ -92,19 +240,18 @@ def get_pmids_for_query(query, n_docs, n_tokens=20, n_chars=500):
     if "json" not in pubmed_results.headers.get("Content-Type"):
         print("Response content is not in JSON format.")
         print(pubmed_results.text)
-        return []
+        return None
     try:
         pubmed_results = pubmed_results.json()
     except json.decoder.JSONDecodeError:
-        return []
+        return None
 
     try:
         pmids = pubmed_results["esearchresult"]["idlist"]
     except KeyError:
         print("KEYERROR no IDs")
-        pmids = []
+        pmids = None
     # print(request_url, len(pmids))
-    time.sleep(0.1)
     return pmids
 
 
@@ -132,8 +279,28 @@ def get_pubmeds_for_questions(aueb_dic, n_docs=100, limit_queries=None):
             r for r in aueb_dic["queries"] if r["query_id"] in limit_queries
         ]
         print(aueb_dic, limit_queries)
-    for r in tqdm(aueb_dic["queries"]):
-        pmids = get_pmids_for_query(r["query_text"], n_docs)
+    query_tokens = query_analyzer.rank_tokens(
+        [html.unescape(r["query_text"]) for r in aueb_dic["queries"]]
+    )
+    terms_list = [get_search_terms(tokens, n_docs) for tokens in query_tokens]
+    settings = get_search_settings()
+    results = [
+        result_cache.get("pubmed", settings, terms, n_docs) for terms in terms_list
+    ]
+    # the other queries are run concurrently, at the rate allowed by NCBI
+    missing = [i for i, pmids in enumerate(results) if pmids is None]
+    print("{} queries in the result cache".format(len(results) - len(missing)))
+    with tqdm(total=len(missing)) as progress:
+        missing_results = search_all(
+            [terms_list[i] for i in missing], n_docs, progress=progress.update
+        )
+    for i, pmids in zip(missing, missing_results):
+        if pmids is None:
+            results[i] = []
+            continue
+        result_cache.put("pubmed", settings, terms_list[i], n_docs, pmids)
+        results[i] = pmids
+    for r, pmids in zip(aueb_dic["queries"], results):
         qid = r["query_id"]
         if qid not in ret_docs:
             ret_docs[qid] = {}
@@ -0,0 +1,253 @@
+# concurrent PubMed esearch client
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import urllib.parse
+import http.server
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ratelimit import AsyncTokenBucket
+import http_client
+
+"""
+Run many esearch requests concurrently, up to the rate allowed by NCBI.
+
+The requests are made by a pool of threads through the shared HTTP client
+(http_client.py, keep-alive connections), driven by an asyncio event loop. Each
+request takes a token from a token bucket refilled at the max rate of the host
+(rate_limits or default_rate in params.json), so the rate is kept whatever the
+latency of the responses, and from the rate limiter of http_client.py, shared with
+the other processes. Requests answered with 429 or 5xx, or that fail, are
+retried here with exponential backoff, each retry taking a token again (the status
+retries of the HTTP client are turned off for these requests).
+The results are returned in the order of the requests.
+
+The esearch server is eutils_url in params.json, so the client can be run against a
+local stub server. The stub server and a benchmark are run with:
+
+    python src/pubmed_async.py --queries 200 --rate 50 --error_rate 0.1
+"""
+
+with open("params.json", "r") as f:
+    params = json.load(f)
+
+eutils_url = params.get("eutils_url", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/")
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def get_host_rate(url):
+    """Max requests per second of the host of a URL, from params.json"""
+    host = urllib.parse.urlsplit(url).netloc
+    return params.get("rate_limits", {}).get(host, params.get("default_rate", 3))
+
+
+class EsearchClient:
+    """Concurrent esearch requests with rate limiting and retries
+
+    :param rate: max requests per second, by default the rate of the eutils host
+    :type rate: float
+    :param concurrency: max requests in progress
+    :type concurrency: int
+    :param max_retries: retries of each request
+    :type max_retries: int
+    :param backoff: seconds before the first retry, doubled after each retry
+    :type backoff: float
+    :param timeout: seconds to wait for a response
+    :type timeout: float
+    """
+
+    def __init__(
+        self, rate=None, concurrency=8, max_retries=5, backoff=1.0, timeout=30
+    ):
+        self.rate = rate or get_host_rate(eutils_url)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.retries = 0
+        self.failures = 0
+
+    def get_json(self, url):
+        """Request a URL, in a pool thread
+
+        :return: JSON response, or the status code if it should be retried
+        :rtype: dict or int
+        """
+        # fetch already waited for the rate limit and retries the answers itself
+        response = http_client.http.get(
+            url, rate_limit=False, retry_status=False, timeout=self.timeout
+        )
+        if response.status_code in RETRY_STATUS:
+            return response.status_code
+        return response.json()
+
+    async def fetch(self, url, bucket, semaphore, executor):
+        """Request a URL, retrying failures
+
+        :return: JSON response, or None if every attempt failed
+        :rtype: dict
+        """
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                await bucket.acquire()
+                # slot shared with the other processes calling the host
+                delay = http_client.rate_limiter.reserve(url)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    result = await loop.run_in_executor(executor, self.get_json, url)
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    result = type(e).__name__
+            if not isinstance(result, (int, str)):
+                return result
+            if attempt < self.max_retries:
+                # single event loop thread, no lock needed
+                self.retries += 1
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        self.failures += 1
+        print("esearch failed ({}): {}".format(result, url), file=sys.stderr)
+        return None
+
+    async def fetch_all(self, urls, progress=None):
+        bucket = AsyncTokenBucket(self.rate)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(url):
+            result = await self.fetch(url, bucket, semaphore, executor)
+            if progress is not None:
+                progress()
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # gather keeps the order of the requests
+            return await asyncio.gather(*[fetch(url) for url in urls])
+
+    def get_all(self, urls, progress=None):
+        """Request URLs concurrently
+
+        :param urls: URLs to request
+        :type urls: list
+        :param progress: function called after each URL
+        :type progress: function
+        :return: JSON response of each URL, None for failed requests
+        :rtype: list
+        """
+        if not urls:
+            return []
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.fetch_all(urls, progress))
+        finally:
+            loop.close()
+
+
+def get_esearch_url(terms, n_docs, api_key=None):
+    """esearch URL of a PubMed search sorted by relevance"""
+    url = eutils_url + "esearch.fcgi?db=pubmed&retmode=json&sort=relevance"
+    if api_key:
+        url += "&api_key=" + api_key
+    return url + "&retmax={}&term={}".format(n_docs, terms)
+
+
+def search_all(terms_list, n_docs, client=None, progress=None):
+    """Run a PubMed search for each query
+
+    :param terms_list: search terms of each query, already URL encoded
+    :type terms_list: list
+    :param n_docs: max number of documents per query
+    :type n_docs: int
+    :return: list of PMIDs of each query, None for failed searches
+    :rtype: list
+    """
+    if client is None:
+        client = EsearchClient(concurrency=params.get("pubmed_concurrency", 8))
+    urls = [
+        get_esearch_url(terms, n_docs, params.get("pubmed_api")) for terms in terms_list
+    ]
+    results = []
+    for result in client.get_all(urls, progress):
+        try:
+            results.append(result["esearchresult"]["idlist"])
+        except (KeyError, TypeError):
+            results.append(None)
+    return results
+
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class StubEsearchHandler(http.server.BaseHTTPRequestHandler):
+    """esearch stub: returns the term as PMIDs, fails some requests with 429/503"""
+
+    error_rate = 0.0
+    latency = 0.05
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.send_response(random.choice([429, 503]))
+            self.end_headers()
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        retmax = int(query.get("retmax", ["20"])[0])
+        pmids = query.get("term", [""])[0].split()[:retmax]
+        body = json.dumps({"esearchresult": {"idlist": pmids}}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    global eutils_url
+    parser = argparse.ArgumentParser(description="benchmark against a stub esearch.")
+    parser.add_argument("--queries", type=int, default=200, help="number of queries")
+    parser.add_argument("--rate", type=float, default=50, help="requests per second")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests at once")
+    parser.add_argument(
+        "--error_rate", type=float, default=0.1, help="fraction of 429/503 answers"
+    )
+    args = parser.parse_args()
+
+    StubEsearchHandler.error_rate = args.error_rate
+    server = StubServer(("127.0.0.1", 0), StubEsearchHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    eutils_url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    http_client.rate_limiter.rates[urllib.parse.urlsplit(eutils_url).netloc] = args.rate
+
+    terms_list = ["{}+{}".format(i, i + 1) for i in range(args.queries)]
+    client = EsearchClient(args.rate, args.concurrency, backoff=0.1)
+    start = time.time()
+    results = search_all(terms_list, 10, client)
+    elapsed = time.time() - start
+    server.shutdown()
+    in_order = all(r == [str(i), str(i + 1)] for i, r in enumerate(results))
+    print(
+        "{} queries in {:.2f}s ({:.1f} queries/s, {:.1f} requests/s), "
+        "{} retries, {} failed, results in order: {}".format(
+            args.queries,
+            elapsed,
+            args.queries / elapsed,
+            (args.queries + client.retries) / elapsed,
+            client.retries,
+            client.failures,
+            in_order,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# build the pubmed abstract corpus from the PubMed baseline and update files
+import os
+import sys
+import gzip
+import glob
+import argparse
+import itertools
+import multiprocessing
+import xml.etree.ElementTree as ET
+
+from tqdm import tqdm
+
+from abstract_store import update_store
+
+"""
+Build the directory of <pmid>.txt files read by pubmed.get_doc_text from the gzipped
+PubMed XML files (https://ftp.ncbi.nlm.nih.gov/pubmed/baseline/ and updatefiles/).
+
+Each text file has the article title on the first line and the abstract on the
+following line.
+The XML files are stream-parsed, one article at a time, by a pool of processes. Each
+process writes the texts of its file and only returns counts; the files take turns to
+write, in the order of the file names, so a later update file overrides the previous
+versions of an article, and DeleteCitation entries remove the text file. The articles
+parsed while a file waits for its turn are buffered (at most --buffer), then they are
+written as they are parsed.
+The names of the files already ingested are kept in <abstract_path>/.ingested, so
+running the command again with the daily update files only processes the new files,
+and only writes the articles they contain.
+The PMIDs written or deleted are appended to <abstract_path>/.changed, which --pack
+uses to update the packed store (abstract_store.update_store) without packing it
+again.
+
+Usage:
+
+    python src/pubmed_ingest.py /pubmed_xml/baseline /pubmed_xml/updatefiles --abstract_path /pubmed_abstracts/
+"""
+
+MANIFEST = ".ingested"
+CHANGED = ".changed"
+
+
+def get_text(elem):
+    """Text of an element including inline markup, in a single line"""
+    if elem is None:
+        return ""
+    return " ".join("".join(elem.itertext()).split())
+
+
+def parse_article(article):
+    """Get PMID and text of a PubmedArticle element
+
+    :return: PMID and text file contents, text is None if there is no title
+    :rtype: tuple
+    """
+    citation = article.find("MedlineCitation")
+    pmid = citation.findtext("PMID").strip()
+    title = get_text(citation.find("Article/ArticleTitle"))
+    abstract = " ".join(
+        get_text(a) for a in citation.findall("Article/Abstract/AbstractText")
+    )
+    if not title:
+        return pmid, None
+    return pmid, title + "\n" + abstract.strip() + "\n"
+
+
+def parse_file(xml_file):
+    """Stream-parse a gzipped PubMed XML file
+
+    :param xml_file: path of the .xml.gz file
+    :type xml_file: string
+    :return: (PMID, text, deleted) in the order of the file, text is None if the
+        article has no title or is deleted
+    :rtype: iterator
+    """
+    with gzip.open(xml_file, "rb") as f:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event != "end":
+                continue
+            if elem.tag == "PubmedArticle":
+                pmid, text = parse_article(elem)
+                root.clear()  # keep only the current article in memory
+                yield pmid, text, False
+            elif elem.tag == "DeleteCitation":
+                pmids = [p.text.strip() for p in elem.findall("PMID")]
+                root.clear()
+                for pmid in pmids:
+                    yield pmid, None, True
+
+
+def init_worker(condition, counter):
+    global turn, next_file
+    turn = condition
+    next_file = counter
+
+
+def ingest_file(task):
+    """Parse a file and write its texts once the previous files are written, in a
+    worker process
+
+    :param task: index of the file in the ingestion order, path of the .xml.gz file,
+        directory of the text files and max number of articles buffered while waiting
+        for the previous files
+    :type task: tuple
+    :return: file path and counts of written, unchanged and deleted texts
+    :rtype: tuple
+    """
+    index, xml_file, abstract_path, buffer_size = task
+    try:
+        records = parse_file(xml_file)
+        buffer = []
+        for record in records:
+            buffer.append(record)
+            if len(buffer) >= buffer_size or next_file.value == index:
+                break
+        with turn:
+            turn.wait_for(lambda: next_file.value == index)
+        counts = {"written": 0, "unchanged": 0, "deleted": 0}
+        with open(os.path.join(abstract_path, CHANGED), "a") as changed:
+            for pmid, text, deleted in itertools.chain(buffer, records):
+                if deleted:
+                    if delete_text(abstract_path, pmid):
+                        counts["deleted"] += 1
+                        changed.write(pmid + "\n")
+                elif text is None:
+                    continue
+                elif write_text(abstract_path, pmid, text):
+                    counts["written"] += 1
+                    changed.write(pmid + "\n")
+                else:
+                    counts["unchanged"] += 1
+        return xml_file, counts
+    finally:
+        # also on errors, so the next files are not blocked
+        with turn:
+            turn.wait_for(lambda: next_file.value == index)
+            next_file.value += 1
+            turn.notify_all()
+
+
+def write_text(abstract_path, pmid, text):
+    """Write a text file if its contents changed
+
+    :return: True if the file was written
+    :rtype: boolean
+    """
+    path = os.path.join(abstract_path, pmid + ".txt")
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            if f.read() == text:
+                return False
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return True
+
+
+def delete_text(abstract_path, pmid):
+    path = os.path.join(abstract_path, pmid + ".txt")
+    if os.path.isfile(path):
+        os.remove(path)
+        return True
+    return False
+
+
+def get_ingested(abstract_path):
+    manifest = os.path.join(abstract_path, MANIFEST)
+    if not os.path.isfile(manifest):
+        return set()
+    with open(manifest, "r") as f:
+        return set(l.strip() for l in f if l.strip())
+
+
+def get_changed(abstract_path):
+    """PMIDs written or deleted since the packed store was last updated"""
+    path = os.path.join(abstract_path, CHANGED)
+    if not os.path.isfile(path):
+        return set()
+    with open(path, "r") as f:
+        return set(l.strip() for l in f if l.strip())
+
+
+def ingest(xml_files, abstract_path, processes=None, buffer_size=10000):
+    """Write the texts of PubMed XML files that were not ingested yet
+
+    :param xml_files: paths of the .xml.gz files
+    :type xml_files: list
+    :param abstract_path: directory where pubmed text files are stored as .txt files
+    :type abstract_path: string
+    :param processes: number of parser processes, by default the number of cores
+    :type processes: int
+    :param buffer_size: max number of articles of a file buffered while waiting for
+        the previous files
+    :type buffer_size: int
+    :return: counts of written, unchanged and deleted texts
+    :rtype: dict
+    """
+    os.makedirs(abstract_path, exist_ok=True)
+    ingested = get_ingested(abstract_path)
+    xml_files = sorted(
+        (f for f in xml_files if os.path.basename(f) not in ingested),
+        key=os.path.basename,
+    )
+    counts = {"files": len(xml_files), "written": 0, "unchanged": 0, "deleted": 0}
+    print("ingesting {} files, {} already ingested".format(len(xml_files), len(ingested)))
+    if not xml_files:
+        return counts
+    tasks = [(i, f, abstract_path, buffer_size) for i, f in enumerate(xml_files)]
+    pool = multiprocessing.Pool(
+        processes=processes,
+        initializer=init_worker,
+        initargs=(multiprocessing.Condition(), multiprocessing.Value("i", 0)),
+    )
+    with pool, open(os.path.join(abstract_path, MANIFEST), "a") as manifest:
+        # imap returns the files in order, once their texts are written
+        for xml_file, file_counts in tqdm(
+            pool.imap(ingest_file, tasks), total=len(tasks)
+        ):
+            for key, value in file_counts.items():
+                counts[key] += value
+            manifest.write(os.path.basename(xml_file) + "\n")
+            manifest.flush()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build pubmed text files from XML.")
+    parser.add_argument(
+        "inputs", nargs="+", help=".xml.gz files or directories containing them"
+    )
+    parser.add_argument(
+        "--abstract_path", default="/pubmed_abstracts/", help="output directory"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=None, help="parser processes (default: cores)"
+    )
+    parser.add_argument(
+        "--buffer",
+        type=int,
+        default=10000,
+        help="articles of a file buffered while waiting for the previous files",
+    )
+    parser.add_argument(
+        "--pack", default=None, help="also update the packed store in this directory"
+    )
+    args = parser.parse_args()
+
+    xml_files = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            xml_files += glob.glob(os.path.join(path, "*.xml.gz"))
+        elif os.path.isfile(path):
+            xml_files.append(path)
+        else:
+            print("not found", path, file=sys.stderr)
+    counts = ingest(xml_files, args.abstract_path, args.processes, args.buffer)
+    print(counts)
+    changed = get_changed(args.abstract_path)
+    if args.pack and (changed or not os.path.isdir(args.pack)):
+        n = update_store(args.abstract_path, args.pack, changed)
+        print("updated {} texts of {}".format(n, args.pack))
+        if changed:
+            os.remove(os.path.join(args.abstract_path, CHANGED))
+
+
+if __name__ == "__main__":
+    main()
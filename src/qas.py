@@ -2,18 +2,18 @@ import sys
 import pickle
 import os
 import csv
-import atexit
 import requests
 import urllib.parse
 import json
 import re
 from random import sample   
 from tqdm import tqdm
-import spacy
 import numpy as np
 
-# Load English tokenizer, tagger, parser, NER and word vectors
-nlp = spacy.load("en_vectors_web_lg")
+from pmid_cache import PmidCache, RESOLVED
+from http_client import http, rate_limiter
+from link_resolver import resolve_link, NETWORK
+from nlp_server import get_vectors
 
 """
 Helper functions for QA post retrieval and processing.
@@ -23,28 +23,42 @@ with open("params.json", "r") as f:
     params = json.load(f)
 
 # use cache to avoid frequent calls to ID converter API
-cache_file = "pmid_maping.pickle"
-# store string-> pubmed ID
-if os.path.isfile(cache_file):
-    # logging.info("loading cache...")
-    pm_cache = pickle.load(open(cache_file, "rb"))
-    if "None" not in pm_cache:
-        pm_cache["None"] = set()
-    loadedcache = True
-    # logging.info("loaded cache dictionary with %s entries", str(len(pm_cache)))
-else:
-    pm_cache = {}
-    pm_cache["None"] = set()
-    loadedcache = False
-    print("new pmid cache")
+# store string-> pubmed ID, every mapping is saved as soon as it is obtained
+cache_file = "pmid_maping.db"
+# transient failures are retried after retry_delay seconds, doubled at each attempt
+pm_cache = PmidCache(
+    cache_file,
+    legacy_file="pmid_maping.pickle",
+    retry_delay=params.get("retry_delay", 600),
+    max_attempts=params.get("max_attempts", 5),
+)
 
+# NCBI services, can be pointed to another server in params.json
+idconv_url = params.get(
+    "idconv_url", "https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/"
+)
+eutils_url = params.get("eutils_url", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/")
+# max IDs per idconv/esearch request
+ncbi_batch_size = 200
 
-def exit_handler():
-    print("Saving cache dictionary...!")
-    pickle.dump(pm_cache, open(cache_file, "wb"))
 
+class TransientError(Exception):
+    """The service is unavailable or rate limited, the request can be tried again"""
 
-atexit.register(exit_handler)
+
+# errors after which a URL is tried again in a later run
+transient_errors = (requests.exceptions.RequestException, TransientError, ValueError)
+
+
+def get_url(url, **kwargs):
+    """GET through the shared HTTP client (rate limit, timeout and retries of the host)
+
+    :raises TransientError: if the response status is still 429 or 5xx after retries
+    """
+    response = http.get(url, **kwargs)
+    if response.status_code == 429 or response.status_code >= 500:
+        raise TransientError("HTTP {} {}".format(response.status_code, url))
+    return response
 
 # Question and Answer tables
 a_cols = [
@@ -70,6 +84,19 @@ def calculate_semantic_similarity(csvlines):
     """
     csv columns: qid, aid, qtext, score, docid, doctext
     """
+    # vectors of every text, computed in batches by the NLP server or a local model
+    texts = list(
+        dict.fromkeys(t for line in csvlines if len(line) > 5 for t in (line[2], line[5]))
+    )
+    vectors = get_vectors(params.get("similarity_model", "en_vectors_web_lg"), texts)
+    norms = np.linalg.norm(vectors, axis=1)
+    text_index = {t: i for i, t in enumerate(texts)}
+
+    def similarity(text1, text2):
+        """Cosine similarity of the document vectors, as spaCy's Doc.similarity"""
+        i, j = text_index[text1], text_index[text2]
+        return float(np.dot(vectors[i], vectors[j]) / (norms[i] * norms[j]))
+
     sim_values = []
     random_sim_values = []
     for i, line in enumerate(tqdm(csvlines)):
@@ -79,11 +106,9 @@ def calculate_semantic_similarity(csvlines):
             break
         if line[5].strip() == "":
             continue
-        doc1 = nlp(line[2])
-        doc2 = nlp(line[5])
-        if not doc1.vector_norm or not doc2.vector_norm:
+        if not norms[text_index[line[2]]] or not norms[text_index[line[5]]]:
             continue
-        sim_values.append(doc1.similarity(doc2))
+        sim_values.append(similarity(line[2], line[5]))
         
         #print("random lines", random_lines)
         random_compare = 1
@@ -99,10 +124,9 @@ def calculate_semantic_similarity(csvlines):
                 else:
                     break
         for r in random_lines:
-            doc3 = nlp(r[5])
-            if not doc3.vector_norm:
+            if not norms[text_index[r[5]]]:
                 continue
-            random_sim_values.append(doc1.similarity(doc3))
+            random_sim_values.append(similarity(line[2], r[5]))
         if i % 500 == 0:
             print(line[2], line[5])
             print(sum(sim_values)/len(sim_values))
@@ -371,11 +395,15 @@ def normalize_pmid(url, revisit_missing=True):
 
     Sometimes the PubMed URL has the title words instead of the PMID so we also have to 
     use the search API to retrieve the PMID.
+    Links that do not need the network are resolved with *link_resolver.resolve_link*.
     Also converts https to http (for compatibility)
     And other techniques were also implemented.
 
     :param url: url
     :type url: string
+    :param revisit_missing: retry URLs that failed because of network or server errors,
+        once their backoff delay has passed. URLs that cannot be mapped are never retried.
+    :type revisit_missing: boolean
     :return: PMID or None if it could not be mapped
     :rtype: string or None
 
@@ -395,41 +423,47 @@ def normalize_pmid(url, revisit_missing=True):
     """
 
     global pm_cache
-    if url in pm_cache:
-        return pm_cache[url]
-    elif url in pm_cache["None"] and not revisit_missing:
+    entry = pm_cache.lookup(url)
+    if entry is not None and entry.status == RESOLVED:
+        return entry.pmid
+    elif not pm_cache.needs_resolution(url, retry_transient=revisit_missing):
         return None
-    #elif revisit_missing is False:
-    #    return None
-    url_converter = "https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/?tool={}&email={}&ids={}&format=json"
-    pmsearch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&term={}&api_key={}&format=json"
-    if (
-        url.strip("/").split("/")[-1] == "pmc"
-        or url.strip("/").split("/")[-1] == "pubmed"
-    ):  # links to PMC or PubMed homepage
-        pm_cache["None"].add(url)
-        return None
-    print(url)
-    if "pmc" in url and "pmid" not in url and "?term=" not in url and "cmd=search" not in url.lower():
-        #print(url)
-        # http://europepmc.org/backend/ptpmcrender.fcgi?accid=pmc1208485&blobtype=pdf
-        # https://europepmc.org/article/pmc/pmc1208485
-        #pmcid = url.split("/")[5][:10]
-        #pmcid = "pmc" + url.split("pmc")[-1][:7]
-        match = re.search(r"pmc([0-9]+)", url)
-        #print(url, match, match.group(0))
-        if match is None:
-            pm_cache["None"].add(url)
-            return None
-        pmcid = match.group(0)
-        # pmcid = pmcid.split("/")[0]
+    # links with the PMID in the URL and links that are never mapped
+    status, pmid, family = resolve_link(url)
+    if status == NETWORK:
         try:
-            result = requests.get(
-                url_converter.format(params["toolname"], params["email"], pmcid)
-            )
-        except:
-            pm_cache["None"].add(url)
+            pmid = get_pmid_online(url, family)
+        except transient_errors as e:
+            pm_cache.set_transient(url, repr(e))
             return None
+    if pmid is None:
+        pm_cache.set_unmappable(url)
+    else:
+        pm_cache[url] = pmid
+    return pmid
+
+
+def get_pmid_online(url, family):
+    """Convert URLs that need the network to PMID using the NCBI and Elsevier APIs
+
+    :param url: url
+    :type url: string
+    :param family: family of the URL, from *link_resolver.resolve_link*
+    :type family: string
+    :return: PMID or None if the URL cannot be mapped
+    :rtype: string or None
+    :raises TransientError: if the service is unavailable or rate limited
+    """
+    url_converter = idconv_url + "?tool={}&email={}&ids={}&format=json"
+    pmsearch_url = eutils_url + "esearch.fcgi?db=pubmed&term={}&api_key={}&format=json"
+    if family == "pmc":
+        # http://europepmc.org/backend/ptpmcrender.fcgi?accid=pmc1208485&blobtype=pdf
+        # https://europepmc.org/article/pmc/pmc1208485
+        match = re.search(r"pmc([0-9]+)", url, re.IGNORECASE)
+        pmcid = "PMC" + match.group(1)
+        result = get_url(
+            url_converter.format(params["toolname"], params["email"], pmcid)
+        )
         result = result.json()
         # print(result)
         if result["status"] == "error" or "pmid" not in result["records"][0]:
@@ -437,27 +471,23 @@ def normalize_pmid(url, revisit_missing=True):
             # print(pmcid)
             # print(url)
             # print(result)
-            pm_cache["None"].add(url)
             return None
         pmid = result["records"][0]["pmid"]
-    elif ("pubmed" in url or "pmc" in url) and (
-        "?term=" in url or "cmd=search" in url.lower()
-    ):
+    elif family == "search":
         search_terms = urllib.parse.unquote(url.split("=")[-1])
-        result = requests.get(pmsearch_url.format(search_terms, params["pubmed_api"]))
+        result = get_url(pmsearch_url.format(search_terms, params["pubmed_api"]))
         result = result.json()
         if not result["esearchresult"]["idlist"]:
             # print("ERROR")
             # print(search_terms)
             # print(url)
             # print(result)
-            pm_cache["None"].add(url)
             return None
         pmid = result["esearchresult"]["idlist"][0]
         # print("cmd/term search", url, pmid)
-    elif "doi.org" in url:
+    elif family == "doi":
         doi = "/".join(url.split("/")[3:])
-        result = requests.get(
+        result = get_url(
             url_converter.format(params["toolname"], params["email"], doi)
         )
         if "json" not in result.headers.get("Content-Type"):
@@ -466,18 +496,16 @@ def normalize_pmid(url, revisit_missing=True):
             # print(doi)
             # print(url)
             # print(result)
-            pm_cache["None"].add(url)
             return None
         try:
             result = result.json()
         # print(result)
         except json.decoder.JSONDecodeError:
             print("error json decoder", result.text)
-            pm_cache["None"].add(url)
             return None
 
         if result["status"] == "error" or "pmid" not in result["records"][0]:
-            result = requests.get(
+            result = get_url(
                 pmsearch_url.format(doi + "[aid]", params["pubmed_api"])
             )
             result = result.json()
@@ -486,45 +514,32 @@ def normalize_pmid(url, revisit_missing=True):
                 # print(doi)
                 # print(url)
                 # print(result)
-                pm_cache["None"].add(url)
                 return None
             pmid = result["esearchresult"]["idlist"][0]
             # print("mapped doi with pm api", url, doi, pmid)
         else:
             pmid = result["records"][0]["pmid"]
             # print("mapped doi with id converter api", url, doi, pmid)
-    elif "linkname=" in url.lower():
-        pmid = url.split("=")[-1]
-        # print("linkname=", url, pmid)
-    elif "cmd=retrieve" in url.lower():
-        match = re.search(r"([0-9]{8})", url)
-        pmid = match.group()
-    elif "/m/pubmed" in url.lower():
-        pmid = url.split("/")[5]
-
-    elif "artid=" in url.lower():
+    elif family == "artid":
         pmcid = url.split("artid=")[-1].split("&")[0]
-        response = requests.get(
+        response = get_url(
             url_converter.format(params["toolname"], params["email"], "PMC" + pmcid)
         )
         result = response.text
         pmid = result.split("pmid=")[-1].split(" ")[0]
 
 
-    elif "accid=" in url.lower():
+    elif family == "accid":
         pmcid = url.split("accid=")[-1].split("&")[0]
-        response = requests.get(
+        response = get_url(
             url_converter.format(params["toolname"], params["email"], pmcid)
         )
         result = response.text
         pmid = result.split("pmid=")[-1].split(" ")[0]
 
 
-    elif "pmid=" in url.lower():
-        pmid = url.split("pmid=")[-1]
-
-    elif "sciencedirect" in url.lower():
-        r = requests.get(
+    elif family == "sciencedirect":
+        r = get_url(
             "https://api.elsevier.com/content/article/pii/"
             + url.split("pii/")[-1].split("?")[0]
             + "?apiKey={}".format(params["elsevier_api"])
@@ -533,12 +548,11 @@ def normalize_pmid(url, revisit_missing=True):
         if "<pubmed-id>" in response:
             pmid = response.split("<pubmed-id>")[-1].split("</pubmed-id>")[0]
         else:
-            pm_cache["None"].add(url)
             return None
 
-    elif "researchgate" in url.lower():
+    elif family == "researchgate":
         title = "+".join(url.lower().split("/")[-1].split("_")[1:])
-        result = requests.get(pmsearch_url.format(title + "[title]", params["pubmed_api"]))
+        result = get_url(pmsearch_url.format(title + "[title]", params["pubmed_api"]))
         #pmid = r.text.split("<Id>")[-1].split("</Id>")[0]
         try:
             result = result.json()
@@ -551,35 +565,197 @@ def normalize_pmid(url, revisit_missing=True):
             # print(doi)
             #print(url)
             #print(result)
-            pm_cache["None"].add(url)
             return None
         pmid = result["esearchresult"]["idlist"][0]
 
 
-    elif (
-        "imgur" in url.lower()
-        or "youtube" in url.lower()
-        or "book" in url.lower()
-        or "projects" in url.lower()
-        or "wiki" in url.lower()
-        or ".jpg" in url.lower()
-        or "flickr" in url.lower()
-    ):
-        pm_cache["None"].add(url)
+    pmid = "".join([i for i in pmid if i.isdigit()])
+    if not pmid:
         return None
+    # pmid = "http://www.ncbi.nlm.nih.gov/pubmed/" + pmid
+    return pmid
 
-    else:
+
+def get_batch_id(url):
+    """Return the ID of a URL that can be converted in batch by *normalize_pmids*
+
+    Follows the same rules as the PMC and DOI branches of *normalize_pmid*.
+
+    :param url: url
+    :type url: string
+    :return: ("pmcid", PMC ID), ("doi", DOI) or (None, None) for other URLs
+    :rtype: tuple
+    """
+    status, pmid, family = resolve_link(url)
+    if status != NETWORK:
+        return None, None
+    if family == "pmc":
+        match = re.search(r"pmc([0-9]+)", url, re.IGNORECASE)
+        return "pmcid", "PMC" + match.group(1)
+    elif family == "doi":
+        return "doi", "/".join(url.split("/")[3:]).lower()
+    return None, None
+
+
+def get_json(url, query_params):
+    """GET a JSON document"""
+    return get_url(url, params=query_params).json()
+
+
+def convert_ids(ids, idtype):
+    """Convert PMC IDs or DOIs to PMIDs with multi-id idconv requests
+
+    idconv rejects a whole request when one of its IDs is invalid, so a batch that
+    is answered with an error is split in halves that are requested again, until
+    the error is narrowed down to single IDs. Rejected IDs are not converted, like
+    the IDs answered with an error record (DOIs can still be found by *search_dois*).
+
+    :param ids: IDs of the same type
+    :type ids: list
+    :param idtype: either pmcid or doi
+    :type idtype: string
+    :return: ID -> PMID for the IDs that were converted, and the IDs of the requests
+        that failed because of network or server errors
+    :rtype: tuple
+    """
+    pmids = {}
+    failed = set()
+    batches = [
+        ids[i : i + ncbi_batch_size] for i in range(0, len(ids), ncbi_batch_size)
+    ]
+    while batches:
+        batch = batches.pop()
         try:
-            pmid = url.split("/")[4]
-            # pmid = int(pmid)
-            # pm_cache[url] = pmid
+            result = get_json(
+                idconv_url,
+                {
+                    "tool": params["toolname"],
+                    "email": params["email"],
+                    "ids": ",".join(batch),
+                    "idtype": idtype,
+                    "format": "json",
+                },
+            )
+        except transient_errors:
+            failed.update(batch)
+            continue
+        if result.get("status") == "error":
+            if len(batch) > 1:
+                half = len(batch) // 2
+                batches += [batch[:half], batch[half:]]
+            continue
+        for record in result.get("records", []):
+            if "pmid" not in record or record.get("status") == "error":
+                continue
+            key = record.get("requested-id", record.get(idtype, ""))
+            key = key.upper() if idtype == "pmcid" else key.lower()
+            pmids[key] = str(record["pmid"])
+    return pmids, failed
 
-        except:
-            pm_cache["None"].add(url)
-            return None
 
-    pmid = "".join([i for i in pmid if i.isdigit()])
-    # pmid = "http://www.ncbi.nlm.nih.gov/pubmed/" + pmid
-    print(pmid)
-    pm_cache[url] = pmid
-    return pmid
+def search_dois(dois):
+    """Find the PMIDs of DOIs with esearch [aid] OR-queries
+
+    When a query has more than one DOI, esummary is used to map each PMID back
+    to its DOI.
+
+    :param dois: lower case DOIs
+    :type dois: list
+    :return: DOI -> PMID for the DOIs that were found, and the DOIs of the requests
+        that failed because of network or server errors
+    :rtype: tuple
+    """
+    pmids = {}
+    failed = set()
+    for i in range(0, len(dois), ncbi_batch_size):
+        batch = dois[i : i + ncbi_batch_size]
+        try:
+            result = get_json(
+                eutils_url + "esearch.fcgi",
+                {
+                    "db": "pubmed",
+                    "term": " OR ".join("{}[aid]".format(doi) for doi in batch),
+                    "retmax": len(batch) * 2,
+                    "api_key": params["pubmed_api"],
+                    "format": "json",
+                },
+            )
+            idlist = result["esearchresult"].get("idlist")
+            if not idlist:
+                continue
+            if len(batch) == 1:
+                pmids[batch[0]] = idlist[0]
+                continue
+            summary = get_json(
+                eutils_url + "esummary.fcgi",
+                {
+                    "db": "pubmed",
+                    "id": ",".join(idlist),
+                    "api_key": params["pubmed_api"],
+                    "retmode": "json",
+                },
+            )
+        except transient_errors:
+            failed.update(batch)
+            continue
+        for uid in summary["result"].get("uids", []):
+            for articleid in summary["result"][uid].get("articleids", []):
+                doi = articleid["value"].lower()
+                if articleid["idtype"] == "doi" and doi in batch and doi not in pmids:
+                    pmids[doi] = uid
+    return pmids, failed
+
+
+def normalize_pmids(urls, revisit_missing=True):
+    """Convert a list of URLs to PMIDs, grouping PMC and DOI links in batch requests
+
+    PMC IDs and DOIs are converted with multi-id idconv calls, and the DOIs that
+    idconv could not convert are searched with esearch [aid] OR-queries. Other URLs
+    are converted one by one with *normalize_pmid*. Every result is written to
+    *pm_cache*.
+
+    :param urls: urls
+    :type urls: list
+    :param revisit_missing: retry URLs that failed because of network or server errors
+    :type revisit_missing: boolean
+    :return: url -> PMID or None if it could not be mapped
+    :rtype: dict
+    """
+    pmids = {}
+    batch_urls = {"pmcid": {}, "doi": {}}  # ID -> urls
+    for url in dict.fromkeys(urls):
+        if url in pm_cache:
+            pmids[url] = pm_cache[url]
+            continue
+        elif not pm_cache.needs_resolution(url, retry_transient=revisit_missing):
+            pmids[url] = None
+            continue
+        idtype, batch_id = get_batch_id(url)
+        if idtype is None:
+            pmids[url] = normalize_pmid(url, revisit_missing=revisit_missing)
+        else:
+            batch_urls[idtype].setdefault(batch_id, []).append(url)
+
+    converted, failed = convert_ids(list(batch_urls["pmcid"]), "pmcid")
+    doi_pmids, doi_failed = convert_ids(list(batch_urls["doi"]), "doi")
+    # DOIs that idconv did not convert or rejected, as normalize_pmid
+    search_pmids, search_failed = search_dois(
+        [d for d in batch_urls["doi"] if d not in doi_pmids and d not in doi_failed]
+    )
+    converted.update(doi_pmids)
+    converted.update(search_pmids)
+    failed.update(doi_failed)
+    failed.update(search_failed)
+
+    for idtype in batch_urls:
+        for batch_id, id_urls in batch_urls[idtype].items():
+            for url in id_urls:
+                pmid = converted.get(batch_id)
+                if pmid is not None:
+                    pm_cache[url] = pmid
+                elif batch_id in failed:
+                    pm_cache.set_transient(url, "batch request failed")
+                else:
+                    pm_cache.set_unmappable(url)
+                pmids[url] = pmid
+    return pmids
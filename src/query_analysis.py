@@ -0,0 +1,182 @@
+# query token selection shared by the retrieval engines
+import sys
+import json
+import sqlite3
+import hashlib
+
+from nlp_models import DISABLED_PIPES
+from nlp_server import rank_tokens
+from lexeme_table import get_table, read_parity
+
+"""
+Select the query tokens sent to the retrieval engines (galago.py, pubmed.py).
+
+Only lexical attributes are used (is_punct, is_space, is_stop and prob), so the
+queries are processed with nlp.pipe in batches with the tagger, parser and NER
+disabled. The tokens of each query are stored in a SQLite cache, keyed by the hash
+of the query text and the analyzer settings, so a query is only processed once
+across runs and engines, and the spaCy model is only loaded when some query is not
+in the cache. Queries are sent to the NLP server (nlp_server.py) when it is running.
+
+params.json options:
+query_model: spaCy model (default en_core_web_lg)
+query_cache: cache database (default query_analysis.db)
+nlp_batch_size: queries per nlp.pipe batch (default 256)
+nlp_processes: nlp.pipe processes (default 1, more than 1 requires spaCy>=2.2.2)
+query_analyzer: "spacy" (default) or "fast", which uses the lexeme table exported from
+the model instead of the model (see lexeme_table.py)
+lexeme_table: table file of the fast analyzer (default lexemes.npz)
+lexeme_min_parity: the fast analyzer is only used if the table was checked against
+the spaCy analyzer (lexeme_table.py check) with at least this fraction of the
+questions with the same tokens (default 0.99), spaCy is used otherwise
+"""
+
+# increase when the token selection changes, to ignore the previous cache entries
+ANALYZER_VERSION = 1
+
+with open("params.json", "r") as f:
+    params = json.load(f)
+
+
+class QueryAnalyzer:
+    """Batched and cached query token selection
+
+    :param model: spaCy model name
+    :type model: string
+    :param cache_file: path of the SQLite cache, None to disable the cache
+    :type cache_file: string
+    :param batch_size: queries per nlp.pipe batch
+    :type batch_size: int
+    :param n_process: nlp.pipe processes
+    :type n_process: int
+    :param mode: spacy to process the queries with the model, fast to use the lexeme
+        table exported from the model
+    :type mode: string
+    :param lexeme_table: table file of the fast mode
+    :type lexeme_table: string
+    :param min_parity: parity with the spacy mode recorded for the table, below which
+        the spacy mode is used instead of the fast mode
+    :type min_parity: float
+    """
+
+    def __init__(
+        self,
+        model="en_core_web_lg",
+        cache_file=None,
+        batch_size=256,
+        n_process=1,
+        mode="spacy",
+        lexeme_table="lexemes.npz",
+        min_parity=0.99,
+    ):
+        if mode == "fast":
+            parity = read_parity(lexeme_table)
+            if parity is None or min(parity.values()) < min_parity:
+                print(
+                    "lexeme table {} has no parity check of at least {} with spaCy "
+                    "(lexeme_table.py check), using spaCy".format(
+                        lexeme_table, min_parity
+                    ),
+                    file=sys.stderr,
+                )
+                mode = "spacy"
+        self.model = model
+        self.cache_file = cache_file
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.mode = mode
+        self.lexeme_table = lexeme_table
+        self.conn = None
+        if mode == "fast":
+            self.settings = "{}|fast|{}".format(ANALYZER_VERSION, lexeme_table)
+        else:
+            self.settings = "{}|{}|{}".format(
+                ANALYZER_VERSION, model, ",".join(DISABLED_PIPES)
+            )
+
+    def get_conn(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.cache_file)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS analysis ("
+                "settings TEXT, text_hash TEXT, tokens TEXT, "
+                "PRIMARY KEY (settings, text_hash))"
+            )
+        return self.conn
+
+    def get_key(self, text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def get_cached(self, keys):
+        """Tokens of the cached queries, by key"""
+        cached = {}
+        conn = self.get_conn()
+        keys = list(set(keys))
+        # stay below the SQLite limit of variables per statement
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            rows = conn.execute(
+                "SELECT text_hash, tokens FROM analysis WHERE settings = ? "
+                "AND text_hash IN ({})".format(",".join("?" * len(chunk))),
+                [self.settings] + chunk,
+            )
+            for key, tokens in rows:
+                cached[key] = json.loads(tokens)
+        return cached
+
+    def analyze(self, texts):
+        """Process texts with spaCy
+
+        :param texts: query texts
+        :type texts: list
+        :return: tokens of each text, without punctuation, spaces and stop words,
+            from the least to the most frequent
+        :rtype: list
+        """
+        if self.mode == "fast":
+            return get_table(self.lexeme_table).rank_tokens(texts)
+        return rank_tokens(self.model, texts, self.batch_size, self.n_process)
+
+    def rank_tokens(self, texts):
+        """Select the tokens of each query, using the cache when possible
+
+        :param texts: query texts
+        :type texts: list
+        :return: tokens of each text, without punctuation, spaces and stop words,
+            from the least to the most frequent
+        :rtype: list
+        """
+        if self.cache_file is None:
+            return self.analyze(texts)
+        keys = [self.get_key(text) for text in texts]
+        cached = self.get_cached(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing[key] = text
+        if missing:
+            print("analyzing {} queries".format(len(missing)))
+            missing_tokens = self.analyze(list(missing.values()))
+            new_entries = dict(zip(missing.keys(), missing_tokens))
+            conn = self.get_conn()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO analysis VALUES (?, ?, ?)",
+                    (
+                        (self.settings, key, json.dumps(tokens))
+                        for key, tokens in new_entries.items()
+                    ),
+                )
+            cached.update(new_entries)
+        return [cached[key] for key in keys]
+
+
+query_analyzer = QueryAnalyzer(
+    model=params.get("query_model", "en_core_web_lg"),
+    cache_file=params.get("query_cache", "query_analysis.db"),
+    batch_size=params.get("nlp_batch_size", 256),
+    n_process=params.get("nlp_processes", 1),
+    mode=params.get("query_analyzer", "spacy"),
+    lexeme_table=params.get("lexeme_table", "lexemes.npz"),
+    min_parity=params.get("lexeme_min_parity", 0.99),
+)
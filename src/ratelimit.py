@@ -0,0 +1,150 @@
+# per-host request rate limiting
+import os
+import time
+import fcntl
+import asyncio
+import threading
+import urllib.parse
+
+"""
+Rate limiters shared by the threads (RateLimiter) or coroutines (AsyncTokenBucket) of
+a process that make requests to the same host, or by all the processes of the machine
+(SharedRateLimiter).
+NCBI allows 3 requests per second without an API key and 10 with a key.
+"""
+
+
+class RateLimiter:
+    """Space out requests to each host according to a maximum rate
+
+    :param rates: host -> max requests per second
+    :type rates: dict
+    :param default_rate: max requests per second of hosts not in *rates*,
+        None for no limit
+    :type default_rate: float
+    """
+
+    def __init__(self, rates=None, default_rate=None):
+        self.rates = dict(rates or {})
+        self.default_rate = default_rate
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def get_rate(self, host):
+        return self.rates.get(host, self.default_rate)
+
+    def reserve(self, url):
+        """Reserve the next request slot of the host of *url*
+
+        :param url: url or host name
+        :type url: string
+        :return: seconds to wait before making the request
+        :rtype: float
+        """
+        host = urllib.parse.urlsplit(url).netloc or url
+        rate = self.get_rate(host)
+        if not rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + 1.0 / rate
+        return slot - now
+
+    def wait(self, url):
+        """Block until a request to the host of *url* is allowed
+
+        :param url: url or host name
+        :type url: string
+        """
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter shared by all the processes of the machine
+
+    The next free slot of each host is stored in a file of *state_dir*, read and
+    updated under an exclusive lock (flock), so parallel jobs calling the same host
+    space out their requests together.
+    The files are opened by each process, since the locks of a file descriptor
+    inherited from the parent (e.g. by multiprocessing workers) are shared with it.
+
+    :param state_dir: directory of the state files, created if needed
+    :type state_dir: string
+    """
+
+    def __init__(self, rates=None, default_rate=None, state_dir="/tmp/biqa_ratelimit"):
+        super().__init__(rates, default_rate)
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self.files = {}
+        self.pid = os.getpid()
+
+    def get_file(self, host):
+        if os.getpid() != self.pid:
+            # forked process: the inherited descriptors belong to the parent
+            self.files = {}
+            self.pid = os.getpid()
+        if host not in self.files:
+            path = os.path.join(self.state_dir, host.replace(":", "_").replace("/", "_"))
+            self.files[host] = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        return self.files[host]
+
+    def reserve(self, url):
+        host = urllib.parse.urlsplit(url).netloc or url
+        rate = self.get_rate(host)
+        if not rate:
+            return 0
+        # flock does not exclude the threads of a process sharing the file descriptor
+        with self.lock:
+            fd = self.get_file(host)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # wall clock time, the monotonic clock is not shared by processes
+                now = time.time()
+                try:
+                    next_slot = float(os.pread(fd, 32, 0))
+                except ValueError:
+                    next_slot = now
+                slot = max(now, next_slot)
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, repr(slot + 1.0 / rate).encode("ascii"), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        return slot - now
+
+
+class AsyncTokenBucket:
+    """Token bucket for the coroutines of an asyncio event loop
+
+    :param rate: tokens added per second
+    :type rate: float
+    :param capacity: max tokens, the largest burst of requests allowed
+    :type capacity: float
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = None
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        # the lock keeps the waiting coroutines in order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
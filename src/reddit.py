@@ -4,8 +4,8 @@ import pickle
 import sys
 import os
 import tqdm
-import requests
 import praw
+from http_client import http
 import pandas as pd
 from qas import (
     a_cols,
@@ -94,7 +94,7 @@ def get_reddit_questions_pushshift(sitename, min_answer_count=1, min_q_score=1):
         else:
             url = base_url
         print(iteration, url)
-        result = requests.get(url)
+        result = http.get(url)
         reddit_posts = result.json()
         if len(reddit_posts["data"]) == 0:
             break
@@ -0,0 +1,112 @@
+# persistent cache of retrieval engine results
+import json
+import sqlite3
+import hashlib
+import threading
+
+"""
+SQLite cache of the documents retrieved for each query by the retrieval engines
+(pubmed.py, galago.py).
+
+Results are keyed by the engine, the engine settings and the query sent to the
+engine (after query analysis), and are stored as soon as each query is done, so a
+repeated or interrupted run only runs the queries that are not in the cache.
+The number of documents requested (topk) is stored with the results: a request for
+fewer documents is served by truncating the cached list, and a request for more
+documents runs the query again and replaces the entry.
+
+The cache file is result_cache in params.json (default result_cache.db), set it to
+null to disable the cache.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    engine TEXT,
+    settings TEXT,
+    query TEXT,
+    topk INTEGER,
+    results TEXT
+)
+"""
+
+with open("params.json", "r") as f:
+    params = json.load(f)
+
+
+class ResultCache:
+    """Results of each (engine, settings, query), with the topk they were retrieved with
+
+    :param path: path of the SQLite database file, None to disable the cache
+    :type path: string
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def get_conn(self):
+        """SQLite connection of the current thread"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def get_key(self, engine, settings, query):
+        key = json.dumps([engine, settings, query])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, engine, settings, query, topk):
+        """Cached results of a query
+
+        :param engine: engine name
+        :type engine: string
+        :param settings: engine settings that change the results
+        :type settings: string
+        :param query: query sent to the engine
+        :type query: string
+        :param topk: number of results requested
+        :type topk: int
+        :return: first topk results, or None if the query was not run with at least
+            topk results
+        :rtype: list
+        """
+        if self.path is None:
+            return None
+        row = self.get_conn().execute(
+            "SELECT topk, results FROM results WHERE key = ?",
+            (self.get_key(engine, settings, query),),
+        ).fetchone()
+        if row is None or row[0] < topk:
+            return None
+        return json.loads(row[1])[:topk]
+
+    def put(self, engine, settings, query, topk, results):
+        """Store the results of a query, ordered by rank
+
+        An entry with more results is not replaced.
+
+        :param results: results, ordered by rank
+        :type results: list
+        """
+        if self.path is None:
+            return
+        self.get_conn().execute(
+            "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET topk = excluded.topk, "
+            "results = excluded.results WHERE excluded.topk >= results.topk",
+            (
+                self.get_key(engine, settings, query),
+                engine,
+                settings,
+                query,
+                topk,
+                json.dumps(results),
+            ),
+        )
+
+
+result_cache = ResultCache(params.get("result_cache", "result_cache.db"))
@@ -9,10 +9,8 @@ import subprocess
 import atexit
 import unicodedata
 import html
-import multiprocessing
 
 from tqdm import tqdm
-import spacy
 
 import os.path
 
@@ -25,22 +23,17 @@ import numpy as np
 # warnings.warn = warn
 
 
-from sklearn.metrics import average_precision_score
-
-from pubmed import get_doc_text
-from galago import get_doc_text_galago
+from pubmed import get_doc_text, get_doc_texts
+from evaluation import evaluate_queries, summarize, write_trec_run, write_trec_qrels
 
 """
 Evaluate document retrieval systems on the corpora generated.
-Currently implemented: galago and PubMed entrez API
+Currently implemented: galago, PubMed entrez API, a local BM25 index and
+document vectors
 Galago requries a local installation of pubmed
 PubMed API requires API key stored in params.json
 """
 
-# Load English tokenizer, tagger, parser, NER and word vectors
-nlp = spacy.load("en_core_web_lg")
-
-
 
 def process_search_results(ret_docs, aueb_dic, get_doc_set=False, use_mp=True):
     """Process document retrieval files to be used by AUEB system
@@ -145,7 +138,7 @@ def process_search_results(ret_docs, aueb_dic, get_doc_set=False, use_mp=True):
 
 def get_doc_set_info(pmids_per_q, aueb_dic, use_mp=True):
     """ Return dic with pmid -> {doc_id: title, abstract}
-    Either use a cache, or run with multiprocessing
+    Texts are read with *get_doc_texts*, with a thread pool if use_mp is True
 
     :param pmids_per_q: Dictionary with all question and respective PMIDs
     :type pmids_per_q: dict
@@ -154,35 +147,20 @@ def get_doc_set_info(pmids_per_q, aueb_dic, use_mp=True):
 
     """
     doc_set = {}
-    all_pmids = []
+    all_pmids = set()
     for q in pmids_per_q:
-        all_pmids += pmids_per_q[q].keys()
-    all_pmids = all_pmids
+        all_pmids.update(str(pmid) for pmid in pmids_per_q[q])
     print("retrieving doc text")
-    if not use_mp:
-        for pmid in tqdm(all_pmids):
-            doc_object = get_doc_object(pmid)
-            doc_set[str(pmid)] = doc_object
-            #print("not using cache", pmid, type(pmid), doc_cache[int(pmid)])
-    else:
-        with multiprocessing.Pool(processes=20) as pool:
-            doc_objects = pool.map(get_doc_object, all_pmids)
-
-            for i, doc in enumerate(doc_objects):
-                doc_set[str(all_pmids[i])] = doc
-
-    for pmid in all_pmids:
-        if doc_set.get(str(pmid), None) is None:
-            if str(pmid) in doc_set:
-                del doc_set[str(pmid)]
-
+    doc_texts = get_doc_texts(all_pmids, n_threads=None if use_mp else 1)
+    for pmid, doc_info in doc_texts.items():
+        doc_object = make_doc_object(doc_info)
+        if doc_object is not None:
+            doc_set[pmid] = doc_object
 
     return doc_set
 
 
-def get_doc_object(pmid):
-    doc_info = get_doc_text(pmid)
-    #doc_info = get_doc_text_galago(pmid)
+def make_doc_object(doc_info):
     if doc_info is not None:
         doc_object = {
             "title": doc_info[0],
@@ -194,107 +172,28 @@ def get_doc_object(pmid):
         return None
 
 
-
-def average_precision(ret_doc, rel_doc, max_items=10):
-    """
-    Calculate AP according to BioASQ guidelines. 
-
-    Instead of dividing by the number of relevant articles of each query, P is
-    divided by the maximum number of documents
-
-    :param ret_doc: ordered retrieved docs
-    :type ret_doc: list
-    :param rel_doc: relevant docs
-    :type rel_doc: list
-    :param max_items: max number of relevant items a query can have
-    :type max_items: int
-
-    """
-    # order ret_doc by score
-    # print(ret_doc, rel_doc)
-    max_items = len(ret_doc)
-    total = 0
-    for i, doc in enumerate(ret_doc):
-        if doc in rel_doc:
-            tps = set(ret_doc[: i + 1]) & set(rel_doc)
-            fps = set(ret_doc[: i + 1]) - set(rel_doc)
-            partial = len(tps) / (len(tps) + len(fps))
-            total += partial
-    # print(total)
-    return total / max_items
-
-
 def calculate_scores(data, max_retrieve=10):
     """for each q-a pair, calculate micro p/r/f
-    
+
+    The metrics of all the queries are computed at once by evaluation.py.
+
     :param data: AUEB format dictionary
     :type data: dict
     :return: precision, recall, f1, map scores
     :rtype: tuple
     """
-    new_data = {"queries": []}
-    fps = 0
-    tps = 0
-    fns = 0
-    maps = []
-    for q in data["queries"]:
-        # y_true = np.array([0, 0, 1, 1])
-        y_true = []
-        y_scores = []
-        ret_scores = {}
-        for retdoc in q["retrieved_documents"]:
-            # print(retdoc)
-            ret_scores[retdoc["doc_id"]] = retdoc["score"]
-            if retdoc["doc_id"] in q["relevant_documents"]:
-                tps += 1
-                y_true.append(1)
-                y_scores.append(retdoc["score"])
-            else:
-                fps += 1
-                y_true.append(0)
-                y_scores.append(retdoc["score"])
-        for reldoc in set(q["relevant_documents"]):
-            # print(reldoc)
-            if reldoc not in [x["doc_id"] for x in q["retrieved_documents"]]:
-                fns += 1
-        if tps > 0:
-            new_data["queries"].append(q)
-        # print(y_true, y_scores)
-        try:
-            doc_ap = average_precision_score(y_true, y_scores)
-        # doc_ap = average_precision(
-        #    [k for k, v in sorted(ret_scores.items(), key=lambda item: item[1])],
-        #    q["relevant_documents"],
-        # )
-        except:
-            doc_ap = 0.0
-        if np.isnan(doc_ap):
-            maps.append(0.0)
-        else:
-            maps.append(doc_ap)
-        # if doc_ap > 0.3:
-        #    print(q["query_id"], doc_ap, set(q["relevant_documents"]))
-    if tps + fps > 0:
-        p = tps / (tps + fps)
-    else:
-        p = 0
-
-    if tps + fns > 0:
-        r = tps / (tps + fns)
-    else:
-        r = 0
-
-    if p > 0 and r > 0:
-        f = (2 * p * r) / (p + r)
-    else:
-        f = 0
-    # print(maps)
-    map_score = sum(maps) / len(maps)
-    # gmap_score = p.exp(np.mean(np.log(np.array(maps))))
-    # a = np.log(maps)
-    # gmap_score = np.exp(a.sum() / len(a))
-    print("TPs:", tps, len(data["queries"]))
-    return (p, r, f, map_score), new_data  # , gmap_score
+    metrics = evaluate_queries(data["queries"])
+    tps = metrics["num_rel_ret"]
+    # queries from the first one with a relevant document retrieved
+    has_tps = np.cumsum(tps) > 0
+    new_data = {"queries": [q for q, keep in zip(data["queries"], has_tps) if keep]}
+    summary = summarize(metrics)
+    print("TPs:", int(tps.sum()), len(data["queries"]))
+    print(
+        "MRR: {mrr:.4f}, nDCG@10: {mndcg@10:.4f}, recall@10: {mrecall@10:.4f}, "
+        "recall@100: {mrecall@100:.4f}".format(**summary)
+    )
+    return (summary["precision"], summary["recall"], summary["f1"], summary["map"]), new_data
 
 
 def main():
@@ -333,6 +232,16 @@ def main():
             data, n_docs=topk, limit_queries=limit_queries
         )
         data, docset, bioasqjson = process_search_results(pubmed_ret_docs, data,  get_doc_set, use_mp)
+    elif retrieval_engine == "bm25":  # local index, see bm25.py
+        from bm25 import get_pmids_bm25
+
+        bm25_ret_docs = get_pmids_bm25(data, n=topk, limit_queries=limit_queries)
+        data, docset, bioasqjson = process_search_results(bm25_ret_docs, data, get_doc_set, use_mp)
+    elif retrieval_engine == "vectors":  # document vectors, see dense_retrieval.py
+        from dense_retrieval import get_pmids_vectors
+
+        vectors_ret_docs = get_pmids_vectors(data, n=topk, limit_queries=limit_queries)
+        data, docset, bioasqjson = process_search_results(vectors_ret_docs, data, get_doc_set, use_mp)
     elif retrieval_engine == "drqa":
         from drqa_retriever import get_pmids_drqa
 
@@ -346,6 +255,10 @@ def main():
         )
         data, docset, bioasqjson = process_search_results(esearch_ret_docs, data, get_doc_set, use_mp)
     # print(data)
+    if len(sys.argv) > 3:
+        # TREC files, to evaluate the run again with evaluation.py
+        write_trec_run(sys.argv[3] + ".run", data["queries"], retrieval_engine)
+        write_trec_qrels(sys.argv[3] + ".qrels", data["queries"])
     scores, data = calculate_scores(data, topk)
     print(sys.argv[1:], scores)
 
@@ -0,0 +1,200 @@
+# paired significance tests between retrieval runs
+import sys
+import time
+import argparse
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from evaluation import evaluate_runs
+
+"""
+Compare retrieval runs with paired tests on their per-query metrics (AP by default).
+
+The per-query metrics come from the evaluation of TREC run files against a qrels file
+(see evaluation.py) or from a file saved with evaluate --per_query. Only the queries
+evaluated in every run are used, so all the runs are compared on the same queries and
+every pair is tested at once:
+
+- randomization test: the sign of the per-query differences of each pair is flipped at
+  random, and the p-value is the fraction of resamples with a mean difference at least
+  as large as the observed one. The resamples are a matrix of random signs multiplied
+  by the matrix of differences of all the pairs, in blocks of resamples.
+- bootstrap: the queries are resampled with replacement, as a matrix of query counts
+  multiplied by the metrics of all the runs and the differences of all the pairs, which
+  gives percentile confidence intervals of the mean of each run and of each difference.
+
+    python src/significance.py corpus.qrels galago.run galago_bm25.run pubmed.run
+    python src/significance.py --per_query per_query.tsv --baseline galago.run
+"""
+
+# resamples per matrix product
+BLOCK_SIZE = 1000
+
+
+def per_query_table(results, metric="ap"):
+    """Table of a metric with one row per query and one column per run
+
+    :param results: path -> query ids and metrics of each query, from
+        evaluation.evaluate_runs
+    :type results: dict
+    :rtype: pandas.DataFrame
+    """
+    columns = {
+        path: pd.Series(metrics[metric], index=qids)
+        for path, (qids, metrics) in results.items()
+    }
+    return pd.DataFrame(columns)
+
+
+def read_per_query(path, metric="ap"):
+    """Table of a metric from a file saved with evaluation.py evaluate --per_query"""
+    data = pd.read_csv(path, sep="\t", dtype={"run": str, "query_id": str})
+    return data.pivot(index="query_id", columns="run", values=metric)
+
+
+def randomization_test(diffs, n_resamples=10000, seed=0):
+    """Two-sided paired randomization test of the mean of each column
+
+    :param diffs: per-query differences, one column per pair of runs
+    :type diffs: numpy.ndarray
+    :return: p-value of each column
+    :rtype: numpy.ndarray
+    """
+    rng = np.random.RandomState(seed)
+    n_queries = diffs.shape[0]
+    observed = np.abs(diffs.mean(axis=0))
+    # the tolerance keeps resamples equal to the observed mean
+    threshold = observed - 1e-12
+    extreme = np.zeros(diffs.shape[1], dtype=np.int64)
+    for start in range(0, n_resamples, BLOCK_SIZE):
+        size = min(BLOCK_SIZE, n_resamples - start)
+        signs = rng.randint(0, 2, (size, n_queries)) * 2.0 - 1
+        means = signs @ diffs / n_queries
+        extreme += (np.abs(means) >= threshold).sum(axis=0)
+    return (extreme + 1) / (n_resamples + 1)
+
+
+def bootstrap(values, n_resamples=10000, confidence=0.95, seed=0):
+    """Percentile bootstrap confidence interval of the mean of each column
+
+    :param values: per-query values, one column per run or pair of runs
+    :type values: numpy.ndarray
+    :return: lower and upper bounds of each column
+    :rtype: tuple
+    """
+    rng = np.random.RandomState(seed)
+    n_queries = values.shape[0]
+    means = np.zeros((n_resamples, values.shape[1]))
+    for start in range(0, n_resamples, BLOCK_SIZE):
+        size = min(BLOCK_SIZE, n_resamples - start)
+        samples = rng.randint(0, n_queries, (size, n_queries))
+        # number of times each query is drawn in each resample
+        offsets = samples + n_queries * np.arange(size)[:, None]
+        counts = np.bincount(offsets.ravel(), minlength=size * n_queries)
+        means[start : start + size] = counts.reshape(size, n_queries) @ values / n_queries
+    tail = (1 - confidence) / 2 * 100
+    return np.percentile(means, tail, axis=0), np.percentile(means, 100 - tail, axis=0)
+
+
+def compare_runs(table, pairs, n_resamples=10000, confidence=0.95, seed=0):
+    """Randomization test and bootstrap confidence interval of each pair of runs
+
+    :param table: per-query metric, one column per run, from per_query_table
+    :type table: pandas.DataFrame
+    :param pairs: pairs of run names to compare
+    :type pairs: list
+    :return: means of each run with their confidence intervals, and the mean
+        difference, confidence interval and p-value of each pair
+    :rtype: tuple
+    """
+    values = table.values.astype(np.float64)
+    column = {run: i for i, run in enumerate(table.columns)}
+    diffs = np.stack(
+        [values[:, column[b]] - values[:, column[a]] for a, b in pairs], axis=1
+    )
+    run_low, run_high = bootstrap(values, n_resamples, confidence, seed)
+    diff_low, diff_high = bootstrap(diffs, n_resamples, confidence, seed)
+    p_values = randomization_test(diffs, n_resamples, seed)
+    runs = pd.DataFrame(
+        {"mean": values.mean(axis=0), "ci_low": run_low, "ci_high": run_high},
+        index=list(table.columns),
+    )
+    comparisons = pd.DataFrame(
+        {
+            "run_a": [a for a, b in pairs],
+            "run_b": [b for a, b in pairs],
+            "mean_a": [runs["mean"][a] for a, b in pairs],
+            "mean_b": [runs["mean"][b] for a, b in pairs],
+            "diff": diffs.mean(axis=0),
+            "ci_low": diff_low,
+            "ci_high": diff_high,
+            "p_value": p_values,
+        }
+    )
+    return runs, comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare retrieval runs.")
+    parser.add_argument("files", nargs="*", help="qrels file and run files")
+    parser.add_argument("--per_query", help="per-query metrics file, instead of runs")
+    parser.add_argument("--metric", default="ap", help="per-query metric (default: ap)")
+    parser.add_argument("--baseline", help="compare every run with this run only")
+    parser.add_argument("--resamples", type=int, default=10000, help="resamples")
+    parser.add_argument("--confidence", type=float, default=0.95, help="CI level")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes")
+    parser.add_argument("--output", help="TSV file of the comparisons")
+    args = parser.parse_args()
+
+    if args.per_query:
+        table = read_per_query(args.per_query, args.metric)
+    elif len(args.files) >= 3:
+        results = evaluate_runs(args.files[0], args.files[1:], args.processes)
+        table = per_query_table(results, args.metric)
+    else:
+        print("usage: significance.py <qrels> <run> <run> [<run> ...]")
+        sys.exit(1)
+    n_queries = len(table)
+    table = table.dropna()
+    if len(table) < n_queries:
+        print(
+            "{} queries not evaluated in every run are left out".format(
+                n_queries - len(table)
+            )
+        )
+    if args.baseline and args.baseline not in table.columns:
+        print(
+            "unknown baseline run {}, available runs: {}".format(
+                args.baseline, ", ".join(table.columns)
+            )
+        )
+        sys.exit(1)
+    if args.baseline:
+        pairs = [(args.baseline, run) for run in table.columns if run != args.baseline]
+    else:
+        pairs = list(itertools.combinations(table.columns, 2))
+    if not pairs or len(table) == 0:
+        print("nothing to compare")
+        sys.exit(1)
+
+    start = time.time()
+    runs, comparisons = compare_runs(
+        table, pairs, args.resamples, args.confidence, args.seed
+    )
+    print(
+        "{} pairs, {} queries, {} resamples in {:.2f}s".format(
+            len(pairs), len(table), args.resamples, time.time() - start
+        )
+    )
+    with pd.option_context("display.width", 200, "display.max_colwidth", 60):
+        print(runs.round(4))
+        print(comparisons.round(4).to_string(index=False))
+    if args.output:
+        comparisons.to_csv(args.output, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,12 @@ from stackapi import StackAPI
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
-import requests
 from tqdm import tqdm
 import logging
 
+from post_store import open_store
+from http_client import http
+
 # SE answer retriever
 request_query = True  # set to True to call SE API, False uses cached pickle
 with open("params.json", "r") as f:
@@ -36,6 +38,7 @@ def retrieve_questions(sitename):
 
     Can request from scratch (request_query=True) or return a previously cached request.
     Use cached request to repeat experiments wihtout overloading the API.
+    The questions are read from the post store built from the cached request.
 
     :param sitename: Name of StackExchange community
     :type sitename: string
@@ -44,6 +47,7 @@ def retrieve_questions(sitename):
 
     """
     # sitename = sitename.split("/")[-1]
+    cache_file = "{}_questions_cache.json".format(sitename)
     if request_query:
         SITE = StackAPI(sitename, key=params["se_key"])
         SITE.page_size = 50
@@ -51,25 +55,26 @@ def retrieve_questions(sitename):
         questions = SITE.fetch(
             "questions", filter="!-*jbN-o8P3E5", sort="votes"
         )  # has q and a text
-        with open("{}_questions_cache.json".format(sitename), "w") as f:
+        with open(cache_file, "w") as f:
             json.dump(questions, f)
-    else:
-        with open("{}_questions_cache.json".format(sitename), "r") as f:
-            questions = json.load(f)
+    store = open_store(cache_file)
+    response = store.get_meta("response", {})
     # answers["items"][0]['answer_id']
     print(
         "quota max",
-        questions["quota_max"],
+        response.get("quota_max"),
         "quota remaining",
-        questions["quota_remaining"],
+        response.get("quota_remaining"),
         "total",
-        questions["total"],
+        response.get("total"),
         "page",
-        questions["page"],
+        response.get("page"),
         file=sys.stderr,
     )
-    print("retrieved {} questions".format(len(questions["items"])))
-    return questions["items"]
+    question_items = list(store.iter_questions())
+    store.close()
+    print("retrieved {} questions".format(len(question_items)))
+    return question_items
 
 
 def parse_questions(question_items, sitename, min_answer_count=1, min_q_score=1):
@@ -208,7 +213,7 @@ def get_pubmed_titles(ids):
     fetch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?"
     fetch_url += "db=pubmed&id={}&retmode=xml"
     # get titles
-    titles_result = requests.get(fetch_url.format(",".join(ids)))
+    titles_result = http.get(fetch_url.format(",".join(ids)))
     parsed_answer = BeautifulSoup(titles_result.text, "lxml-xml")
     for p in parsed_answer.find_all("MedlineCitation"):
         titles[p.find("PMID").text] = p.find("ArticleTitle").text
@@ -0,0 +1,227 @@
+# parameter sweep of the retrieval engines
+import os
+import re
+import sys
+import html
+import json
+import time
+import pickle
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from query_analysis import query_analyzer
+from evaluation import evaluate_queries, summarize, write_trec_run, write_trec_qrels
+
+"""
+Run a retrieval engine with every combination of a grid of parameters and evaluate
+each configuration on the same corpus.
+
+The corpus is loaded and its queries are analyzed once, then the configurations are
+run concurrently under a CPU budget (--cpus): each configuration gets --threads
+CPUs (galago threadCount or bm25 search processes), so cpus / threads configurations
+run at the same time. Each configuration writes its query files and its TREC run file
+in its own directory of --output, next to the qrels of the corpus, so the runs can be
+compared later with significance.py. The metrics of all the configurations are saved
+to sweep.tsv.
+
+Grid keys are the options of the engine:
+galago: batch search options, e.g. {"scorer": ["bm25"], "k": [0.9, 1.2], "b": [0.4, 0.75]}
+    or {"mu": [500, 1000, 2000]}
+bm25: k1 and b
+
+    python src/sweep.py galago corpus.pkl --grid '{"mu": [500, 1000, 2000]}' --cpus 40 --threads 10
+"""
+
+
+def get_configs(grid):
+    """Every combination of the values of a grid
+
+    :param grid: option -> list of values
+    :type grid: dict
+    :return: options of each configuration
+    :rtype: list
+    """
+    keys = sorted(grid)
+    values = [v if isinstance(v, list) else [v] for v in (grid[k] for k in keys)]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def get_config_name(engine, config):
+    name = "_".join([engine] + ["{}={}".format(k, v) for k, v in sorted(config.items())])
+    return re.sub(r"[^\w=.-]", "-", name)
+
+
+def get_run_queries(ret_docs, queries):
+    """AUEB format queries with the documents retrieved, as process_search_results
+
+    Queries without results are left out.
+    """
+    run_queries = []
+    for r in queries:
+        qid = str(r["query_id"])
+        if qid not in ret_docs:
+            continue
+        run_queries.append(
+            {
+                "query_id": qid,
+                "relevant_documents": r["relevant_documents"],
+                "retrieved_documents": [
+                    {"doc_id": str(pmid), "rank": d["rank"], "score": d["score"]}
+                    for pmid, d in ret_docs[qid].items()
+                ],
+            }
+        )
+    return run_queries
+
+
+class Sweep:
+    """Configurations of an engine run on the same corpus
+
+    :param engine: galago or bm25
+    :type engine: string
+    :param data: AUEB format dict
+    :type data: dict
+    :param topk: number of documents to retrieve per query
+    :type topk: int
+    :param threads: CPUs of each configuration
+    :type threads: int
+    :param output: output directory
+    :type output: string
+    """
+
+    def __init__(self, engine, data, topk, threads, output):
+        self.engine = engine
+        self.data = data
+        self.topk = topk
+        self.threads = threads
+        self.output = output
+        # the queries are analyzed once for all the configurations
+        if engine == "galago":
+            from galago import make_galago_queries
+
+            self.query_dic = make_galago_queries(data)
+        else:
+            self.query_tokens = query_analyzer.rank_tokens(
+                [html.unescape(r["query_text"]) for r in data["queries"]]
+            )
+
+    def run(self, config):
+        """Run and evaluate one configuration
+
+        :param config: options of the engine
+        :type config: dict
+        :return: configuration, number of queries and scores
+        :rtype: dict
+        """
+        name = get_config_name(self.engine, config)
+        workdir = os.path.join(self.output, name)
+        os.makedirs(workdir, exist_ok=True)
+        start = time.time()
+        if self.engine == "galago":
+            from galago import get_pmids_galago
+
+            ret_docs = get_pmids_galago(
+                self.data,
+                n=self.topk,
+                options=config,
+                threads=self.threads,
+                workdir=workdir,
+                query_dic=self.query_dic,
+            )
+        else:
+            from bm25 import get_pmids_bm25
+
+            ret_docs = get_pmids_bm25(
+                self.data,
+                n=self.topk,
+                processes=self.threads,
+                k1=config.get("k1"),
+                b=config.get("b"),
+                query_tokens=self.query_tokens,
+            )
+        elapsed = time.time() - start
+        run_queries = get_run_queries(ret_docs, self.data["queries"])
+        write_trec_run(os.path.join(workdir, name + ".run"), run_queries, name)
+        row = {"config": name}
+        row.update(config)
+        row["queries"] = len(run_queries)
+        row["seconds"] = round(elapsed, 1)
+        if run_queries:
+            row.update(summarize(evaluate_queries(run_queries)))
+        return row
+
+
+def run_sweep(engine, data, grid, topk=100, cpus=None, threads=4, output="sweep"):
+    """Run every configuration of a grid, several at a time
+
+    :param engine: galago or bm25
+    :type engine: string
+    :param data: AUEB format dict
+    :type data: dict
+    :param grid: option -> list of values
+    :type grid: dict
+    :param cpus: CPUs used by all the configurations, by default the number of cores
+    :type cpus: int
+    :param threads: CPUs of each configuration
+    :type threads: int
+    :return: configuration and scores of each configuration, best MAP first
+    :rtype: pandas.DataFrame
+    """
+    configs = get_configs(grid)
+    cpus = cpus or os.cpu_count()
+    threads = min(threads, cpus)
+    concurrency = max(1, min(len(configs), cpus // threads))
+    os.makedirs(output, exist_ok=True)
+    write_trec_qrels(os.path.join(output, "qrels"), data["queries"])
+    sweep = Sweep(engine, data, topk, threads, output)
+    print(
+        "running {} configurations, {} at a time with {} CPUs each".format(
+            len(configs), concurrency, threads
+        )
+    )
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        rows = list(executor.map(sweep.run, configs))
+    table = pd.DataFrame(rows)
+    if "map" in table:
+        table = table.sort_values("map", ascending=False)
+    table.to_csv(os.path.join(output, "sweep.tsv"), sep="\t", index=False)
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="parameter sweep of an engine.")
+    parser.add_argument("engine", choices=["galago", "bm25"], help="retrieval engine")
+    parser.add_argument("corpus", help="AUEB pickle file")
+    parser.add_argument(
+        "--grid", required=True, help="JSON grid of options, or a JSON file"
+    )
+    parser.add_argument("--topk", type=int, default=100, help="documents per query")
+    parser.add_argument("--cpus", type=int, default=None, help="total CPUs")
+    parser.add_argument(
+        "--threads", type=int, default=4, help="CPUs of each configuration"
+    )
+    parser.add_argument("--output", default="sweep", help="output directory")
+    args = parser.parse_args()
+
+    if os.path.isfile(args.grid):
+        with open(args.grid, "r") as f:
+            grid = json.load(f)
+    else:
+        grid = json.loads(args.grid)
+    with open(args.corpus, "rb") as f:
+        data = pickle.load(f)
+    if not data["queries"]:
+        print("no queries")
+        sys.exit()
+    table = run_sweep(
+        args.engine, data, grid, args.topk, args.cpus, args.threads, args.output
+    )
+    with pd.option_context("display.width", 200, "display.max_columns", 12):
+        print(table.round(4).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()